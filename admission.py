@@ -0,0 +1,206 @@
+"""Admission control: turn away requests a worker can't serve in time.
+
+Without it, a burst of traffic queues up on the DB pool: every request
+holds a thread while it waits for a connection, the waits grow until
+they hit the pool timeout, and the worker ends up serving mostly requests
+whose clients already gave up. With ADMISSION_ENABLED, each worker counts
+its requests in flight and answers those over its concurrency limit at
+once with 503 and a Retry-After header, before they touch the database.
+
+The limit adapts (AIMD): a request that waited more than
+ADMISSION_POOL_WAIT_MS for a pool connection, or took longer than
+ADMISSION_LATENCY_MS, cuts it by ADMISSION_BACKOFF (at most once per
+cooldown, so one burst of slow requests counts once); every other request
+raises it by 1/limit, about 1 per limit's worth of requests, while the
+worker is busy enough for the limit to matter. It stays between
+ADMISSION_MIN_LIMIT and ADMISSION_MAX_LIMIT.
+
+Requests don't all share the limit equally. By priority:
+
+- logged-in writes (posting, liking, following) may use all of it
+- other requests up to READ_SHARE of it
+- expensive reads (EXPENSIVE_ENDPOINTS, e.g. the user list and search)
+  up to EXPENSIVE_SHARE
+
+so as a worker fills up, expensive reads are shed first and writes last.
+Static files, thumbnails, /metrics and live streams are never shed or
+counted. A request that times out waiting for the pool anyway gets the
+same 503, and cuts the limit. Streamed responses (STREAMING_ENDPOINTS,
+e.g. exports) take as long as the download, so only their pool waits are
+fed back.
+"""
+
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request, session
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from werkzeug.exceptions import ServiceUnavailable
+
+from models import db
+
+WRITE = 'write'
+READ = 'read'
+EXPENSIVE = 'expensive'
+
+READ_SHARE = 0.8
+EXPENSIVE_SHARE = 0.5
+SHARES = {WRITE: 1.0, READ: READ_SHARE, EXPENSIVE: EXPENSIVE_SHARE}
+
+EXEMPT_ENDPOINTS = {'static', 'thumbnail', 'metrics', 'timeline_stream'}
+EXPENSIVE_ENDPOINTS = {'list_users', 'messages_search', 'show_following',
+                       'users_followers', 'show_like', 'export_user'}
+# responses streamed for as long as the client reads them: their latency
+# says nothing about how loaded the worker is
+STREAMING_ENDPOINTS = {'export_user', 'timeline_stream'}
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+def classify(endpoint, method, logged_in):
+    """Priority of a request, or None if it's exempt."""
+
+    if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+        return None
+    if method not in SAFE_METHODS and logged_in:
+        return WRITE
+    if endpoint in EXPENSIVE_ENDPOINTS:
+        return EXPENSIVE
+    return READ
+
+
+class AIMDLimit:
+    """A concurrency limit adjusted by additive increase, multiplicative
+    decrease."""
+
+    def __init__(self, initial=20, minimum=2, maximum=200,
+                 pool_wait_target=0.05, latency_target=1.0, backoff=0.9,
+                 cooldown=0.5, clock=time.monotonic):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.pool_wait_target = pool_wait_target
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.clock = clock
+        self.decreased_at = None
+
+    def update(self, latency, pool_wait, in_flight):
+        """Adjust for a request that finished with `in_flight` requests
+        (itself included) running."""
+
+        if pool_wait > self.pool_wait_target or latency > self.latency_target:
+            now = self.clock()
+            if (self.decreased_at is None
+                    or now - self.decreased_at >= self.cooldown):
+                self.decreased_at = now
+                self.limit = max(self.minimum, self.limit * self.backoff)
+        elif in_flight * 2 >= self.limit:
+            # idle workers don't learn anything about their capacity
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+
+class AdmissionController:
+    """Requests in flight in this process, admitted against a limit."""
+
+    def __init__(self, limit, retry_after=1, user_key='curr_user'):
+        self.limit = limit
+        self.retry_after = retry_after
+        self.user_key = user_key
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.shed = Counter()
+
+    def acquire(self, priority):
+        """Take a slot for a `priority` request; False if it's shed."""
+
+        with self.lock:
+            if self.in_flight + 1 > max(1, self.limit.limit
+                                        * SHARES[priority]):
+                self.shed[priority] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, pool_wait):
+        """Give back a slot, feeding back how the request went."""
+
+        with self.lock:
+            self.limit.update(latency, pool_wait, self.in_flight)
+            self.in_flight -= 1
+
+    def instrument_pool(self, pool):
+        """Add connection checkout waits from `pool` to the request's."""
+
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                if has_request_context() and 'admission_start' in g:
+                    g.admission_pool_wait += time.perf_counter() - start
+
+        pool.connect = timed_connect
+        pool.admission_instrumented = True
+
+    def before_request(self):
+        if not current_app.config['ADMISSION_ENABLED']:
+            return
+
+        # engine.dispose() (e.g. after fork) replaces the pool
+        if not getattr(db.engine.pool, 'admission_instrumented', False):
+            self.instrument_pool(db.engine.pool)
+
+        priority = classify(request.endpoint, request.method,
+                            self.user_key in session)
+        if priority is None:
+            return
+        if not self.acquire(priority):
+            metrics = current_app.extensions.get('metrics')
+            if metrics is not None:
+                metrics.registry.inc('warbler_admission_shed_total',
+                                     {'priority': priority})
+            raise ServiceUnavailable(retry_after=self.retry_after)
+
+        g.admission_start = time.perf_counter()
+        g.admission_pool_wait = 0.0
+
+    def teardown_request(self, exc):
+        if 'admission_start' not in g:
+            return
+        start = g.pop('admission_start')
+        latency = (0.0 if request.endpoint in STREAMING_ENDPOINTS
+                   else time.perf_counter() - start)
+        self.release(latency, g.pop('admission_pool_wait'))
+
+    def pool_timeout(self, error):
+        """A request that gave up on the pool: shed it, and back off."""
+
+        if 'admission_start' in g:
+            g.admission_pool_wait = float('inf')
+        return ServiceUnavailable(
+            retry_after=self.retry_after).get_response()
+
+
+def init_app(app, user_key):
+    """Admit `app`'s requests against an adaptive concurrency limit.
+    `user_key` is the session key of the logged-in user."""
+
+    config = app.config
+    controller = AdmissionController(
+        AIMDLimit(config['ADMISSION_INITIAL_LIMIT'],
+                  config['ADMISSION_MIN_LIMIT'],
+                  config['ADMISSION_MAX_LIMIT'],
+                  config['ADMISSION_POOL_WAIT_MS'] / 1000,
+                  config['ADMISSION_LATENCY_MS'] / 1000,
+                  config['ADMISSION_BACKOFF']),
+        config['ADMISSION_RETRY_AFTER'], user_key)
+    app.extensions['admission'] = controller
+
+    app.before_request(controller.before_request)
+    app.teardown_request(controller.teardown_request)
+    app.register_error_handler(PoolTimeout, controller.pool_timeout)
@@ -1,13 +1,43 @@
+import csv
+import io
 import os
+import tempfile
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g, abort
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, abort, jsonify, Response, stream_with_context)
+from sqlalchemy import tuple_
 from sqlalchemy.exc import IntegrityError
-
-from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from forms import (UserAddForm, LoginForm, MessageForm, UserEditForm,
+                   FollowImportForm)
+from models import db, connect_db, User, Message, Likes, Follows
+import admission
+import archive
+import assets
+import availability
+import capture
+import export
+import graph
+import likebuffer
+import live
+import metrics
+import notifications
+import profiler
+import replay
+import search
+import sharding
+import slowlog
+import thumbnails
+import timeline
+from ratelimit import RateLimiter, make_backend
 
 CURR_USER_KEY = "curr_user"
+LIKES_PAGE_SIZE = 20
+MAX_BULK_FOLLOWS = 1000
+ARCHIVE_AFTER_MONTHS = 12
 
 app = Flask(__name__)
 
@@ -18,11 +48,172 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
-#app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-#toolbar = DebugToolbarExtension(app)
+
+# Dev-only tooling; not even imported in production (FLASK_ENV=production,
+# see wsgi.py), since it only slows down worker startup there.
+if os.environ.get('FLASK_ENV') != 'production':
+    from flask_debugtoolbar import DebugToolbarExtension
+    #app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+    #toolbar = DebugToolbarExtension(app)
+
+# Rate limiting: 'memory' (per worker) or 'sqlite:////path/to/file.db'
+# (shared by all workers on this machine).
+app.config['RATELIMIT_ENABLED'] = (
+    os.environ.get('RATELIMIT_ENABLED', '1') == '1')
+app.config['RATELIMIT_BACKEND'] = (
+    os.environ.get('RATELIMIT_BACKEND', 'memory'))
+
+# Reverse proxies in front of the app that set X-Forwarded-For and
+# X-Forwarded-Proto; client addresses (rate limits, the metrics allowlist)
+# are read from those headers. Leave at 0 when clients connect directly,
+# or they can forge their address.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app,
+                            x_for=app.config['TRUSTED_PROXIES'],
+                            x_proto=app.config['TRUSTED_PROXIES'])
+
+# Thumbnails of remote avatars/header images (see thumbnails.py)
+app.config['THUMBNAIL_CACHE_DIR'] = os.environ.get(
+    'THUMBNAIL_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), f'warbler-thumbs-{os.getuid()}'))
+app.config['THUMBNAIL_CACHE_MAX_BYTES'] = int(
+    os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+app.config['THUMBNAIL_WORKERS'] = int(os.environ.get('THUMBNAIL_WORKERS', 4))
+# Fetch sources on private/loopback addresses too; only for development.
+app.config['THUMBNAIL_ALLOW_PRIVATE'] = (
+    os.environ.get('THUMBNAIL_ALLOW_PRIVATE') == '1')
+
+# Home timeline engine: 'sql' (one IN query per page load) or 'cache'
+# (merge of per-author recent-message caches; see timeline.py)
+app.config['TIMELINE_ENGINE'] = os.environ.get('TIMELINE_ENGINE', 'sql')
+app.config['TIMELINE_CACHE_TTL'] = int(
+    os.environ.get('TIMELINE_CACHE_TTL', 30))
+
+# On-demand profiling (see profiler.py): off unless a token is set or the
+# sample rate is above 0.
+app.config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN', '')
+app.config['PROFILER_SAMPLE_RATE'] = float(
+    os.environ.get('PROFILER_SAMPLE_RATE', 0))
+app.config['PROFILER_ENDPOINTS'] = [
+    endpoint for endpoint in os.environ.get('PROFILER_ENDPOINTS', '').split(',')
+    if endpoint]
+app.config['PROFILER_MODE'] = os.environ.get('PROFILER_MODE', 'sample')
+app.config['PROFILER_INTERVAL'] = float(
+    os.environ.get('PROFILER_INTERVAL', 0.001))
+app.config['PROFILER_DIR'] = os.environ.get(
+    'PROFILER_DIR', os.path.join(tempfile.gettempdir(), 'warbler-profiles'))
+
+# Prometheus metrics at /metrics (see metrics.py). Set METRICS_DIR to a
+# directory shared by all workers to report for the whole node.
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', '')
+app.config['METRICS_FLUSH_INTERVAL'] = float(
+    os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+app.config['METRICS_ALLOWED_IPS'] = os.environ.get(
+    'METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+# Slow query log (see slowlog.py); SLOW_QUERY_MS=0 turns it off.
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 200))
+app.config['SLOW_QUERY_LOG'] = os.environ.get(
+    'SLOW_QUERY_LOG', os.path.join(app.instance_path, 'slow-queries.log'))
+app.config['SLOW_QUERY_ENDPOINTS'] = [
+    endpoint for endpoint in os.environ.get('SLOW_QUERY_ENDPOINTS', '').split(',')
+    if endpoint]
+app.config['SLOW_QUERY_EXPLAIN_INTERVAL'] = float(
+    os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', 60))
+# parameter values include emails and password hashes: off by default
+app.config['SLOW_QUERY_LOG_PARAMETERS'] = (
+    os.environ.get('SLOW_QUERY_LOG_PARAMETERS') == '1')
+
+# Seconds between picking up users created by other workers (see
+# availability.py).
+app.config['USERNAME_FILTER_REFRESH'] = float(
+    os.environ.get('USERNAME_FILTER_REFRESH', 5))
+
+# Follow graph engine: 'sql' (queries) or 'csr' (in-memory arrays, see
+# graph.py), rebuilt every GRAPH_REBUILD_INTERVAL seconds.
+app.config['GRAPH_ENGINE'] = os.environ.get('GRAPH_ENGINE', 'sql')
+app.config['GRAPH_REBUILD_INTERVAL'] = float(
+    os.environ.get('GRAPH_REBUILD_INTERVAL', 60))
+
+# Likes and follows within a bucket of this many hours are aggregated into
+# one notification (see notifications.py).
+app.config['NOTIFICATION_BUCKET_HOURS'] = float(
+    os.environ.get('NOTIFICATION_BUCKET_HOURS', 24))
+
+# Live timeline updates over SSE (see live.py); off unless the server can
+# hold many idle connections (gunicorn.conf.py turns it on for gevent).
+# LIVE_CHANNEL carries new messages between workers: 'auto', 'postgres',
+# 'unix' or 'local'.
+app.config['LIVE_UPDATES'] = os.environ.get('LIVE_UPDATES') == '1'
+app.config['LIVE_CHANNEL'] = os.environ.get('LIVE_CHANNEL', 'auto')
+app.config['LIVE_SOCKET_DIR'] = os.environ.get(
+    'LIVE_SOCKET_DIR',
+    os.path.join(tempfile.gettempdir(), f'warbler-live-{os.getuid()}'))
+app.config['LIVE_MAX_STREAMS'] = int(os.environ.get('LIVE_MAX_STREAMS', 1000))
+app.config['LIVE_HEARTBEAT'] = float(os.environ.get('LIVE_HEARTBEAT', 15))
+
+# Shard messages and likes by author over these databases (see
+# sharding.py); empty keeps them in the main database.
+app.config['SHARD_DATABASE_URLS'] = [
+    url for url in os.environ.get('SHARD_DATABASE_URLS', '').split(',')
+    if url]
+app.config['SHARD_MAP_REFRESH'] = float(
+    os.environ.get('SHARD_MAP_REFRESH', 5))
+
+# Like writes: 'direct' (a commit per click) or 'buffered' (group commits
+# every LIKE_FLUSH_MS; see likebuffer.py). LIKE_DURABILITY 'commit' waits
+# for the group commit, 'async' doesn't.
+app.config['LIKE_WRITE_MODE'] = os.environ.get('LIKE_WRITE_MODE', 'direct')
+app.config['LIKE_FLUSH_MS'] = float(os.environ.get('LIKE_FLUSH_MS', 5))
+app.config['LIKE_FLUSH_BATCH'] = int(os.environ.get('LIKE_FLUSH_BATCH', 500))
+app.config['LIKE_BUFFER_MAX'] = int(os.environ.get('LIKE_BUFFER_MAX', 10000))
+app.config['LIKE_DURABILITY'] = os.environ.get('LIKE_DURABILITY', 'commit')
+
+# Traffic capture for `flask replay-traffic` (see capture.py); off unless
+# CAPTURE_LOG is set. Senders are pseudonymized with CAPTURE_KEY
+# (default: SECRET_KEY).
+app.config['CAPTURE_LOG'] = os.environ.get('CAPTURE_LOG', '')
+app.config['CAPTURE_KEY'] = os.environ.get('CAPTURE_KEY', '')
+app.config['CAPTURE_SAMPLE_RATE'] = float(
+    os.environ.get('CAPTURE_SAMPLE_RATE', 1))
+
+# Admission control (see admission.py): shed requests over an adaptive
+# per-worker concurrency limit with 503 + Retry-After.
+app.config['ADMISSION_ENABLED'] = (
+    os.environ.get('ADMISSION_ENABLED', '1') == '1')
+app.config['ADMISSION_INITIAL_LIMIT'] = int(
+    os.environ.get('ADMISSION_INITIAL_LIMIT', 20))
+app.config['ADMISSION_MIN_LIMIT'] = int(
+    os.environ.get('ADMISSION_MIN_LIMIT', 2))
+app.config['ADMISSION_MAX_LIMIT'] = int(
+    os.environ.get('ADMISSION_MAX_LIMIT', 200))
+app.config['ADMISSION_POOL_WAIT_MS'] = float(
+    os.environ.get('ADMISSION_POOL_WAIT_MS', 50))
+app.config['ADMISSION_LATENCY_MS'] = float(
+    os.environ.get('ADMISSION_LATENCY_MS', 1000))
+app.config['ADMISSION_BACKOFF'] = float(
+    os.environ.get('ADMISSION_BACKOFF', 0.9))
+app.config['ADMISSION_RETRY_AFTER'] = int(
+    os.environ.get('ADMISSION_RETRY_AFTER', 1))
 
 connect_db(app)
+slowlog.init_app(app)
+metrics.init_app(app)
+capture.init_app(app, CURR_USER_KEY)
+admission.init_app(app, CURR_USER_KEY)
+assets.init_app(app)
+thumbnails.init_app(app)
+timeline.init_app(app)
+availability.init_app(app)
+graph.init_app(app)
+sharding.init_app(app)
+likebuffer.init_app(app)
+notifications.init_app(app)
+live.init_app(app)
+profiler.init_app(app)
+limiter = RateLimiter(backend=make_backend(app.config['RATELIMIT_BACKEND']))
 
 
 ##############################################################################
@@ -40,6 +231,18 @@ def add_user_to_g():
         g.user = None
 
 
+@app.before_request
+def rate_limit():
+    """Throttle login/signup/posting/liking per IP and per user, and login
+    attempts per username and IP."""
+
+    if app.config['RATELIMIT_ENABLED']:
+        username = (request.form.get('username')
+                    if limiter.needs_username(request.endpoint) else None)
+        limiter.check(request.endpoint, request.method, request.remote_addr,
+                      g.user.id if g.user else None, username)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -69,6 +272,14 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # reject known collisions before paying for the bcrypt hash
+        if availability.is_taken('username', form.username.data):
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+        if availability.is_taken('email', form.email.data):
+            flash("Email already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -82,6 +293,7 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        availability.user_added(user)
         do_login(user)
 
         return redirect("/")
@@ -90,6 +302,27 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
+@app.route('/users/available')
+def check_available():
+    """Are a username and/or email free? For live form validation.
+
+    Takes `username` and/or `email` query parameters; returns JSON like
+    {"username": true, "email": false}. Values the logged-in user already
+    has count as available.
+    """
+
+    result = {}
+    for field in availability.FIELDS:
+        value = request.args.get(field)
+        if value:
+            result[field] = not availability.is_taken(
+                field, value, g.user.id if g.user else None)
+
+    if not result:
+        abort(400)
+    return jsonify(result)
+
+
 @app.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
@@ -144,16 +377,24 @@ def users_show(user_id):
 
     user = User.query.get_or_404(user_id)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    likes = [message.id for message in user.likes]
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    viewer_id = g.user.id if g.user else None
+    if sharding.enabled():
+        messages = sharding.user_messages(user_id, 100)
+        likes, like_counts = sharding.page_state(viewer_id, messages)
+    else:
+        # snagging messages in order from the database;
+        # user.messages won't be in order by default
+        messages = (Message
+                    .query
+                    .filter(Message.user_id == user_id)
+                    .order_by(Message.timestamp.desc())
+                    .limit(100)
+                    .all())
+        message_ids = [message.id for message in messages]
+        likes, like_counts = likebuffer.overlay(
+            viewer_id, message_ids, *Likes.page_state(viewer_id, message_ids))
+    return render_template('users/show.html', user=user, messages=messages,
+                           likes=likes, like_counts=like_counts)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -170,14 +411,35 @@ def show_following(user_id):
 
 @app.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user.
+
+    With ?filter=mutual, only those the user follows back.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    mutual = request.args.get('filter') == 'mutual'
+    if mutual:
+        # followers the user follows back, in one join
+        follower = db.aliased(Follows)
+        back = db.aliased(Follows)
+        followers = (User.query
+                     .join(follower, db.and_(
+                         follower.user_following_id == User.id,
+                         follower.user_being_followed_id == user_id))
+                     .join(back, db.and_(
+                         back.user_following_id == user_id,
+                         back.user_being_followed_id == User.id))
+                     .order_by(User.id)
+                     .all())
+    else:
+        followers = user.followers
+
+    return render_template('users/followers.html', user=user,
+                           followers=followers, mutual=mutual)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -188,9 +450,11 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    User.query.get_or_404(follow_id)
+    if Follows.follow_many(g.user.id, User.id == follow_id):
+        notifications.record_follow(follow_id, g.user)
     db.session.commit()
+    graph.user_follows_changed(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -203,13 +467,113 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    Follows.unfollow_many(g.user.id, User.id == follow_id)
     db.session.commit()
+    graph.user_follows_changed(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
+def bulk_user_ids():
+    """User ids posted to a bulk follow endpoint.
+
+    Takes JSON {"user_ids": [...]} or repeated 'user_ids' form fields;
+    responds 400 if they aren't ids or there are too many.
+    """
+
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        user_ids = data.get('user_ids')
+    else:
+        user_ids = request.form.getlist('user_ids')
+
+    try:
+        user_ids = {int(user_id) for user_id in user_ids}
+    except (TypeError, ValueError):
+        abort(400)
+
+    if not user_ids or len(user_ids) > MAX_BULK_FOLLOWS:
+        abort(400)
+
+    return user_ids
+
+
+@app.route('/users/follow', methods=['POST'])
+def add_follows():
+    """Follow many users at once (e.g. onboarding suggestions).
+
+    Responds with JSON: how many new follows, and the new following count.
+    """
+
+    if not g.user:
+        abort(401)
+
+    followed = Follows.follow_many(g.user.id, User.id.in_(bulk_user_ids()))
+    db.session.commit()
+    graph.user_follows_changed(g.user.id)
+
+    return jsonify(followed=followed,
+                   following_count=Follows.following_count(g.user.id))
+
+
+@app.route('/users/stop-following', methods=['POST'])
+def stop_following_many():
+    """Stop following many users at once.
+
+    Responds with JSON: how many follows removed, and the new following count.
+    """
+
+    if not g.user:
+        abort(401)
+
+    unfollowed = Follows.unfollow_many(g.user.id, User.id.in_(bulk_user_ids()))
+    db.session.commit()
+    graph.user_follows_changed(g.user.id)
+
+    return jsonify(unfollowed=unfollowed,
+                   following_count=Follows.following_count(g.user.id))
+
+
+@app.route('/users/following/import', methods=['GET', 'POST'])
+def import_following():
+    """Follow everyone listed in an uploaded CSV of usernames.
+
+    The CSV may have a 'username' header; otherwise the first column is
+    used. Unknown usernames are ignored.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = FollowImportForm()
+
+    if form.validate_on_submit():
+        lines = io.TextIOWrapper(form.csv_file.data.stream, encoding='UTF-8',
+                                 errors='replace')
+        rows = [row for row in csv.reader(lines) if row]
+        if rows and 'username' in rows[0]:
+            column = rows.pop(0).index('username')
+        else:
+            column = 0
+        usernames = {row[column].strip().lstrip('@')
+                     for row in rows if len(row) > column}
+
+        followed = 0
+        usernames = sorted(usernames)
+        for start in range(0, len(usernames), MAX_BULK_FOLLOWS):
+            batch = usernames[start:start + MAX_BULK_FOLLOWS]
+            followed += Follows.follow_many(g.user.id,
+                                            User.username.in_(batch))
+        db.session.commit()
+        graph.user_follows_changed(g.user.id)
+
+        flash(f"Followed {followed} new users.", "success")
+        return redirect(f"/users/{g.user.id}/following")
+
+    return render_template('users/import.html', form=form)
+
+
 @app.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
@@ -222,6 +586,14 @@ def profile():
     form = UserEditForm(obj=user)
     
     if form.validate_on_submit():
+        if availability.is_taken('username', form.username.data, user.id):
+            flash("Username already taken", 'danger')
+            return render_template("users/edit.html", form=form, user_id=user.id)
+        if availability.is_taken('email', form.email.data, user.id):
+            flash("Email already taken", 'danger')
+            return render_template("users/edit.html", form=form, user_id=user.id)
+
+        old_username, old_email = user.username, user.email
         if User.authenticate(form.username.data, form.password.data):
             user.username = form.username.data
             user.email = form.email.data
@@ -231,6 +603,7 @@ def profile():
             user.location=form.location.data
             
             db.session.commit()
+            availability.user_changed(old_username, old_email, user)
             return redirect(f"/users/{user.id}")
         flash("Unauthorized, plese try again","danger")
     return render_template("users/edit.html", form=form, user_id=user.id)
@@ -243,9 +616,24 @@ def add_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    if sharding.enabled():
+        liked_message = sharding.find_message(message_id)
+        if liked_message is None:
+            abort(404)
+        if liked_message.user_id == g.user.id:
+            return abort(403)
+        if sharding.toggle_like(g.user.id, liked_message):
+            notifications.record_like(liked_message, g.user)
+            db.session.commit()
+        return redirect('/')
+
     liked_message = Message.query.get_or_404(message_id)
     if liked_message.user_id == g.user.id:
         return abort(403)
+
+    if likebuffer.enabled():
+        likebuffer.toggle(g.user.id, liked_message)
+        return redirect('/')
     
     user_likes = g.user.likes
     
@@ -253,6 +641,7 @@ def add_like(message_id):
         g.user.likes = [like for like in user_likes if like != liked_message]
     else:
         g.user.likes.append(liked_message)
+        notifications.record_like(liked_message, g.user)
     
     db.session.commit()
     
@@ -267,7 +656,102 @@ def show_like(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template("/users/likes.html", user=user, likes=user.likes)
+
+    before = request.args.get('before', '')
+    liked_at, _, like_id = before.rpartition('_')
+    cursor = None
+    if liked_at and like_id.isdigit():
+        try:
+            cursor = (datetime.fromisoformat(liked_at), int(like_id))
+        except ValueError:
+            abort(400)
+
+    if sharding.enabled():
+        likes = sharding.liked_messages(user_id, cursor, LIKES_PAGE_SIZE + 1)
+        return render_liked_messages(user, likes)
+
+    # one query for the page: likes -> messages -> authors, newest like
+    # first, only the columns the template shows. `before` is the
+    # "<timestamp>_<like id>" of the last like on the previous page.
+    query = (db.session
+             .query(Likes.id.label('like_id'),
+                    Likes.timestamp.label('liked_at'),
+                    Message.id,
+                    Message.text,
+                    Message.timestamp,
+                    User.id.label('author_id'),
+                    User.username.label('author_username'),
+                    User.image_url.label('author_image_url'))
+             .join(Message, Message.id == Likes.message_id)
+             .join(User, User.id == Message.user_id)
+             .filter(Likes.user_id == user_id))
+
+    if cursor is not None:
+        query = query.filter(tuple_(Likes.timestamp, Likes.id) < cursor)
+
+    likes = (query
+             .order_by(Likes.timestamp.desc(), Likes.id.desc())
+             .limit(LIKES_PAGE_SIZE + 1)
+             .all())
+    return render_liked_messages(user, likes)
+
+
+def render_liked_messages(user, likes):
+    """The likes page for up to LIKES_PAGE_SIZE + 1 liked messages."""
+
+    next_page = None
+    if len(likes) > LIKES_PAGE_SIZE:
+        likes = likes[:LIKES_PAGE_SIZE]
+        last = likes[-1]
+        next_page = f"{last.liked_at.isoformat()}_{last.like_id}"
+
+    return render_template("/users/likes.html", user=user, likes=likes,
+                           next_page=next_page)
+
+@app.route('/notifications')
+def show_notifications():
+    """Show the logged-in user's notifications, newest first; the first
+    page marks them all read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    before = request.args.get('before', '')
+    result = notifications.page(g.user.id, before)
+    if result is None:
+        abort(400)
+    rows, next_page = result
+
+    seen_at = g.user.notifications_seen_at
+    if not before:
+        notifications.mark_seen(g.user)
+        db.session.commit()
+
+    return render_template("notifications.html", notifications=rows,
+                           seen_at=seen_at, next_page=next_page)
+
+@app.route('/users/export')
+def export_user():
+    """Download all of the logged-in user's data, streamed.
+
+    Takes a 'format' param: 'ndjson' (default) or 'csv'.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export.CONTENT_TYPES:
+        abort(400)
+
+    filename = f"warbler-{g.user.username}.{fmt}"
+    return Response(
+        stream_with_context(export.export_chunks(g.user.id, fmt)),
+        mimetype=export.CONTENT_TYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 
 @app.route('/users/delete', methods=["POST"])
 def delete_user():
@@ -279,8 +763,13 @@ def delete_user():
 
     do_logout()
 
+    archive.forget_user(g.user.id)
+    if sharding.enabled():
+        sharding.forget_user(g.user.id)
     db.session.delete(g.user)
     db.session.commit()
+    availability.user_deleted(g.user)
+    graph.user_deleted(g.user.id)
 
     return redirect("/signup")
 
@@ -302,20 +791,52 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        if sharding.enabled():
+            msg = sharding.add_message(g.user, form.text.data)
+        else:
+            msg = Message(text=form.text.data)
+            g.user.messages.append(msg)
+            db.session.flush()
+            search.index_message(msg)
+            db.session.commit()
+            timeline.message_added(msg)
+        live.message_added(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Full-text search of messages.
+
+    Takes a 'q' param to search for and an optional 'cursor' param
+    (from the previous page's "more" link) to page through results.
+    """
+
+    q = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor')
+
+    messages, next_cursor = [], None
+    if q:
+        messages, next_cursor = search.search_messages(q, cursor=cursor)
+
+    return render_template('messages/search.html',
+                           q=q, messages=messages, next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message, looking in the archive if it's not a recent one."""
 
-    msg = Message.query.get(message_id)
+    if sharding.enabled():
+        msg = sharding.find_message(message_id)
+    else:
+        msg = (Message.query.get(message_id)
+               or archive.find_message(message_id))
+    if msg is None:
+        abort(404)
     return render_template('messages/show.html', message=msg)
 
 
@@ -327,13 +848,185 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    if sharding.enabled():
+        msg = sharding.find_message(message_id)
+        if msg is None:
+            abort(404)
+        sharding.delete_message(msg)
+        notifications.message_deleted(msg)
+        db.session.commit()
+        return redirect(f"/users/{g.user.id}")
+
+    msg = Message.query.get_or_404(message_id)
+    search.unindex_message(msg)
+    notifications.message_deleted(msg)
     db.session.delete(msg)
     db.session.commit()
+    timeline.message_deleted(msg)
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# CLI commands
+
+
+@app.cli.command('reindex-messages')
+@click.option('--batch-size', default=search.REINDEX_BATCH_SIZE,
+              help="Messages to index per batch.")
+def reindex_messages_command(batch_size):
+    """Rebuild the message full-text search index."""
+
+    for done in search.reindex_messages(batch_size=batch_size):
+        click.echo(f"indexed {done} messages")
+
+
+@app.cli.command('export-user')
+@click.argument('user_id', type=int)
+@click.option('--format', 'fmt', type=click.Choice(list(export.CONTENT_TYPES)),
+              default='ndjson')
+@click.option('--output', type=click.File('wb'), default='-',
+              help="File to write to (default: stdout).")
+def export_user_command(user_id, fmt, output):
+    """Export all of a user's data."""
+
+    for chunk in export.export_chunks(user_id, fmt):
+        output.write(chunk)
+
+
+@app.cli.command('archive-messages')
+@click.option('--keep-months', default=ARCHIVE_AFTER_MONTHS,
+              help="Whole months of messages to keep in the hot table.")
+@click.option('--chunk-size', default=archive.CHUNK_SIZE,
+              help="Messages per compressed archive chunk.")
+def archive_messages_command(keep_months, chunk_size):
+    """Move old messages to the compressed archive, a month at a time."""
+
+    # chunks archived before the per-user index existed
+    indexed = archive.index_unindexed()
+    if indexed:
+        click.echo(f"indexed {indexed} archive chunks")
+
+    before = archive.cutoff(keep_months)
+    for month, count in archive.archive_before(before, chunk_size):
+        click.echo(f"archived {count} messages from {month:%Y-%m}")
+
+
+@app.cli.command('rebalance-shards')
+@click.option('--drain', type=int, multiple=True,
+              help="Shard to move every bucket off (repeatable).")
+@click.option('--settle', type=float, default=None,
+              help="Seconds to wait after switching a bucket before the "
+                   "final copy (default: SHARD_MAP_REFRESH + 1).")
+@click.option('--dry-run', is_flag=True, help="Only show the moves.")
+def rebalance_shards_command(drain, settle, dry_run):
+    """Spread message buckets evenly over SHARD_DATABASE_URLS."""
+
+    if not sharding.enabled():
+        raise click.ClickException("SHARD_DATABASE_URLS isn't set")
+
+    for bucket, source, target, moved in sharding.rebalance(
+            app.extensions['shards'], drain, settle, dry_run):
+        if moved is None:
+            click.echo(f"bucket {bucket}: shard {source} -> {target}")
+        else:
+            click.echo(f"bucket {bucket}: shard {source} -> {target}, "
+                       f"{moved} messages")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint static files and write static/manifest.json."""
+
+    manifest = assets.write_manifest(app.static_folder)
+    click.echo(f"fingerprinted {len(manifest)} static files")
+
+
+@app.cli.command('slow-queries')
+@click.option('--top', default=10, help="Statements to show.")
+@click.option('--sort', type=click.Choice(['total', 'count', 'max']),
+              default='total', help="Rank by total time, count or worst time.")
+@click.option('--plans', is_flag=True, help="Show each statement's plan.")
+def slow_queries_command(top, sort, plans):
+    """Summarize the slow query log, worst statements first."""
+
+    entries = slowlog.read_entries(app.config['SLOW_QUERY_LOG'])
+    for group in slowlog.summarize(entries, sort)[:top]:
+        endpoints = ", ".join(f"{endpoint} x{count}" for endpoint, count
+                              in group['endpoints'].most_common(3))
+        click.echo(f"{group['count']:6} calls  {group['total_ms']:10.1f} ms "
+                   f"total  {group['max_ms']:8.1f} ms max  [{endpoints}]")
+        click.echo(f"    {group['statement']}")
+        for frame in group['stack'][:1]:
+            click.echo(f"    at {frame}")
+        if plans and group['plan']:
+            for line in group['plan']:
+                click.echo(f"      {line}")
+        click.echo()
+
+
+@app.cli.command('replay-traffic')
+@click.argument('log', type=click.Path(exists=True, dir_okay=False))
+@click.option('--target', required=True,
+              help="Base URL to replay against, e.g. http://staging:8000.")
+@click.option('--speed', default='1',
+              help="Multiple of the captured pace (1, 10, ...) or 'max'.")
+@click.option('--concurrency', type=int, default=None,
+              help="Most requests outstanding (default: the capture's peak "
+                   "times the speed).")
+@click.option('--users', type=int, default=300,
+              help="Replay senders as the target's users 1..N.")
+@click.option('--output', type=click.File('w'), default=None,
+              help="Write the results here, for compare-replays.")
+def replay_traffic_command(log, target, speed, concurrency, users, output):
+    """Re-issue captured requests against another instance and show their
+    latency next to the captured one."""
+
+    speed = None if speed == 'max' else float(speed)
+    entries = capture.read_entries(log)
+    send = replay.HTTPSender(target, replay.Sessions(app, CURR_USER_KEY,
+                                                     users))
+    results = replay.replay(entries, send, speed, concurrency)
+    if output is not None:
+        replay.save(results, output, target=target, log=log,
+                    speed=speed or 'max')
+
+    click.echo(f"replayed {len(results)} requests")
+    print_replay_comparison(replay.summarize(results, 'original_ms'),
+                            replay.summarize(results), 'captured', 'replay')
+
+
+@app.cli.command('compare-replays')
+@click.argument('before', type=click.File())
+@click.argument('after', type=click.File())
+def compare_replays_command(before, after):
+    """Latency per route of two replay-traffic results, e.g. of two
+    builds."""
+
+    print_replay_comparison(replay.summarize(replay.load(before)),
+                            replay.summarize(replay.load(after)),
+                            'before', 'after')
+
+
+def print_replay_comparison(before, after, before_name, after_name):
+    click.echo(f"{'route':40} {'count':>6} {'errors':>9}  "
+               f"{'p50 ' + before_name:>12} {'p50 ' + after_name:>12} "
+               f"{'delta':>8}  {'p95 ' + before_name:>12} "
+               f"{'p95 ' + after_name:>12} {'delta':>8}")
+    for (name, count, errors_before, errors_after, p50_before, p50_after,
+         p95_before, p95_after) in replay.compare(before, after):
+        click.echo(
+            f"{name[:40]:40} {count:6} {errors_before:4}/{errors_after:<4}  "
+            f"{format_ms(p50_before):>12} {format_ms(p50_after):>12} "
+            f"{replay.delta(p50_before, p50_after):>8}  "
+            f"{format_ms(p95_before):>12} {format_ms(p95_after):>12} "
+            f"{replay.delta(p95_before, p95_after):>8}")
+
+
+def format_ms(value):
+    return '-' if value is None else f"{value:.1f} ms"
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -347,20 +1040,41 @@ def homepage():
     """
 
     if g.user:
-        following_self_ids = [f.id for f in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_self_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        like_msg_ids = [msg.id for msg in g.user.likes]
-        return render_template('home.html', messages=messages, likes=like_msg_ids)
+        if sharding.enabled():
+            following_self_ids = Follows.following_ids(g.user.id) + [g.user.id]
+            messages = sharding.home_messages(following_self_ids, 100)
+            likes, like_counts = sharding.page_state(g.user.id, messages)
+            return render_template('home.html', messages=messages,
+                                   likes=likes, like_counts=like_counts)
+        elif app.config['TIMELINE_ENGINE'] == 'cache':
+            following_self_ids = Follows.following_ids(g.user.id) + [g.user.id]
+            messages = timeline.home_messages(following_self_ids, 100)
+        else:
+            following_self_ids = [f.id for f in g.user.following] + [g.user.id]
+            messages = (Message
+                        .query
+                        .filter(Message.user_id.in_(following_self_ids))
+                        .order_by(Message.timestamp.desc())
+                        .limit(100)
+                        .all())
+        message_ids = [msg.id for msg in messages]
+        likes, like_counts = likebuffer.overlay(
+            g.user.id, message_ids, *Likes.page_state(g.user.id, message_ids))
+        return render_template('home.html', messages=messages, likes=likes,
+                               like_counts=like_counts)
 
     else:
         return render_template('home-anon.html')
 
 
+##############################################################################
+# Async serving mode (see async_views.py)
+
+if os.environ.get('WARBLER_ASYNC') == '1':
+    import async_views
+    async_views.init_app(app)
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -370,7 +1084,14 @@ def homepage():
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Static files and thumbnails keep their own caching headers
+    (see assets.py and thumbnails.py).
+    """
+
+    if request.endpoint in ('static', 'thumbnail'):
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
@@ -0,0 +1,253 @@
+"""Cold storage for old messages.
+
+Timelines and profiles only read an author's newest messages, but the
+`messages` table and its indexes grow forever. `flask archive-messages`
+(run it from cron) moves every message from before the last
+--keep-months whole calendar months out of `messages` and into
+`message_archives`, a month at a time: one row per chunk of up to
+CHUNK_SIZE messages, holding them as zlib-compressed JSON along with the
+chunk's id range. The hot table and its indexes then only hold recent
+months. `message_archive_users` lists the chunks holding each user's
+messages and likes, so exports and account deletion only read those.
+
+Archived messages can still be opened by id (`messages_show` falls back to
+`find_message`) and are included in account exports, as are their likes
+(without when they were made). They no longer appear in timelines,
+profiles or search; their likes are archived with them as liker ids.
+"""
+
+import json
+import zlib
+from datetime import date, datetime
+
+from sqlalchemy import delete, func, select
+
+from models import db, Likes, Message, MessageArchive, MessageArchiveUser, User
+import search
+
+CHUNK_SIZE = 1000
+
+
+def add_months(day, months):
+    """The first of the month `months` months after `day`'s month."""
+
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def cutoff(keep_months, today=None):
+    """Start of the oldest month to keep: messages before it are archived."""
+
+    today = today or datetime.utcnow().date()
+    return datetime.combine(add_months(today, -keep_months),
+                            datetime.min.time())
+
+
+def pack(records):
+    return zlib.compress(json.dumps(records).encode('UTF-8'), 9)
+
+
+def unpack(data):
+    """The records of an archive chunk's data: [id, user_id, timestamp,
+    text, liker ids]."""
+
+    return json.loads(zlib.decompress(data))
+
+
+def archive_chunk(start, end, after_id, chunk_size):
+    """Archive up to `chunk_size` messages from [start, end) with ids above
+    `after_id`, in one transaction. Returns the ids archived."""
+
+    rows = db.session.execute(
+        select(Message.id, Message.user_id, Message.timestamp, Message.text)
+        .where(Message.timestamp >= start, Message.timestamp < end,
+               Message.id > after_id)
+        .order_by(Message.id)
+        .limit(chunk_size)).all()
+    if not rows:
+        return []
+
+    ids = [row.id for row in rows]
+    likers = {}
+    for message_id, user_id in db.session.execute(
+            select(Likes.message_id, Likes.user_id)
+            .where(Likes.message_id.in_(ids))
+            .order_by(Likes.id)):
+        likers.setdefault(message_id, []).append(user_id)
+
+    records = [[row.id, row.user_id, row.timestamp.isoformat(), row.text,
+                likers.get(row.id, [])] for row in rows]
+    chunk = MessageArchive(month=start.date(), first_id=ids[0],
+                           last_id=ids[-1], count=len(ids),
+                           data=pack(records))
+    db.session.add(chunk)
+    db.session.flush()
+    index_chunk(chunk.id, records)
+
+    db.session.execute(delete(Likes).where(Likes.message_id.in_(ids)))
+    search.unindex_messages(ids)
+    db.session.execute(delete(Message).where(Message.id.in_(ids)))
+    db.session.commit()
+    return ids
+
+
+def archive_before(before, chunk_size=CHUNK_SIZE):
+    """Archive every message older than `before`, oldest month first.
+
+    Each chunk is committed on its own, so the job can be stopped and
+    rerun. Yields (month, messages archived) per month.
+    """
+
+    while True:
+        oldest = db.session.scalar(select(func.min(Message.timestamp))
+                                   .where(Message.timestamp < before))
+        if oldest is None:
+            return
+
+        start = datetime(oldest.year, oldest.month, 1)
+        end = min(datetime.combine(add_months(start, 1), datetime.min.time()),
+                  before)
+
+        archived = 0
+        last_id = 0
+        while True:
+            ids = archive_chunk(start, end, last_id, chunk_size)
+            if not ids:
+                break
+            archived += len(ids)
+            last_id = ids[-1]
+
+        yield start.date(), archived
+
+
+def index_chunk(archive_id, records):
+    """Add the message_archive_users rows of a chunk holding `records`."""
+
+    authors = {record[1] for record in records}
+    likers = {liker for record in records for liker in record[4]}
+    db.session.add_all(
+        [MessageArchiveUser(user_id=user_id, archive_id=archive_id,
+                            authored=user_id in authors)
+         for user_id in authors | likers])
+
+
+def index_unindexed(batch_size=100):
+    """Index the chunks archived before message_archive_users existed, a
+    batch per transaction. Returns how many chunks were indexed."""
+
+    indexed = 0
+    while True:
+        chunks = db.session.execute(
+            select(MessageArchive.id, MessageArchive.data)
+            .where(~select(MessageArchiveUser.archive_id)
+                   .where(MessageArchiveUser.archive_id == MessageArchive.id)
+                   .exists())
+            .order_by(MessageArchive.id)
+            .limit(batch_size)).all()
+        if not chunks:
+            return indexed
+        for archive_id, data in chunks:
+            index_chunk(archive_id, unpack(data))
+        db.session.commit()
+        indexed += len(chunks)
+
+
+def chunks_of(user_id, authored=False):
+    """Statement for the chunks holding `user_id`'s messages or likes (just
+    messages if `authored`), in id order."""
+
+    stmt = (select(MessageArchive)
+            .join(MessageArchiveUser,
+                  MessageArchiveUser.archive_id == MessageArchive.id)
+            .where(MessageArchiveUser.user_id == user_id)
+            .order_by(MessageArchive.id))
+    if authored:
+        stmt = stmt.where(MessageArchiveUser.authored)
+    return stmt
+
+
+def to_message(record, user=None):
+    """A transient (unsaved) Message for an archived record, with its user
+    (`user`, or looked up), or None if the user is gone."""
+
+    message_id, user_id, timestamp, text, _ = record
+    if user is None:
+        user = db.session.get(User, user_id)
+    if user is None:
+        return None
+
+    msg = Message(id=message_id, user_id=user_id, text=text,
+                  timestamp=datetime.fromisoformat(timestamp))
+    msg.user = user
+    return msg
+
+
+def find_message(message_id):
+    """Archived message `message_id` as a transient Message, or None."""
+
+    record = find_record(db.session.scalars(chunks_holding(message_id)),
+                         message_id)
+    return to_message(record) if record is not None else None
+
+
+def chunks_holding(message_id):
+    """Statement for the data of the chunks whose id range covers
+    `message_id`."""
+
+    return (select(MessageArchive.data)
+            .where(MessageArchive.first_id <= message_id,
+                   MessageArchive.last_id >= message_id)
+            .order_by(MessageArchive.first_id.desc()))
+
+
+def find_record(chunks, message_id):
+    """The record of `message_id` in the chunk data `chunks`, or None."""
+
+    for data in chunks:
+        for record in unpack(data):
+            if record[0] == message_id:
+                return record
+    return None
+
+
+def user_records(user_id):
+    """(id, timestamp, text) of every archived message by `user_id`."""
+
+    for chunk in db.session.scalars(chunks_of(user_id, authored=True)):
+        for message_id, author_id, timestamp, text, _ in unpack(chunk.data):
+            if author_id == user_id:
+                yield message_id, timestamp, text
+
+
+def user_likes(user_id):
+    """(message id, author id, text) of every archived message `user_id`
+    liked. When they liked it isn't archived."""
+
+    for chunk in db.session.scalars(chunks_of(user_id)):
+        for message_id, author_id, _, text, likers in unpack(chunk.data):
+            if user_id in likers:
+                yield message_id, author_id, text
+
+
+def forget_user(user_id):
+    """Drop a deleted user's archived messages and likes, rewriting the
+    chunks that hold them; the caller commits."""
+
+    for chunk in db.session.scalars(chunks_of(user_id)).all():
+        records = unpack(chunk.data)
+        kept = [[message_id, author_id, timestamp, text,
+                 [liker for liker in likers if liker != user_id]]
+                for message_id, author_id, timestamp, text, likers in records
+                if author_id != user_id]
+
+        if kept:
+            chunk.data = pack(kept)
+            chunk.count = len(kept)
+        else:
+            db.session.execute(delete(MessageArchiveUser)
+                               .where(MessageArchiveUser.archive_id
+                                      == chunk.id))
+            db.session.delete(chunk)
+
+    db.session.execute(delete(MessageArchiveUser)
+                       .where(MessageArchiveUser.user_id == user_id))
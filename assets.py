@@ -0,0 +1,132 @@
+"""Content-fingerprinted static assets.
+
+At startup (or ahead of time with `flask build-assets`) every file under the
+static folder is hashed, and templates link to it by a fingerprinted name:
+
+    {{ asset_url('stylesheets/style.css') }}
+        -> /static/stylesheets/style.3f2a9c1b7d4e.css
+
+Since a fingerprinted URL changes whenever the file does, it's served with
+a year-long `immutable` Cache-Control and browsers never revalidate it.
+Unfingerprinted /static/ URLs still work, with Flask's normal caching.
+"""
+
+import hashlib
+import json
+import os
+
+from flask import current_app, send_from_directory
+
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 12
+ONE_YEAR = 365 * 24 * 60 * 60
+
+
+def fingerprint(path):
+    """Short content hash of the file at `path`."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def fingerprinted_name(filename, file_hash):
+    """'images/logo.png' -> 'images/logo.<hash>.png'."""
+
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{file_hash}{ext}"
+
+
+def build_manifest(static_folder):
+    """Map each static file's name (relative, '/'-separated) to its
+    fingerprinted name."""
+
+    manifest = {}
+    if not static_folder or not os.path.isdir(static_folder):
+        return manifest
+
+    for dirpath, _, filenames in os.walk(static_folder):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            filename = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            if filename == MANIFEST_NAME:
+                continue
+            manifest[filename] = fingerprinted_name(filename, fingerprint(path))
+
+    return manifest
+
+
+def write_manifest(static_folder):
+    """Build the manifest and save it next to the assets; returns it."""
+
+    manifest = build_manifest(static_folder)
+    with open(os.path.join(static_folder, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    """A prebuilt manifest if `flask build-assets` was run, else build one."""
+
+    path = os.path.join(static_folder or '', MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return build_manifest(static_folder)
+
+
+def asset_url(filename):
+    """URL for a static asset, fingerprinted if we know the file.
+
+    Takes a name relative to the static folder ('images/logo.png') or a
+    /static/ URL ('/static/images/logo.png'); any other URL (e.g. a remote
+    avatar) is returned unchanged.
+    """
+
+    if not filename:
+        return filename
+
+    static_url = current_app.static_url_path + '/'
+    if filename.startswith(static_url):
+        filename = filename[len(static_url):]
+    elif '://' in filename or filename.startswith('/'):
+        return filename
+
+    manifest = current_app.extensions['assets']['manifest']
+    return static_url + manifest.get(filename, filename)
+
+
+def serve_static(filename):
+    """Flask's static view, plus long-lived caching for fingerprinted names."""
+
+    original = current_app.extensions['assets']['originals'].get(filename)
+    if original is None:
+        return current_app.send_static_file(filename)
+
+    response = send_from_directory(current_app.static_folder, original,
+                                   max_age=ONE_YEAR)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def refresh(app):
+    """(Re)load the manifest for `app`'s static folder."""
+
+    manifest = load_manifest(app.static_folder)
+    app.extensions['assets'] = {
+        'manifest': manifest,
+        'originals': {hashed: name for name, hashed in manifest.items()},
+    }
+
+
+def init_app(app):
+    """Build the manifest and hook fingerprinting into `app`."""
+
+    refresh(app)
+
+    app.view_functions['static'] = serve_static
+    app.add_template_global(asset_url)
+    app.add_template_filter(asset_url)
@@ -0,0 +1,237 @@
+"""Async serving mode for the read-heavy views.
+
+With WARBLER_ASYNC=1, `homepage`, `users_show`, `messages_show` and
+`list_users` are replaced by the `async def` versions below, which query
+through SQLAlchemy's async engine (asyncpg / aiosqlite) and run
+independent queries concurrently.
+
+Flask normally runs each async view in a fresh event loop, which would
+defeat connection pooling. Instead every worker process gets one
+long-lived event loop in a background thread; request threads (run
+gunicorn with `--worker-class gthread --threads N`) hand their view
+coroutine to that loop and wait, so N requests share one loop and one
+async connection pool while their DB round trips are in flight.
+"""
+
+import asyncio
+import os
+import threading
+from functools import wraps
+
+from flask import g, render_template, request, abort
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import (async_sessionmaker, create_async_engine,
+                                    AsyncSession)
+from sqlalchemy.orm import joinedload
+
+from models import db, set_sqlite_pragmas, Follows, Likes, Message, User
+import archive
+import likebuffer
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_url(url):
+    """Turn a sync database URL into the equivalent async-driver URL."""
+
+    scheme, sep, rest = url.partition('://')
+    scheme = ASYNC_DRIVERS.get(scheme.split('+')[0], scheme)
+    return scheme + sep + rest
+
+
+class LoopThread:
+    """One event loop per process, running in a daemon thread."""
+
+    def __init__(self, database_url):
+        self.database_url = database_url
+        self.lock = threading.Lock()
+        self.loop = None
+        self.pid = None
+        self.Session = None
+
+    def start(self):
+        """Start (or, after a fork, restart) the loop and async engine."""
+
+        with self.lock:
+            if self.loop is not None and self.pid == os.getpid():
+                return
+
+            self.loop = asyncio.new_event_loop()
+            self.pid = os.getpid()
+            threading.Thread(target=self.loop.run_forever, daemon=True,
+                             name='warbler-async-loop').start()
+
+            engine = create_async_engine(async_url(self.database_url))
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine.sync_engine, 'connect',
+                             set_sqlite_pragmas)
+            self.Session = async_sessionmaker(engine, expire_on_commit=False,
+                                              class_=AsyncSession)
+
+    def run(self, coro):
+        """Run `coro` on the loop; block this thread until it's done."""
+
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def async_to_sync(self, func):
+        """Replacement for Flask.async_to_sync that uses our shared loop."""
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.run(func(*args, **kwargs))
+
+        return wrapper
+
+
+runner = None
+
+
+async def fetch(stmt, unique=False):
+    """Run `stmt` in its own session, so callers can gather() several."""
+
+    async with runner.Session() as session:
+        result = await session.execute(stmt)
+        if unique:
+            result = result.unique()
+        return result.scalars().all()
+
+
+async def fetch_rows(stmt):
+    """Like fetch(), but returning whole rows rather than scalars."""
+
+    async with runner.Session() as session:
+        return (await session.execute(stmt)).all()
+
+
+async def like_state(messages):
+    """Likes.page_state, for the async views."""
+
+    if not messages:
+        return set(), {}
+    viewer_id = g.user.id if g.user else None
+    message_ids = [msg.id for msg in messages]
+    return likebuffer.overlay(viewer_id, message_ids, *Likes.split_state(
+        await fetch_rows(Likes.state_query(viewer_id, message_ids))))
+
+
+async def fetch_one(stmt):
+    """Like fetch(), but for a single row (or None)."""
+
+    rows = await fetch(stmt, unique=True)
+    return rows[0] if rows else None
+
+
+##############################################################################
+# Views
+
+
+async def list_users():
+    """Page with listing of users.
+
+    Can take a 'q' param in querystring to search by that username.
+    """
+
+    search = request.args.get('q')
+
+    stmt = select(User)
+    if search:
+        stmt = stmt.where(User.username.like(f"%{search}%"))
+
+    users = await fetch(stmt)
+    return render_template('users/index.html', users=users)
+
+
+async def users_show(user_id):
+    """Show user profile."""
+
+    # just the user: the template's counts come from the count helpers
+    user, messages = await asyncio.gather(
+        fetch_one(select(User).where(User.id == user_id)),
+        fetch(select(Message)
+              .where(Message.user_id == user_id)
+              .options(joinedload(Message.user))
+              .order_by(Message.timestamp.desc())
+              .limit(100)),
+    )
+
+    if user is None:
+        abort(404)
+
+    likes, like_counts = await like_state(messages)
+    return render_template('users/show.html', user=user, messages=messages,
+                           likes=likes, like_counts=like_counts)
+
+
+async def find_archived(message_id):
+    """archive.find_message, for the async views."""
+
+    chunks = await fetch(archive.chunks_holding(message_id))
+    record = archive.find_record(chunks, message_id)
+    if record is None:
+        return None
+    user = await fetch_one(select(User).where(User.id == record[1]))
+    return archive.to_message(record, user) if user is not None else None
+
+
+async def messages_show(message_id):
+    """Show a message, looking in the archive if it's not a recent one."""
+
+    msg = (await fetch_one(select(Message)
+                           .where(Message.id == message_id)
+                           .options(joinedload(Message.user)))
+           or await find_archived(message_id))
+    if msg is None:
+        abort(404)
+    return render_template('messages/show.html', message=msg)
+
+
+async def homepage():
+    """Show homepage:
+
+    - anon users: no messages
+    - logged in: 100 most recent messages of followed_users
+    """
+
+    if not g.user:
+        return render_template('home-anon.html')
+
+    following_ids = (select(Follows.user_being_followed_id)
+                     .where(Follows.user_following_id == g.user.id))
+
+    messages = await fetch(select(Message)
+                           .where((Message.user_id.in_(following_ids))
+                                  | (Message.user_id == g.user.id))
+                           .options(joinedload(Message.user))
+                           .order_by(Message.timestamp.desc())
+                           .limit(100), unique=True)
+
+    likes, like_counts = await like_state(messages)
+    return render_template('home.html', messages=messages, likes=likes,
+                           like_counts=like_counts)
+
+
+ASYNC_VIEWS = {
+    'homepage': homepage,
+    'users_show': users_show,
+    'messages_show': messages_show,
+    'list_users': list_users,
+}
+
+
+def init_app(app):
+    """Switch `app` to the async versions of the read-heavy views."""
+
+    global runner
+    with app.app_context():
+        # the engine's URL, since Flask-SQLAlchemy resolves relative
+        # SQLite paths against the instance folder
+        url = db.engine.url.render_as_string(hide_password=False)
+    runner = LoopThread(url)
+
+    app.async_to_sync = runner.async_to_sync
+    app.view_functions.update(ASYNC_VIEWS)
@@ -0,0 +1,200 @@
+"""Username and email availability, pre-checked with a Bloom filter.
+
+Each worker keeps a Bloom filter of every username and email in use. A
+value that isn't in the filter is certainly free; one that is might be
+taken, and is confirmed with an indexed lookup. So signup and profile
+edits reject most collisions without a query, and before paying for a
+bcrypt hash, and the /users/available endpoint is cheap.
+
+The filter is built from a streamed scan of users at startup (or on first
+use if the table doesn't exist yet), and kept current by:
+
+- `added`/`changed` from the signup and profile views;
+- picking up users created elsewhere (other workers, scripts) by id, at
+  most every USERNAME_FILTER_REFRESH seconds;
+- a full rebuild once renames and deletes -- which a Bloom filter can't
+  remove, so they linger as false positives -- pile up, or the filter
+  outgrows its capacity.
+
+A value taken moments ago in another worker may still look free here; the
+unique constraints remain the final word.
+"""
+
+import hashlib
+import math
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, User
+
+FIELDS = ('username', 'email')
+MIN_CAPACITY = 100_000
+ERROR_RATE = 0.01
+SCAN_BATCH = 10_000
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter of strings."""
+
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(error_rate)
+                              / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+        # Kirsch-Mitzenmacher: k positions from two 64-bit hashes
+        digest = hashlib.blake2b(value.encode('UTF-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for pos in self.positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self.positions(value))
+
+
+def key(field, value):
+    return f"{field}:{value}"
+
+
+class Availability:
+    """The Bloom filter of taken usernames and emails, with its upkeep."""
+
+    def __init__(self, refresh_interval=5, clock=time.monotonic):
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.max_id = 0
+        self.stale = 0
+        self.refreshed_at = 0
+
+    def add_user(self, bloom, username, email):
+        bloom.add(key('username', username))
+        bloom.add(key('email', email))
+
+    def build(self):
+        """Rebuild the filter from a streamed scan of every user."""
+
+        users = db.session.scalar(select(func.count(User.id)))
+        # room for the user count to double before a rebuild
+        bloom = BloomFilter(max(MIN_CAPACITY, 2 * len(FIELDS) * users))
+        max_id = 0
+
+        result = db.session.execute(
+            select(User.id, User.username, User.email)
+            .execution_options(yield_per=SCAN_BATCH))
+        for partition in result.partitions():
+            for user_id, username, email in partition:
+                self.add_user(bloom, username, email)
+                max_id = max(max_id, user_id)
+
+        self.bloom = bloom
+        self.max_id = max_id
+        self.stale = 0
+        self.refreshed_at = self.clock()
+
+    def refresh(self):
+        """Add users created since the last build or refresh."""
+
+        for user_id, username, email in db.session.execute(
+                select(User.id, User.username, User.email)
+                .where(User.id > self.max_id)
+                .order_by(User.id)):
+            self.add_user(self.bloom, username, email)
+            self.max_id = user_id
+        self.refreshed_at = self.clock()
+
+    def current(self):
+        """The filter, built or refreshed first if due."""
+
+        with self.lock:
+            if (self.bloom is None
+                    or self.bloom.count > self.bloom.capacity
+                    or self.stale > max(1000, self.bloom.count // 10)):
+                self.build()
+            elif self.clock() - self.refreshed_at >= self.refresh_interval:
+                self.refresh()
+            return self.bloom
+
+    def is_taken(self, field, value, exclude_user_id=None):
+        """Is `value` in use as a `field` ('username' or 'email'), by a
+        user other than `exclude_user_id`?"""
+
+        if key(field, value) not in self.current():
+            return False
+
+        query = select(User.id).where(getattr(User, field) == value)
+        if exclude_user_id is not None:
+            query = query.where(User.id != exclude_user_id)
+        return db.session.scalar(query.limit(1)) is not None
+
+    def added(self, user):
+        with self.lock:
+            if self.bloom is not None:
+                self.add_user(self.bloom, user.username, user.email)
+
+    def changed(self, old_username, old_email, user):
+        with self.lock:
+            if self.bloom is not None:
+                self.add_user(self.bloom, user.username, user.email)
+                self.stale += ((old_username != user.username)
+                               + (old_email != user.email))
+
+    def deleted(self, user):
+        with self.lock:
+            self.stale += 2
+
+
+def availability():
+    return current_app.extensions['availability']
+
+
+def is_taken(field, value, exclude_user_id=None):
+    """Is `value` in use as a `field` ('username' or 'email')?"""
+
+    return availability().is_taken(field, value, exclude_user_id)
+
+
+def user_added(user):
+    """Note a newly committed user."""
+
+    availability().added(user)
+
+
+def user_changed(old_username, old_email, user):
+    """Note a committed change to a user's username or email."""
+
+    availability().changed(old_username, old_email, user)
+
+
+def user_deleted(user):
+    """Note a deleted user."""
+
+    availability().deleted(user)
+
+
+def init_app(app):
+    """Build the filter now, so forked workers share it."""
+
+    app.extensions['availability'] = checker = Availability(
+        app.config['USERNAME_FILTER_REFRESH'])
+
+    with app.app_context():
+        try:
+            checker.build()
+        except SQLAlchemyError:
+            # no users table yet; build on first use
+            db.session.rollback()
@@ -0,0 +1,127 @@
+"""Compare concurrent-client throughput of the sync and async serving modes.
+
+Starts gunicorn twice against the database in DATABASE_URL (seed it first
+with seed.py) -- once with sync workers, once with gthread workers and
+WARBLER_ASYNC=1 -- and hammers the read-heavy views with concurrent clients.
+
+    DATABASE_URL=postgresql:///warbler python benchmarks/async_bench.py \\
+        --clients 8 32 128 --workers 4 --threads 32
+"""
+
+import argparse
+import http.client
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+from app import app, CURR_USER_KEY  # noqa: E402
+
+MODES = {
+    'sync': (['--worker-class', 'sync'], {}),
+    'async': (['--worker-class', 'gthread'], {'WARBLER_ASYNC': '1'}),
+}
+
+
+def session_cookie(user_id):
+    """A signed Flask session cookie logging in `user_id`."""
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    return f"session={serializer.dumps({CURR_USER_KEY: user_id})}"
+
+
+def paths(n_users, n_messages):
+    """A random read-heavy request path."""
+
+    return random.choice([
+        '/',
+        '/users',
+        f'/users/{random.randint(1, n_users)}',
+        f'/messages/{random.randint(1, n_messages)}',
+    ])
+
+
+def client(port, cookie, deadline, args, latencies):
+    """Issue requests back to back until `deadline`."""
+
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        conn.request('GET', paths(args.users, args.messages),
+                     headers={'Cookie': cookie})
+        conn.getresponse().read()
+        latencies.append(time.perf_counter() - t0)
+
+
+def wait_for(port):
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("gunicorn did not start")
+
+
+def run_mode(mode, args):
+    worker_args, env = MODES[mode]
+    cmd = ['gunicorn', '--workers', str(args.workers),
+           '--threads', str(args.threads), '--bind', f'127.0.0.1:{args.port}',
+           *worker_args, 'app:app']
+    server = subprocess.Popen(cmd, cwd=ROOT, env={**os.environ, **env},
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        wait_for(args.port)
+        cookie = session_cookie(args.login_user)
+
+        for n_clients in args.clients:
+            latencies = []
+            deadline = time.perf_counter() + args.seconds
+            threads = [threading.Thread(target=client,
+                                        args=(args.port, cookie, deadline,
+                                              args, latencies))
+                       for _ in range(n_clients)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            latencies.sort()
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000
+            print(f"{mode:5} {n_clients:4} clients  "
+                  f"{len(latencies) / args.seconds:8.1f} req/s  "
+                  f"p50 {p50:7.1f} ms  p99 {p99:7.1f} ms")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, nargs='+', default=[8, 32, 128])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=32,
+                        help="threads per gthread worker (async mode)")
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--login-user', type=int, default=1)
+    parser.add_argument('--modes', nargs='+', default=list(MODES))
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        run_mode(mode, args)
+
+
+if __name__ == '__main__':
+    main()
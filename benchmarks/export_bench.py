@@ -0,0 +1,77 @@
+"""Benchmark streaming account export.
+
+Gives one user N messages (1M by default) in the database named by
+DATABASE_URL, then exports them in each format, reporting throughput and
+the process's peak memory -- which should stay flat as N grows.
+
+    DATABASE_URL=postgresql:///warbler-bench python benchmarks/export_bench.py
+
+Don't point this at a database you care about: it drops all tables.
+"""
+
+import argparse
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import app  # noqa: E402
+from models import db, User, Message  # noqa: E402
+import export  # noqa: E402
+
+
+def fill(n_messages, batch_size):
+    db.drop_all()
+    db.create_all()
+
+    user = User(username="bench", email="bench@example.com", password="x")
+    db.session.add(user)
+    db.session.commit()
+
+    start = datetime(2020, 1, 1)
+    for offset in range(0, n_messages, batch_size):
+        db.session.execute(Message.__table__.insert(), [
+            dict(text=f"benchmark warble number {offset + i}",
+                 timestamp=start + timedelta(seconds=offset + i),
+                 user_id=user.id)
+            for i in range(min(batch_size, n_messages - offset))
+        ])
+        db.session.commit()
+
+    return user.id
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        user_id = fill(args.messages, args.batch_size)
+        db.session.expunge_all()
+        print(f"filled {args.messages} messages; "
+              f"peak RSS {peak_rss_mb():.0f} MB")
+
+        for fmt in export.CONTENT_TYPES:
+            t0 = time.perf_counter()
+            total = 0
+            for chunk in export.export_chunks(user_id, fmt):
+                total += len(chunk)
+            elapsed = time.perf_counter() - t0
+
+            print(f"{fmt:6} {total / 1e6:8.1f} MB in {elapsed:6.2f}s  "
+                  f"{args.messages / elapsed:10.0f} rows/s  "
+                  f"{total / 1e6 / elapsed:6.1f} MB/s  "
+                  f"peak RSS {peak_rss_mb():.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Benchmark the CSR social graph on a synthetic follows graph.
+
+Builds forward and reverse CSR arrays for --users users and --edges random
+follows (no database involved), then times per-call latency of
+is_following, the degree counts, following() and mutuals(), and "people
+you follow who follow X" for an account followed by every user.
+
+    python benchmarks/graph_bench.py --users 1000000 --edges 10000000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import graph  # noqa: E402
+
+
+def per_call_us(fn, ids):
+    t0 = time.perf_counter()
+    for user_id in ids:
+        fn(user_id)
+    return (time.perf_counter() - t0) / len(ids) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--edges', type=int, default=10_000_000)
+    parser.add_argument('--calls', type=int, default=10_000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    followers = rng.integers(2, args.users, args.edges, dtype=np.int32)
+    followed = rng.integers(2, args.users, args.edges, dtype=np.int32)
+
+    # user 1 is a celebrity: everyone follows them
+    everyone = np.arange(2, args.users, dtype=np.int32)
+    followers = np.concatenate([followers, everyone])
+    followed = np.concatenate([followed, np.ones_like(everyone)])
+
+    t0 = time.perf_counter()
+    social = graph.SocialGraph()
+    social.set_arrays(*graph.csr(followers, followed, args.users),
+                      *graph.csr(followed, followers, args.users))
+    print(f"{args.users} users, {args.edges} edges: built in "
+          f"{time.perf_counter() - t0:.2f} s, "
+          f"{social.nbytes() / len(followers):.1f} bytes/edge")
+
+    ids = rng.integers(1, args.users, args.calls).tolist()
+    print(f"is_following     {per_call_us(lambda u: social.is_following(u, u + 1), ids):8.2f} us")
+    print(f"following_count  {per_call_us(social.following_count, ids):8.2f} us")
+    print(f"followers_count  {per_call_us(social.followers_count, ids):8.2f} us")
+    print(f"following        {per_call_us(social.following, ids):8.2f} us")
+    print(f"mutuals          {per_call_us(social.mutuals, ids):8.2f} us")
+    print(f"known followers  {per_call_us(lambda u: social.followers_followed_by(1, u), ids):8.2f} us"
+          f"  (of {social.followers_count(1)} followers)")
+
+
+if __name__ == '__main__':
+    main()
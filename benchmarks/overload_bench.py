@@ -0,0 +1,175 @@
+"""Overload a server with and without admission control.
+
+Starts gunicorn against the database in DATABASE_URL (seed it first with
+seed.py) with more threads per worker than its DB pool has connections,
+once with ADMISSION_ENABLED=0 and once with it on, and drives it past
+capacity with an open-loop load generator: requests arrive at --rate per
+second whether or not earlier ones have finished, like real users do. The mix is mostly cheap reads,
+some expensive reads (the user list, search) and some logged-in writes
+(likes). Reports, per class, how many requests succeeded, were shed (503)
+or failed, and the latency of the successful ones.
+
+    DATABASE_URL=postgresql:///warbler python benchmarks/overload_bench.py \\
+        --rate 400 --seconds 20 --threads 32
+"""
+
+import argparse
+import http.client
+import os
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+from app import app, CURR_USER_KEY  # noqa: E402
+
+# class -> share of requests
+MIX = {'read': 0.7, 'expensive': 0.2, 'write': 0.1}
+
+
+def session_cookie(user_id):
+    """A signed Flask session cookie logging in `user_id`."""
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    return f"session={serializer.dumps({CURR_USER_KEY: user_id})}"
+
+
+def next_request(args):
+    """(class, method, path) of a random request from MIX."""
+
+    kind = random.choices(list(MIX), weights=list(MIX.values()))[0]
+    if kind == 'read':
+        return kind, 'GET', random.choice([
+            f'/users/{random.randint(1, args.users)}',
+            f'/messages/{random.randint(1, args.messages)}',
+        ])
+    if kind == 'expensive':
+        return kind, 'GET', random.choice(['/users', '/messages/search?q=the'])
+    return kind, 'POST', f'/users/add_like/{random.randint(1, args.messages)}'
+
+
+def sender(port, requests, results):
+    """Send requests off the queue until it's closed with None."""
+
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+        kind, method, path, cookie, sent_at = item
+        try:
+            conn.request(method, path, headers={'Cookie': cookie})
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            status = None
+        # latency as the user sees it, time queued in the generator included
+        results.append((kind, status, time.perf_counter() - sent_at))
+
+
+def generate(args, cookies):
+    """Open-loop load: issue requests at args.rate for args.seconds."""
+
+    requests = queue.Queue()
+    results = []
+    threads = [threading.Thread(target=sender,
+                                args=(args.port, requests, results))
+               for _ in range(args.connections)]
+    for thread in threads:
+        thread.start()
+
+    start = time.perf_counter()
+    for i in range(int(args.rate * args.seconds)):
+        delay = start + i / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        kind, method, path = next_request(args)
+        requests.put((kind, method, path, random.choice(cookies),
+                      time.perf_counter()))
+
+    for _ in threads:
+        requests.put(None)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def report(label, results):
+    by_kind = defaultdict(list)
+    for kind, status, latency in results:
+        by_kind[kind].append((status, latency))
+
+    for kind in MIX:
+        statuses = Counter(status for status, _ in by_kind[kind])
+        ok = sorted(latency for status, latency in by_kind[kind]
+                    if status is not None and status < 500)
+        p50 = ok[len(ok) // 2] * 1000 if ok else 0
+        p99 = ok[int(len(ok) * 0.99)] * 1000 if ok else 0
+        failed = sum(count for status, count in statuses.items()
+                     if status is None or (status >= 500 and status != 503))
+        print(f"{label:9} {kind:9} ok {len(ok):6}  shed {statuses[503]:6}  "
+              f"failed {failed:5}  p50 {p50:7.1f} ms  p99 {p99:7.1f} ms")
+
+
+def wait_for(port):
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("gunicorn did not start")
+
+
+def run(enabled, args):
+    env = {**os.environ, 'ADMISSION_ENABLED': '1' if enabled else '0',
+           'RATELIMIT_ENABLED': '0'}
+    cmd = ['gunicorn', '--workers', str(args.workers),
+           '--threads', str(args.threads), '--worker-class', 'gthread',
+           '--bind', f'127.0.0.1:{args.port}', 'app:app']
+    server = subprocess.Popen(cmd, cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        wait_for(args.port)
+        cookies = [session_cookie(user_id)
+                   for user_id in random.sample(range(1, args.users + 1),
+                                                min(50, args.users))]
+        report('admission' if enabled else 'none', generate(args, cookies))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rate', type=float, default=400,
+                        help="requests per second to offer")
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--connections', type=int, default=256,
+                        help="most requests outstanding at once")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=32,
+                        help="threads per worker; the pool holds 15")
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    args = parser.parse_args()
+
+    for enabled in (False, True):
+        run(enabled, args)
+
+
+if __name__ == '__main__':
+    main()
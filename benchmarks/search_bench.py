@@ -0,0 +1,101 @@
+"""Benchmark message full-text search.
+
+Fills the database named by DATABASE_URL with synthetic messages, rebuilds
+the search index, then times first-page and deep-page searches.
+
+    DATABASE_URL=postgresql:///warbler-bench python benchmarks/search_bench.py
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/search_bench.py --messages 100000
+
+Don't point this at a database you care about: it drops all tables.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import app  # noqa: E402
+from models import db, User, Message  # noqa: E402
+import search  # noqa: E402
+
+WORDS = ("warble bird song tree nest feather flight morning evening sky "
+         "river mountain coffee code python flask database index query "
+         "cursor page rank token search fast slow happy quiet loud").split()
+
+QUERIES = ["warble", "bird song", "python flask database", "quiet river"]
+
+
+def fill(n_messages, batch_size):
+    """Insert `n_messages` random messages owned by one user."""
+
+    db.drop_all()
+    db.create_all()
+
+    user = User(username="bench", email="bench@example.com", password="x")
+    db.session.add(user)
+    db.session.commit()
+
+    start = datetime(2020, 1, 1)
+    for offset in range(0, n_messages, batch_size):
+        rows = [
+            dict(text=" ".join(random.choices(WORDS, k=random.randint(3, 20))),
+                 timestamp=start + timedelta(seconds=offset + i),
+                 user_id=user.id)
+            for i in range(min(batch_size, n_messages - offset))
+        ]
+        db.session.execute(Message.__table__.insert(), rows)
+        db.session.commit()
+
+
+def timed(fn, repeat):
+    """Best-of-`repeat` wall time of fn(), in ms."""
+
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=10_000_000)
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    parser.add_argument('--pages', type=int, default=10,
+                        help="how deep to page for the deep-page timing")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        t0 = time.perf_counter()
+        fill(args.messages, args.batch_size)
+        print(f"inserted {args.messages} messages "
+              f"in {time.perf_counter() - t0:.1f}s")
+
+        t0 = time.perf_counter()
+        for _ in search.reindex_messages(batch_size=args.batch_size):
+            pass
+        print(f"reindexed in {time.perf_counter() - t0:.1f}s")
+
+        for q in QUERIES:
+            first = timed(lambda: search.search_messages(q), args.repeat)
+
+            def deep():
+                cursor = None
+                for _ in range(args.pages):
+                    _, cursor = search.search_messages(q, cursor=cursor)
+                    if cursor is None:
+                        break
+
+            deep_ms = timed(deep, args.repeat) / args.pages
+            print(f"{q!r:28} first page {first:8.2f} ms   "
+                  f"avg of {args.pages} pages {deep_ms:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
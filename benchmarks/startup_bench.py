@@ -0,0 +1,96 @@
+"""Measure cold-start-to-first-response time of gunicorn.
+
+Compares the plain dev entry point (app:app) with the production profile
+(wsgi:app with gunicorn.conf.py: no dev imports, preload_app, templates
+precompiled into a shared bytecode cache). For each run it starts
+gunicorn, polls until the first page renders, then times the first hit on
+each of a few template-heavy pages.
+
+    DATABASE_URL=postgresql:///warbler python benchmarks/startup_bench.py
+"""
+
+import argparse
+import http.client
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+PROFILES = {
+    'dev': ['app:app'],
+    'production': ['-c', 'gunicorn.conf.py', 'wsgi:app'],
+}
+
+PAGES = ['/signup', '/users', '/users/1', '/messages/1']
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', path)
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def run(profile, args, cache_dir):
+    env = {**os.environ, 'TEMPLATE_CACHE_DIR': cache_dir,
+           'BIND': f'127.0.0.1:{args.port}',
+           'WEB_CONCURRENCY': str(args.workers)}
+    cmd = ['gunicorn', '--workers', str(args.workers),
+           '--bind', f'127.0.0.1:{args.port}', *PROFILES[profile]]
+
+    t0 = time.perf_counter()
+    server = subprocess.Popen(cmd, cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                get(args.port, '/login')
+                break
+            except OSError:
+                time.sleep(0.005)
+        first = time.perf_counter() - t0
+
+        pages = []
+        for path in PAGES:
+            t1 = time.perf_counter()
+            get(args.port, path)
+            pages.append(time.perf_counter() - t1)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return first, pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5098)
+    parser.add_argument('--keep-cache', action='store_true',
+                        help="don't clear the bytecode cache between runs")
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='warbler-bench-jinja-')
+    try:
+        for profile in PROFILES:
+            for i in range(args.runs):
+                if not args.keep_cache and i == 0:
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+
+                first, pages = run(profile, args, cache_dir)
+                page_ms = "  ".join(f"{path} {t * 1000:6.1f}ms"
+                                    for path, t in zip(PAGES, pages))
+                print(f"{profile:10} run {i}: first response "
+                      f"{first * 1000:7.1f} ms | {page_ms}")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
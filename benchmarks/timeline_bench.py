@@ -0,0 +1,108 @@
+"""Benchmark the cached k-way-merge home timeline against the SQL query.
+
+Creates --authors authors with --per-author messages each in the database
+named by DATABASE_URL, then for each follow count times:
+
+- sql:   the homepage's `Message.user_id IN (...)` query (100 newest)
+- merge: TimelineCache.home_ids with warm caches, plus loading the 100
+         winning messages by id (what homepage does in 'cache' mode)
+- cold:  the same with empty caches (first load of every author)
+
+    DATABASE_URL=postgresql:///warbler-bench python benchmarks/timeline_bench.py
+
+Don't point this at a database you care about: it drops all tables.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import app  # noqa: E402
+from models import db, User, Message  # noqa: E402
+import timeline  # noqa: E402
+
+
+def fill(n_authors, per_author, batch_size=10_000):
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(User.__table__.insert(), [
+        dict(id=i, username=f"author{i}", email=f"a{i}@example.com",
+             password="x")
+        for i in range(1, n_authors + 1)
+    ])
+
+    start = datetime(2020, 1, 1)
+    rows = []
+    for author in range(1, n_authors + 1):
+        for _ in range(per_author):
+            rows.append(dict(text="benchmark warble", user_id=author,
+                             timestamp=start + timedelta(
+                                 seconds=random.randint(0, 10**8))))
+            if len(rows) >= batch_size:
+                db.session.execute(Message.__table__.insert(), rows)
+                rows = []
+    if rows:
+        db.session.execute(Message.__table__.insert(), rows)
+    db.session.commit()
+
+
+def best_ms(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--authors', type=int, default=5000)
+    parser.add_argument('--per-author', type=int, default=200)
+    parser.add_argument('--follows', type=int, nargs='+',
+                        default=[10, 100, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        fill(args.authors, args.per_author)
+        print(f"{args.authors} authors x {args.per_author} messages")
+
+        app.extensions['timeline'] = cache = timeline.TimelineCache()
+
+        for n_follows in args.follows:
+            author_ids = random.sample(range(1, args.authors + 1),
+                                       min(n_follows, args.authors))
+
+            def sql():
+                (Message.query
+                 .filter(Message.user_id.in_(author_ids))
+                 .order_by(Message.timestamp.desc())
+                 .limit(100)
+                 .all())
+
+            def merge():
+                timeline.home_messages(author_ids, 100)
+
+            def cold():
+                cache.authors.clear()
+                timeline.home_messages(author_ids, 100)
+
+            sql_ms = best_ms(sql, args.repeat)
+            cold_ms = best_ms(cold, args.repeat)
+            merge()
+            merge_ms = best_ms(merge, args.repeat)
+            db.session.expunge_all()
+
+            print(f"follows {n_follows:6}: sql {sql_ms:8.2f} ms   "
+                  f"merge {merge_ms:8.2f} ms   cold {cold_ms:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
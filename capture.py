@@ -0,0 +1,158 @@
+"""Traffic capture, for replaying real request mixes (see replay.py).
+
+With CAPTURE_LOG set, every request (but static files and /metrics) is
+appended to that file as one JSON array per line, fields in FIELDS order:
+
+- when it started (Unix time) and how long it took, in milliseconds
+- its status, method, endpoint and URL rule ("/users/<int:user_id>")
+- the rule's arguments
+- its query string and form fields, as {name: length of value} -- never
+  the values (search text, emails being checked), but for the KEEP_ARGS
+  that only page or pick a view
+- who sent it: a pseudonym for the logged-in user, an HMAC of their id
+  keyed with CAPTURE_KEY (by default SECRET_KEY), or for anonymous
+  requests of the client's address and user agent
+
+Lines are written with a single O_APPEND write, so every worker can share
+one log. CAPTURE_SAMPLE_RATE (0..1) keeps that share of the senders, with
+all of their requests, so sampled logs still replay as whole sessions.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from flask import current_app, g, request, session
+
+FIELDS = ('time', 'duration_ms', 'status', 'method', 'endpoint', 'rule',
+          'view_args', 'args', 'form', 'who')
+
+SKIP_ENDPOINTS = {'static', 'metrics'}
+SKIP_ARGS = {'__profile'}
+KEEP_ARGS = {'before', 'cursor', 'filter', 'format', 'page'}
+
+
+class CaptureLog:
+    """Appends captured requests to a log file shared by workers."""
+
+    def __init__(self, path, key, user_key, sample_rate=1.0,
+                 clock=time.time):
+        self.path = path
+        self.key = key.encode() if isinstance(key, str) else key
+        self.user_key = user_key
+        self.sample_rate = sample_rate
+        self.clock = clock
+        self.fd = None
+        self.pid = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def pseudonym(self, kind, identity):
+        digest = hmac.new(self.key, f"{kind}:{identity}".encode(),
+                          hashlib.sha256).hexdigest()
+        return kind[0] + digest[:15]
+
+    def who(self):
+        """Pseudonym of the sender of the current request."""
+
+        if self.user_key in session:
+            return self.pseudonym('user', session[self.user_key])
+        return self.pseudonym('anonymous', "{} {}".format(
+            request.remote_addr, request.user_agent.string))
+
+    def sampled(self, who):
+        if self.sample_rate >= 1:
+            return True
+        # the same senders are kept by every worker
+        return int(who[1:9], 16) / 0x100000000 < self.sample_rate
+
+    def before_request(self):
+        g.pop('capture_who', None)
+        if request.endpoint in SKIP_ENDPOINTS:
+            return
+        # who sent it as the request arrived, not after logging in or out
+        who = self.who()
+        if self.sampled(who):
+            g.capture_who = who
+            g.capture_start = self.clock()
+            g.capture_timer = time.perf_counter()
+
+    def after_request(self, response):
+        if 'capture_who' not in g or request.url_rule is None:
+            return response
+
+        self.write([
+            round(g.capture_start, 3),
+            round((time.perf_counter() - g.capture_timer) * 1000, 2),
+            response.status_code,
+            request.method,
+            request.endpoint,
+            request.url_rule.rule,
+            request.view_args or {},
+            {name: value if name in KEEP_ARGS else len(value)
+             for name, value in request.args.items()
+             if name not in SKIP_ARGS},
+            {name: len(value) for name, value in request.form.items()},
+            g.capture_who,
+        ])
+        return response
+
+    def write(self, row):
+        # reopen after a fork, so each worker has its own descriptor
+        if self.pid != os.getpid():
+            self.fd = os.open(self.path,
+                              os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            self.pid = os.getpid()
+        line = json.dumps(row, separators=(',', ':'), default=str) + '\n'
+        os.write(self.fd, line.encode())
+
+    def close(self):
+        if self.fd is not None and self.pid == os.getpid():
+            os.close(self.fd)
+        self.fd = self.pid = None
+
+
+def read_entries(path):
+    """Captured requests in the log at `path`, as dicts, in start order."""
+
+    entries = []
+    with open(path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                # a line cut short by a crash
+                continue
+            if isinstance(row, list) and len(row) == len(FIELDS):
+                entries.append(dict(zip(FIELDS, row)))
+    entries.sort(key=lambda entry: entry['time'])
+    return entries
+
+
+def before_request():
+    log = current_app.extensions.get('capture')
+    if log is not None:
+        log.before_request()
+
+
+def after_request(response):
+    log = current_app.extensions.get('capture')
+    if log is None:
+        return response
+    return log.after_request(response)
+
+
+def init_app(app, user_key):
+    """Capture `app`'s requests to CAPTURE_LOG, if it's set. `user_key` is
+    the session key of the logged-in user."""
+
+    app.before_request(before_request)
+    app.after_request(after_request)
+
+    if app.config['CAPTURE_LOG']:
+        app.extensions['capture'] = CaptureLog(
+            app.config['CAPTURE_LOG'],
+            app.config['CAPTURE_KEY'] or app.config['SECRET_KEY'],
+            user_key, app.config['CAPTURE_SAMPLE_RATE'])
@@ -0,0 +1,128 @@
+"""Streaming export of a user's data: profile, messages, likes, follows.
+
+Rows are read with server-side cursors (`yield_per`) and written out as
+they arrive, so memory use stays flat however big the account is. With
+sharded messages, messages and likes are read from the shards in batches
+instead (see sharding.py). Output is NDJSON (one JSON object per line,
+each with a "type") or CSV (one table, with a "type" column and the union
+of the fields).
+"""
+
+import csv
+import io
+import json
+
+from sqlalchemy import select
+
+from models import db, Follows, Likes, Message, User
+import archive
+import sharding
+
+BATCH_SIZE = 1000
+CHUNK_BYTES = 64 * 1024
+
+CSV_FIELDS = ['type', 'id', 'user_id', 'username', 'text', 'timestamp',
+              'email', 'bio', 'location', 'image_url', 'header_image_url']
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def stream(stmt):
+    """Rows of `stmt`, fetched BATCH_SIZE at a time from a server-side
+    cursor."""
+
+    result = db.session.execute(stmt.execution_options(yield_per=BATCH_SIZE))
+    for partition in result.partitions():
+        yield from partition
+
+
+def records(user_id):
+    """Every record to export for `user_id`, as dicts with a 'type'."""
+
+    user = db.session.get(User, user_id)
+    yield dict(type='profile', id=user.id, username=user.username,
+               email=user.email, bio=user.bio, location=user.location,
+               image_url=user.image_url,
+               header_image_url=user.header_image_url)
+
+    if sharding.enabled():
+        messages = sharding.export_messages(user_id)
+        likes = sharding.export_likes(user_id)
+    else:
+        messages = stream(select(Message.id, Message.text, Message.timestamp)
+                          .where(Message.user_id == user_id)
+                          .order_by(Message.id))
+        likes = stream(select(Likes.message_id, Likes.timestamp,
+                              Message.user_id, Message.text)
+                       .join(Message, Message.id == Likes.message_id)
+                       .where(Likes.user_id == user_id)
+                       .order_by(Likes.id))
+
+    for row in messages:
+        yield dict(type='message', id=row.id, text=row.text,
+                   timestamp=row.timestamp.isoformat())
+
+    for message_id, timestamp, text in archive.user_records(user_id):
+        yield dict(type='message', id=message_id, text=text,
+                   timestamp=timestamp)
+
+    for row in likes:
+        yield dict(type='like', id=row.message_id, user_id=row.user_id,
+                   text=row.text, timestamp=row.timestamp.isoformat())
+
+    for message_id, author_id, text in archive.user_likes(user_id):
+        yield dict(type='like', id=message_id, user_id=author_id, text=text,
+                   timestamp=None)
+
+    for kind, mine, theirs in (
+            ('following', Follows.user_following_id,
+             Follows.user_being_followed_id),
+            ('follower', Follows.user_being_followed_id,
+             Follows.user_following_id)):
+        for row in stream(select(User.id, User.username)
+                          .join(Follows, theirs == User.id)
+                          .where(mine == user_id)
+                          .order_by(User.id)):
+            yield dict(type=kind, user_id=row.id, username=row.username)
+
+
+def ndjson_lines(user_id):
+    for record in records(user_id):
+        yield json.dumps(record) + '\n'
+
+
+def csv_lines(user_id):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+
+    writer.writeheader()
+    for record in records(user_id):
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def export_chunks(user_id, fmt='ndjson'):
+    """The export for `user_id` in `fmt` ('ndjson' or 'csv'), as encoded
+    chunks of roughly CHUNK_BYTES, for a streamed response or file."""
+
+    lines = ndjson_lines(user_id) if fmt == 'ndjson' else csv_lines(user_id)
+
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            yield ''.join(chunk).encode('UTF-8')
+            chunk = []
+            size = 0
+
+    if chunk:
+        yield ''.join(chunk).encode('UTF-8')
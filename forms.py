@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
@@ -32,3 +33,9 @@ class LoginForm(FlaskForm):
 
     username = StringField('Username', validators=[DataRequired()])
     password = PasswordField('Password', validators=[Length(min=6)])
+
+
+class FollowImportForm(FlaskForm):
+    """Form for importing a CSV of users to follow."""
+
+    csv_file = FileField('CSV of usernames', validators=[FileRequired()])
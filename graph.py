@@ -0,0 +1,443 @@
+"""In-process social graph: who follows whom, as NumPy CSR arrays.
+
+With GRAPH_ENGINE=csr each worker loads the `follows` table into two
+compressed sparse row structures, indexed directly by user id:
+
+- forward: `out_ptr[u]:out_ptr[u + 1]` slices `out_ids`, the sorted ids of
+  the users `u` follows;
+- reverse: `in_ptr` / `in_ids` likewise, for `u`'s followers.
+
+Ids are int32, so edges cost 8 bytes (4 each way) plus 16 bytes per user
+id for the two int64 row pointers. Degrees are pointer differences,
+`is_following` is a binary search, and mutuals/intersections are searches
+of the smaller sorted row in the larger.
+
+Follows and unfollows made through this worker are applied at once via a
+delta log: `user_follows_changed` re-reads that user's following list and
+records the difference from the arrays per user, in both directions.
+Every GRAPH_REBUILD_INTERVAL seconds (or once the deltas grow past
+MAX_DELTAS) the arrays are rebuilt in a background thread, which also
+picks up changes made through other workers; users changed during the
+rebuild are replayed onto the new arrays.
+
+So a follow made through one worker reaches the others' arrays only at
+their next rebuild, up to GRAPH_REBUILD_INTERVAL later, and counts and
+follower lists there lag by as much. The logged-in user's own follows
+aren't left to lag: `viewer_follows` and `known_followers` read the
+viewer's following list from the database, once per request, so the
+Follow/Unfollow buttons are right straight after the redirect from
+whichever worker handled the follow.
+
+The default GRAPH_ENGINE=sql answers the same questions with queries.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from flask import current_app, g
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Follows, User
+
+LOAD_BATCH = 100_000
+MAX_DELTAS = 100_000
+KNOWN_FOLLOWERS_SAMPLE = 3
+EMPTY = np.empty(0, dtype=np.int32)
+
+KnownFollowers = namedtuple('KnownFollowers', ['count', 'sample'])
+
+
+def intersect_sorted(a, b):
+    """Sorted ids in both sorted, duplicate-free arrays `a` and `b`:
+    binary searches of the smaller array's ids in the larger."""
+
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return EMPTY
+    positions = np.searchsorted(b, a)
+    found = positions < len(b)
+    found[found] = b[positions[found]] == a[found]
+    return a[found]
+
+
+def contains_sorted(ids, value):
+    i = np.searchsorted(ids, value)
+    return bool(i < len(ids) and ids[i] == value)
+
+
+def csr(sources, targets, n):
+    """Row pointers and sorted target ids for edges sources -> targets."""
+
+    order = np.lexsort((targets, sources))
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n), out=ptr[1:])
+    return ptr, targets[order].astype(np.int32)
+
+
+class Delta:
+    """Ids added to and removed from one row since the last build, and the
+    row with them applied.
+
+    The merged row is kept until the next change, so a popular row costs
+    one merge per follow or unfollow rather than one per read.
+    """
+
+    __slots__ = ('added', 'removed', 'merged')
+
+    def __init__(self, added=(), removed=()):
+        self.added = set(added)
+        self.removed = set(removed)
+        self.merged = None
+
+    def add(self, user_id):
+        self.merged = None
+        if user_id in self.removed:
+            self.removed.discard(user_id)
+        else:
+            self.added.add(user_id)
+
+    def remove(self, user_id):
+        self.merged = None
+        if user_id in self.added:
+            self.added.discard(user_id)
+        else:
+            self.removed.add(user_id)
+
+    def apply(self, ids):
+        """`ids`, the row as built (the same every call until the arrays
+        are rebuilt, which drops the deltas), with the changes applied."""
+
+        if self.merged is None:
+            if self.removed:
+                ids = ids[~np.isin(ids, np.fromiter(self.removed, np.int32))]
+            if self.added:
+                ids = np.union1d(ids, np.fromiter(self.added, np.int32))
+            self.merged = ids
+        return self.merged
+
+
+class SocialGraph:
+    """The follows graph in CSR form, plus the deltas since it was built."""
+
+    def __init__(self, app=None, rebuild_interval=60, clock=time.monotonic):
+        self.app = app
+        self.rebuild_interval = rebuild_interval
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.set_arrays(np.zeros(1, dtype=np.int64), EMPTY,
+                        np.zeros(1, dtype=np.int64), EMPTY)
+        self.built = False
+        self.built_at = 0
+        self.rebuilding = False
+        self.changed_during_rebuild = set()
+
+    def set_arrays(self, out_ptr, out_ids, in_ptr, in_ids):
+        self.out_ptr, self.out_ids = out_ptr, out_ids
+        self.in_ptr, self.in_ids = in_ptr, in_ids
+        self.out_deltas = {}
+        self.in_deltas = {}
+        self.deltas = 0
+
+    @staticmethod
+    def load():
+        """CSR arrays for the follows table, read in batches."""
+
+        edges = db.session.scalar(select(func.count()).select_from(Follows))
+        followers = np.empty(edges, dtype=np.int32)
+        followed = np.empty(edges, dtype=np.int32)
+
+        i = 0
+        result = db.session.execute(
+            select(Follows.user_following_id, Follows.user_being_followed_id)
+            .execution_options(yield_per=LOAD_BATCH))
+        for partition in result.partitions():
+            rows = np.array(partition, dtype=np.int32).reshape(-1, 2)
+            # rows added since the count are left for the next rebuild
+            rows = rows[:edges - i]
+            followers[i:i + len(rows)] = rows[:, 0]
+            followed[i:i + len(rows)] = rows[:, 1]
+            i += len(rows)
+        followers, followed = followers[:i], followed[:i]
+
+        n = int(max(followers.max(initial=0), followed.max(initial=0),
+                    db.session.scalar(select(func.max(User.id))) or 0)) + 1
+        return csr(followers, followed, n) + csr(followed, followers, n)
+
+    def build(self):
+        """Load the arrays now, dropping all deltas."""
+
+        arrays = self.load()
+        with self.lock:
+            self.set_arrays(*arrays)
+            self.built = True
+            self.built_at = self.clock()
+
+    def rebuild_in_background(self):
+        """Reload the arrays in a thread; replay users changed meanwhile."""
+
+        def run():
+            try:
+                with self.app.app_context():
+                    arrays = self.load()
+                    with self.lock:
+                        self.set_arrays(*arrays)
+                        self.built_at = self.clock()
+                        changed = self.changed_during_rebuild
+                        self.changed_during_rebuild = set()
+                        self.rebuilding = False
+                    for user_id in changed:
+                        self.resync(user_id)
+                    db.session.remove()
+            finally:
+                self.rebuilding = False
+
+        self.rebuilding = True
+        threading.Thread(target=run, daemon=True,
+                         name='graph-rebuild').start()
+
+    def maybe_rebuild(self):
+        with self.lock:
+            if not self.built:
+                self.build()
+            elif not self.rebuilding and (
+                    self.deltas > MAX_DELTAS
+                    or self.clock() - self.built_at >= self.rebuild_interval):
+                self.rebuild_in_background()
+
+    @staticmethod
+    def row(ptr, ids, user_id):
+        if not 0 <= user_id < len(ptr) - 1:
+            return EMPTY
+        return ids[ptr[user_id]:ptr[user_id + 1]]
+
+    def following(self, user_id):
+        """Sorted ids of the users `user_id` follows."""
+
+        with self.lock:
+            ids = self.row(self.out_ptr, self.out_ids, user_id)
+            delta = self.out_deltas.get(user_id)
+            return delta.apply(ids) if delta else ids
+
+    def followers(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        with self.lock:
+            ids = self.row(self.in_ptr, self.in_ids, user_id)
+            delta = self.in_deltas.get(user_id)
+            return delta.apply(ids) if delta else ids
+
+    def following_count(self, user_id):
+        with self.lock:
+            ptr = self.out_ptr
+            count = (int(ptr[user_id + 1] - ptr[user_id])
+                     if 0 <= user_id < len(ptr) - 1 else 0)
+            delta = self.out_deltas.get(user_id)
+            if delta:
+                count += len(delta.added) - len(delta.removed)
+            return count
+
+    def followers_count(self, user_id):
+        with self.lock:
+            ptr = self.in_ptr
+            count = (int(ptr[user_id + 1] - ptr[user_id])
+                     if 0 <= user_id < len(ptr) - 1 else 0)
+            delta = self.in_deltas.get(user_id)
+            if delta:
+                count += len(delta.added) - len(delta.removed)
+            return count
+
+    def is_following(self, follower_id, followed_id):
+        with self.lock:
+            delta = self.out_deltas.get(follower_id)
+            if delta and followed_id in delta.added:
+                return True
+            if delta and followed_id in delta.removed:
+                return False
+            return contains_sorted(
+                self.row(self.out_ptr, self.out_ids, follower_id), followed_id)
+
+    def mutuals(self, user_id):
+        """Users who follow `user_id` and are followed back."""
+
+        return self.followers_followed_by(user_id, user_id)
+
+    def followers_followed_by(self, user_id, by_id):
+        """Sorted ids of `user_id`'s followers that `by_id` follows."""
+
+        return intersect_sorted(self.followers(user_id),
+                                self.following(by_id))
+
+    def set_following(self, user_id, following_ids):
+        """Record that `user_id` now follows exactly `following_ids`."""
+
+        with self.lock:
+            if self.rebuilding:
+                self.changed_during_rebuild.add(user_id)
+
+            old = set(self.following(user_id).tolist())
+            new = set(following_ids)
+            base = set(self.row(self.out_ptr, self.out_ids, user_id).tolist())
+
+            self.out_deltas[user_id] = Delta(new - base, base - new)
+
+            for followed_id in new - old:
+                self.in_deltas.setdefault(followed_id, Delta()).add(user_id)
+            for followed_id in old - new:
+                self.in_deltas.setdefault(followed_id, Delta()).remove(user_id)
+            self.deltas += len(new ^ old)
+
+    def resync(self, user_id):
+        """Re-read `user_id`'s following list from the database."""
+
+        self.set_following(user_id, Follows.following_ids(user_id))
+
+    def remove_user(self, user_id):
+        """Drop a deleted user's follows, both ways."""
+
+        with self.lock:
+            self.set_following(user_id, [])
+            for follower_id in self.followers(user_id).tolist():
+                self.out_deltas.setdefault(follower_id, Delta()).remove(user_id)
+                self.in_deltas.setdefault(user_id, Delta()).remove(follower_id)
+                self.deltas += 1
+
+    def nbytes(self):
+        return (self.out_ptr.nbytes + self.out_ids.nbytes
+                + self.in_ptr.nbytes + self.in_ids.nbytes)
+
+
+def social_graph():
+    """The app's SocialGraph, made current; None with GRAPH_ENGINE=sql."""
+
+    graph = current_app.extensions.get('graph')
+    if graph is not None:
+        graph.maybe_rebuild()
+    return graph
+
+
+def following_count(user_id):
+    """How many users `user_id` follows."""
+
+    graph = social_graph()
+    if graph is None:
+        return Follows.following_count(user_id)
+    return graph.following_count(user_id)
+
+
+def followers_count(user_id):
+    """How many users follow `user_id`."""
+
+    graph = social_graph()
+    if graph is None:
+        return Follows.followers_count(user_id)
+    return graph.followers_count(user_id)
+
+
+def viewer_follows(user_id):
+    """Does the logged-in user follow `user_id`?"""
+
+    if not g.user:
+        return False
+    return user_id in viewer_following_ids()
+
+
+def viewer_following_ids():
+    """Ids the logged-in user follows, from the database (not the graph,
+    which may not have this worker's latest follows), once per request."""
+
+    if 'following_ids' not in g:
+        g.following_ids = set(Follows.following_ids(g.user.id))
+    return g.following_ids
+
+
+def forget_following():
+    # g outlives a request when an app context was already pushed (tests,
+    # scripts)
+    g.pop('following_ids', None)
+
+
+def followers_followed_by(user_id, by_id):
+    """Ids of `user_id`'s followers that `by_id` follows, in id order;
+    with by_id == user_id, `user_id`'s mutual follows."""
+
+    graph = social_graph()
+    if graph is None:
+        return Follows.followers_followed_by(user_id, by_id)
+    return graph.followers_followed_by(user_id, by_id).tolist()
+
+
+def known_followers(user_id, sample=KNOWN_FOLLOWERS_SAMPLE):
+    """Followers of `user_id` that the logged-in user follows: how many,
+    and a few of them (most followed first) to name."""
+
+    if not g.user or g.user.id == user_id:
+        return KnownFollowers(0, [])
+
+    graph = social_graph()
+    if graph is None:
+        ids = Follows.followers_followed_by(user_id, g.user.id)
+    else:
+        following = np.array(sorted(viewer_following_ids()), dtype=np.int32)
+        ids = intersect_sorted(graph.followers(user_id), following).tolist()
+    if not ids:
+        return KnownFollowers(0, [])
+
+    if len(ids) > sample:
+        if graph is None:
+            counts = dict(db.session.execute(
+                select(Follows.user_being_followed_id, func.count())
+                .where(Follows.user_being_followed_id.in_(ids))
+                .group_by(Follows.user_being_followed_id)).all())
+        else:
+            counts = {follower_id: graph.followers_count(follower_id)
+                      for follower_id in ids}
+        ids = sorted(ids, key=lambda follower_id: -counts.get(follower_id, 0))
+
+    users = {user.id: user for user in
+             User.query.filter(User.id.in_(ids[:sample]))}
+    return KnownFollowers(len(ids), [users[follower_id]
+                                     for follower_id in ids[:sample]
+                                     if follower_id in users])
+
+
+def user_follows_changed(user_id):
+    """Note committed follows/unfollows by `user_id`."""
+
+    g.pop('following_ids', None)
+    graph = current_app.extensions.get('graph')
+    if graph is not None and graph.built:
+        graph.resync(user_id)
+
+
+def user_deleted(user_id):
+    """Note a deleted user."""
+
+    graph = current_app.extensions.get('graph')
+    if graph is not None and graph.built:
+        graph.remove_user(user_id)
+
+
+def init_app(app):
+    """Load the graph now (so forked workers share it) if GRAPH_ENGINE is
+    'csr', and add the template helpers."""
+
+    for helper in (following_count, followers_count, viewer_follows,
+                   known_followers):
+        app.add_template_global(helper)
+    app.before_request(forget_following)
+
+    if app.config['GRAPH_ENGINE'] != 'csr':
+        return
+
+    graph = app.extensions['graph'] = SocialGraph(
+        app, app.config['GRAPH_REBUILD_INTERVAL'])
+    with app.app_context():
+        try:
+            graph.build()
+        except SQLAlchemyError:
+            # no follows table yet; build on first use
+            db.session.rollback()
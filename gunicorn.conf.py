@@ -0,0 +1,51 @@
+"""Gunicorn settings for production: gunicorn -c gunicorn.conf.py wsgi:app"""
+
+import os
+import tempfile
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+
+# WORKER_CLASS=gevent serves each request in a greenlet, so a worker can
+# hold thousands of idle /timeline/stream connections (see live.py).
+# Not for WARBLER_ASYNC, whose event loop runs in a real thread.
+worker_class = os.environ.get('WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 5000))
+os.environ.setdefault('LIVE_UPDATES', '1' if worker_class == 'gevent' else '0')
+
+# The app is preloaded in the master (below), before gevent workers patch
+# anything: patch now, so the locks and conditions it creates at import
+# (likebuffer, live, admission) are gevent's, and a waiting greenlet
+# doesn't block its whole worker.
+if worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+# Import the app (and precompile templates) once in the master, then fork
+# workers that share that memory copy-on-write.
+preload_app = True
+
+# Workers share metrics through files here (see metrics.py); set before
+# the app is preloaded, so it picks it up.
+os.environ.setdefault('METRICS_DIR', os.path.join(
+    tempfile.gettempdir(), f'warbler-metrics-{os.getuid()}'))
+
+
+def on_starting(server):
+    """Start metrics from zero, not from the last run's worker files."""
+
+    import metrics
+
+    if metrics.FileStore.private(os.environ['METRICS_DIR']):
+        metrics.FileStore(os.environ['METRICS_DIR']).clear()
+
+
+def post_fork(server, worker):
+    """Each worker needs its own DB connections, not the master's."""
+
+    from wsgi import app
+    import startup
+
+    startup.dispose_engine_after_fork(app)
+    if worker_class == 'gevent':
+        startup.make_psycopg2_cooperative()
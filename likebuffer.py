@@ -0,0 +1,353 @@
+"""Write-behind buffering of likes, committed in groups.
+
+By default every like/unlike click is its own transaction, so a viral
+message means a stream of tiny commits, each waiting on an fsync. With
+LIKE_WRITE_MODE=buffered, `add_like` instead records the toggle in this
+worker's buffer, and a background thread writes the buffer out every
+LIKE_FLUSH_MS milliseconds, or as soon as it holds LIKE_FLUSH_BATCH
+entries, in one transaction: one multi-row INSERT for the likes, one
+DELETE for the unlikes, and the like notifications.
+
+Toggles are coalesced per (user, message) while buffered: liking and
+unliking again before a flush writes nothing. The buffer holds at most
+LIKE_BUFFER_MAX entries; past that, toggles wait for a flush.
+
+LIKE_DURABILITY says when `add_like` returns:
+
+- 'commit': after the transaction holding its toggle commits. Clicks still
+  share commits, but none is acknowledged and then lost.
+- 'async': at once. A crash loses up to LIKE_FLUSH_MS of likes.
+
+Until its toggle is written, a user sees it through `overlay`, which
+applies this worker's buffered toggles to a page's like state. Other
+workers (and other users' counts) catch up at the next flush.
+
+A like whose message or user was deleted meanwhile would fail the whole
+batch; the batch is then retried one toggle at a time and those dropped.
+With 'commit' durability, a request whose toggle was dropped (say, the
+database was down) gets a 503 rather than a success, as does one that
+waited WRITE_TIMEOUT seconds for its flush. Not used with sharded
+messages.
+"""
+
+import atexit
+import logging
+import os
+import threading
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import ServiceUnavailable
+
+from models import db, dialect_insert, Likes
+import notifications
+
+logger = logging.getLogger(__name__)
+
+WRITE_TIMEOUT = 10
+# dropped toggles are remembered for this many flushes
+FAILED_GENERATIONS = 1000
+
+
+class LikeNotSaved(ServiceUnavailable):
+    description = "Your like couldn't be saved. Please try again."
+
+
+class Toggle:
+    """A buffered like state: `liked` now, `was_liked` in the database."""
+
+    __slots__ = ('liked', 'was_liked', 'author_id')
+
+    def __init__(self, liked, was_liked, author_id):
+        self.liked = liked
+        self.was_liked = was_liked
+        self.author_id = author_id
+
+
+class LikeBuffer:
+    """Buffered like toggles of this process, and the thread flushing
+    them."""
+
+    def __init__(self, app, flush_ms=5, batch=500, max_entries=10000,
+                 durability='commit'):
+        self.app = app
+        self.interval = flush_ms / 1000
+        self.batch = batch
+        self.max_entries = max_entries
+        self.durability = durability
+
+        self.cond = threading.Condition()
+        # user id -> {message id: Toggle}, for the batch filling up and the
+        # one being written
+        self.pending = {}
+        self.flushing = {}
+        self.size = 0
+        self.generation = 0
+        self.flushed = -1
+        # generation -> {(user id, message id)} of toggles it dropped
+        self.failed = {}
+        self.stopping = False
+        self.pid = None
+
+    def start(self):
+        """Start the flush thread (again, after a fork)."""
+
+        with self.cond:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.pending, self.flushing, self.size = {}, {}, 0
+            self.stopping = False
+            threading.Thread(target=self.run, daemon=True,
+                             name='warbler-like-flush').start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Flush what's buffered and stop the thread."""
+
+        with self.cond:
+            if self.pid != os.getpid() or self.stopping:
+                return
+            self.stopping = True
+            generation = self.generation
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.flushed >= generation, timeout=10)
+
+    def buffered(self, user_id, message_id):
+        """(Toggle, whether it's still pending) of `user_id` on
+        `message_id`, or (None, False) if nothing's buffered."""
+
+        toggle = self.pending.get(user_id, {}).get(message_id)
+        if toggle is not None:
+            return toggle, True
+        return self.flushing.get(user_id, {}).get(message_id), False
+
+    def toggle(self, user_id, message_id, author_id):
+        """Like or unlike `message_id` as `user_id`; returns whether it's
+        now liked. With 'commit' durability, waits until that's written,
+        raising LikeNotSaved if it wasn't."""
+
+        self.start()
+
+        while True:
+            with self.cond:
+                flushed = self.flushed
+                toggle, _ = self.buffered(user_id, message_id)
+            in_db = None
+            if toggle is None:
+                in_db = db.session.scalar(
+                    select(Likes.id).where(Likes.user_id == user_id,
+                                           Likes.message_id == message_id)
+                    .limit(1)) is not None
+
+            with self.cond:
+                toggle, is_pending = self.buffered(user_id, message_id)
+                if toggle is None and (in_db is None
+                                       or self.flushed != flushed):
+                    # a flush landed in between: read the database again
+                    continue
+
+                if not self.cond.wait_for(
+                        lambda: self.size < self.max_entries
+                        or message_id in self.pending.get(user_id, ()),
+                        timeout=WRITE_TIMEOUT):
+                    raise LikeNotSaved()
+                toggle, is_pending = self.buffered(user_id, message_id)
+
+                # what the database will hold once in-flight writes land
+                if toggle is None:
+                    liked, base = not in_db, in_db
+                elif is_pending:
+                    liked, base = not toggle.liked, toggle.was_liked
+                else:
+                    liked, base = not toggle.liked, toggle.liked
+
+                toggles = self.pending.setdefault(user_id, {})
+                if message_id in toggles:
+                    del toggles[message_id]
+                    self.size -= 1
+                if liked != base:
+                    toggles[message_id] = Toggle(liked, base, author_id)
+                    self.size += 1
+                elif not toggles:
+                    # back to what's in the database: nothing to write
+                    del self.pending[user_id]
+                self.cond.notify_all()
+
+                if self.durability == 'commit':
+                    if liked != base:
+                        generation = self.generation
+                    elif toggle is not None and not is_pending:
+                        generation = self.generation - 1
+                    else:
+                        return liked
+                    if (not self.cond.wait_for(
+                            lambda: self.flushed >= generation,
+                            timeout=WRITE_TIMEOUT)
+                            or (user_id, message_id)
+                            in self.failed.get(generation, ())):
+                        raise LikeNotSaved()
+                return liked
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.stopping)
+                # give clicks a moment to gather, unless the batch is full
+                self.cond.wait_for(lambda: self.size >= self.batch
+                                   or self.stopping, timeout=self.interval)
+
+                self.flushing, self.pending = self.pending, {}
+                self.size = 0
+                generation = self.generation
+                self.generation += 1
+                stopping = self.stopping
+                self.cond.notify_all()
+
+            failed = set()
+            if self.flushing:
+                try:
+                    failed = self.write(self.flushing)
+                except Exception:
+                    # never let the thread die: requests are waiting on it
+                    logger.exception("like flush failed")
+                    failed = {(user_id, message_id)
+                              for user_id, messages in self.flushing.items()
+                              for message_id in messages}
+
+            with self.cond:
+                self.flushing = {}
+                if failed:
+                    self.failed[generation] = failed
+                self.failed.pop(generation - FAILED_GENERATIONS, None)
+                self.flushed = generation
+                self.cond.notify_all()
+            if stopping:
+                return
+
+    def write(self, toggles):
+        """Write a batch of toggles in one transaction, or if that fails,
+        one at a time. Returns the (user id, message id) of those
+        dropped."""
+
+        likes = []
+        unlikes = []
+        for user_id, messages in toggles.items():
+            for message_id, toggle in messages.items():
+                if toggle.liked:
+                    likes.append((user_id, message_id, toggle.author_id))
+                else:
+                    unlikes.append((user_id, message_id))
+
+        with self.app.app_context():
+            try:
+                apply(likes, unlikes)
+                db.session.commit()
+                return set()
+            except SQLAlchemyError:
+                db.session.rollback()
+
+            failed = set()
+            for batch in ([([like], []) for like in likes]
+                          + [([], [unlike]) for unlike in unlikes]):
+                try:
+                    apply(*batch)
+                    db.session.commit()
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    logger.warning("dropped buffered like toggle %r", batch)
+                    user_id, message_id = (batch[0] or batch[1])[0][:2]
+                    failed.add((user_id, message_id))
+            return failed
+
+    def overlay(self, viewer_id, message_ids, liked, counts):
+        """`liked` and `counts` (from Likes.page_state) with `viewer_id`'s
+        buffered toggles of `message_ids` applied."""
+
+        with self.cond:
+            toggles = {}
+            for message_id in message_ids:
+                toggle, _ = self.buffered(viewer_id, message_id)
+                if toggle is not None:
+                    toggles[message_id] = toggle.liked
+        if not toggles:
+            return liked, counts
+
+        liked = set(liked)
+        counts = dict(counts)
+        for message_id, now_liked in toggles.items():
+            if now_liked == (message_id in liked):
+                continue
+            if now_liked:
+                liked.add(message_id)
+                counts[message_id] = counts.get(message_id, 0) + 1
+            else:
+                liked.discard(message_id)
+                counts[message_id] = counts.get(message_id, 0) - 1
+                if counts[message_id] <= 0:
+                    del counts[message_id]
+        return liked, counts
+
+
+def apply(likes, unlikes):
+    """Statements for a batch: likes are (user id, message id, author id),
+    unlikes (user id, message id). The caller commits."""
+
+    if likes:
+        now = datetime.utcnow()
+        db.session.execute(
+            dialect_insert(Likes.__table__)
+            .values([{'user_id': user_id, 'message_id': message_id,
+                      'timestamp': now}
+                     for user_id, message_id, _ in likes])
+            .on_conflict_do_nothing())
+
+        # one notification upsert per liked message
+        per_message = Counter((message_id, author_id)
+                              for _, message_id, author_id in likes)
+        last_liker = {message_id: user_id for user_id, message_id, _ in likes}
+        for (message_id, author_id), count in per_message.items():
+            notifications.record(author_id, 'like', f"like:{message_id}",
+                                 last_liker[message_id],
+                                 message_id=message_id, now=now, count=count)
+
+    if unlikes:
+        db.session.execute(delete(Likes).where(
+            tuple_(Likes.user_id, Likes.message_id).in_(unlikes)))
+
+
+def enabled():
+    """Are likes buffered?"""
+
+    return 'like_buffer' in current_app.extensions
+
+
+def toggle(user_id, message):
+    """Buffer a like/unlike of `message` by `user_id`; returns whether it's
+    now liked."""
+
+    return current_app.extensions['like_buffer'].toggle(
+        user_id, message.id, message.user_id)
+
+
+def overlay(viewer_id, message_ids, liked, counts):
+    """Page like state with the viewer's own buffered toggles applied."""
+
+    buffer = current_app.extensions.get('like_buffer')
+    if buffer is None or viewer_id is None:
+        return liked, counts
+    return buffer.overlay(viewer_id, message_ids, liked, counts)
+
+
+def init_app(app):
+    """Buffer likes if LIKE_WRITE_MODE is 'buffered'."""
+
+    if app.config['LIKE_WRITE_MODE'] != 'buffered':
+        return
+
+    app.extensions['like_buffer'] = LikeBuffer(
+        app, app.config['LIKE_FLUSH_MS'], app.config['LIKE_FLUSH_BATCH'],
+        app.config['LIKE_BUFFER_MAX'], app.config['LIKE_DURABILITY'])
@@ -0,0 +1,399 @@
+"""Live home timeline updates, over Server-Sent Events.
+
+A logged-in home page opens an EventSource on /timeline/stream. The stream
+subscribes to the authors the viewer follows (and the viewer), and each
+message posted through `messages_add` is pushed to the subscribers of its
+author as a `message` event; the page prepends it to the timeline.
+
+Within a process, a Hub maps author ids to subscriber queues. Between the
+processes of a node, new messages go over a channel (LIVE_CHANNEL):
+
+- 'postgres': NOTIFY on the database, with one LISTEN connection per
+  worker. Every worker, the sender included, hears each message once.
+- 'unix': every worker binds a datagram socket `<LIVE_SOCKET_DIR>/<pid>.sock`
+  and a sender delivers to its own hub and sends to every other socket
+  there. Anyone who can write to the directory could inject or intercept
+  events, so it must be ours and private (0700); otherwise workers only
+  deliver to their own hub.
+- 'local': this process only (single-process servers).
+
+'auto' picks postgres on Postgres and unix otherwise. The channel is
+started lazily in each worker, after gunicorn forks.
+
+An idle stream holds no request context or DB connection, just a queue and
+a blocked `get` -- but it does hold its worker thread, so a sync worker
+would be taken by one home page. The stream is off unless LIVE_UPDATES is
+set, which gunicorn.conf.py does for WORKER_CLASS=gevent: each stream is
+then a greenlet, and a node can keep thousands open. LIVE_MAX_STREAMS
+caps streams per worker. A stream whose queue overflows is closed; the
+browser reconnects with Last-Event-ID and is sent the messages it missed.
+"""
+
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import threading
+import time
+
+from flask import Response, abort, current_app, g, request
+
+from models import db, Follows, Message
+from startup import private_directory
+from thumbnails import thumbnail_url
+import sharding
+
+PG_CHANNEL = 'warbler_messages'
+PG_RECONNECT_DELAY = 5
+BACKFILL_LIMIT = 50
+MAX_DATAGRAM = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One stream's queue of events, from the authors it follows."""
+
+    def __init__(self, authors, maxsize):
+        self.authors = frozenset(authors)
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+        self.subscribed = True
+
+    def put(self, event):
+        """Queue `event`; False if the queue is full (the stream is too
+        slow and should be dropped)."""
+
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+            return False
+        return True
+
+    def get(self, timeout):
+        """The next event, or None after `timeout` seconds."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Hub:
+    """In-process pub/sub of message events, by author."""
+
+    def __init__(self, max_streams=1000, queue_size=100):
+        self.max_streams = max_streams
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.by_author = {}
+        self.streams = 0
+
+    def subscribe(self, authors):
+        """A Subscription to `authors`' messages, or None if this process
+        already has max_streams."""
+
+        with self.lock:
+            if self.streams >= self.max_streams:
+                return None
+            self.streams += 1
+            sub = Subscription(authors, self.queue_size)
+            for author in sub.authors:
+                self.by_author.setdefault(author, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if not sub.subscribed:
+                return
+            sub.subscribed = False
+            self.streams -= 1
+            for author in sub.authors:
+                subs = self.by_author[author]
+                subs.discard(sub)
+                if not subs:
+                    del self.by_author[author]
+
+    def publish(self, event):
+        """Deliver `event` to the subscribers of its author."""
+
+        with self.lock:
+            subs = list(self.by_author.get(event['user_id'], ()))
+        for sub in subs:
+            sub.put(event)
+
+
+class LocalChannel:
+    """Delivers to this process's hub only."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def start(self):
+        pass
+
+    def publish(self, event):
+        self.hub.publish(event)
+
+    def close(self):
+        pass
+
+
+class UnixSocketChannel:
+    """Delivers to every worker's hub through per-process datagram sockets
+    in a shared directory."""
+
+    def __init__(self, hub, directory):
+        self.hub = hub
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.pid = None
+        self.sock = None
+        self.path = None
+
+    def start(self):
+        """Bind this process's socket and start receiving (again after a
+        fork)."""
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            self.pid = os.getpid()
+            if not private_directory(self.directory):
+                logger.warning("live updates stay in this worker: %s is not "
+                               "a directory owned and only writable by this "
+                               "user", self.directory)
+                return
+
+            self.path = os.path.join(self.directory, f"{os.getpid()}.sock")
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(self.path)
+
+            threading.Thread(target=self.receive, args=(self.sock,),
+                             daemon=True, name='warbler-live-unix').start()
+
+    def receive(self, sock):
+        while True:
+            try:
+                data = sock.recv(MAX_DATAGRAM)
+            except OSError:
+                return
+            try:
+                self.hub.publish(json.loads(data))
+            except ValueError:
+                continue
+
+    def publish(self, event):
+        self.start()
+        self.hub.publish(event)
+        if self.sock is None:
+            return
+
+        data = json.dumps(event).encode('UTF-8')
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        try:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if not name.endswith('.sock') or path == self.path:
+                    continue
+                try:
+                    sender.sendto(data, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # an exited worker's socket
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                except BlockingIOError:
+                    # that worker isn't keeping up; it misses this one
+                    continue
+        finally:
+            sender.close()
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None and self.pid == os.getpid():
+                self.sock.close()
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+            self.pid = self.sock = self.path = None
+
+
+class PostgresChannel:
+    """Delivers to every worker's hub with Postgres NOTIFY, each worker
+    LISTENing on its own connection."""
+
+    def __init__(self, hub, engine):
+        self.hub = hub
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.pid = None
+        self.connection = None
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            threading.Thread(target=self.listen, daemon=True,
+                             name='warbler-live-pg').start()
+
+    def listen(self):
+        """LISTEN for good, reconnecting after the connection is lost
+        (messages sent meanwhile are missed, as by a dropped stream)."""
+
+        while True:
+            try:
+                self.receive()
+            except Exception:
+                logger.exception("live LISTEN connection lost; reconnecting")
+            if self.connection is not None:
+                try:
+                    self.connection.invalidate()
+                except Exception:
+                    pass
+                self.connection = None
+            time.sleep(PG_RECONNECT_DELAY)
+
+    def receive(self):
+        # kept until it fails: a pooled connection, never returned
+        self.connection = self.engine.raw_connection()
+        conn = self.connection.dbapi_connection
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {PG_CHANNEL}")
+
+        while True:
+            select.select([conn], [], [], 60)
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                try:
+                    self.hub.publish(json.loads(notify.payload))
+                except ValueError:
+                    continue
+
+    def publish(self, event):
+        self.start()
+        db.session.execute(db.text("SELECT pg_notify(:channel, :payload)"),
+                           {'channel': PG_CHANNEL,
+                            'payload': json.dumps(event)})
+        db.session.commit()
+
+    def close(self):
+        pass
+
+
+def message_event(msg):
+    """The `message` event for a new message."""
+
+    return {
+        'id': msg.id,
+        'user_id': msg.user_id,
+        'username': msg.user.username,
+        'image_url': thumbnail_url(msg.user.image_url, 'sm'),
+        'text': msg.text,
+        'timestamp': msg.timestamp.strftime('%d %B %Y'),
+    }
+
+
+def format_event(event):
+    return f"id: {event['id']}\nevent: message\ndata: {json.dumps(event)}\n\n"
+
+
+def message_added(msg):
+    """Push a newly committed message to live timelines."""
+
+    if current_app.config['LIVE_UPDATES']:
+        current_app.extensions['live']['channel'].publish(message_event(msg))
+
+
+def missed_events(authors, last_id):
+    """Events for messages by `authors` after id `last_id`, oldest first."""
+
+    if sharding.enabled():
+        messages = sharding.messages_after(authors, last_id, BACKFILL_LIMIT)
+    else:
+        messages = (Message.query
+                    .filter(Message.user_id.in_(authors),
+                            Message.id > last_id)
+                    .order_by(Message.id.desc())
+                    .limit(BACKFILL_LIMIT)
+                    .all())
+    return [message_event(msg) for msg in reversed(messages)]
+
+
+def stream(sub, hub, backlog, heartbeat):
+    """The SSE body: backlog, then events as they arrive, with a comment
+    line every `heartbeat` seconds so proxies keep the connection open."""
+
+    try:
+        yield "retry: 3000\n\n"
+        for event in backlog:
+            yield format_event(event)
+        while not sub.overflowed:
+            event = sub.get(heartbeat)
+            yield ": keepalive\n\n" if event is None else format_event(event)
+    finally:
+        hub.unsubscribe(sub)
+
+
+def serve_stream():
+    """SSE stream of new messages for the logged-in user's home timeline."""
+
+    if not current_app.config['LIVE_UPDATES']:
+        abort(404)
+    if not g.user:
+        abort(401)
+
+    live = current_app.extensions['live']
+    live['channel'].start()
+
+    authors = set(Follows.following_ids(g.user.id))
+    authors.add(g.user.id)
+
+    last_id = request.headers.get('Last-Event-ID', '')
+    backlog = missed_events(authors, int(last_id)) if last_id.isdigit() else []
+
+    sub = live['hub'].subscribe(authors)
+    if sub is None:
+        abort(503)
+
+    # the body runs after the request context (and its DB session) is gone
+    return Response(stream(sub, live['hub'], backlog,
+                           current_app.config['LIVE_HEARTBEAT']),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+def make_channel(app, hub):
+    kind = app.config['LIVE_CHANNEL']
+    if kind == 'auto':
+        with app.app_context():
+            dialect = db.engine.dialect.name
+        kind = 'postgres' if dialect == 'postgresql' else 'unix'
+
+    if kind == 'postgres':
+        with app.app_context():
+            return PostgresChannel(hub, db.engine)
+    if kind == 'unix':
+        return UnixSocketChannel(hub, app.config['LIVE_SOCKET_DIR'])
+    return LocalChannel(hub)
+
+
+def init_app(app):
+    """Serve the live timeline stream at /timeline/stream."""
+
+    hub = Hub(app.config['LIVE_MAX_STREAMS'])
+    app.extensions['live'] = {'hub': hub, 'channel': make_channel(app, hub)}
+    app.add_url_rule('/timeline/stream', 'timeline_stream', serve_stream)
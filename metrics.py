@@ -0,0 +1,338 @@
+"""Prometheus metrics for Warbler, served at /metrics.
+
+Recorded per request:
+
+- latency histogram and request count, by endpoint, method and status
+- how long getting a connection from the DB pool took
+- how many SQL statements the request ran
+
+plus hit/miss counts of the app's caches (thumbnails, timeline) and the
+requests shed by admission control.
+
+Each process records into an in-memory Registry. With METRICS_DIR set (as
+under gunicorn), every worker also writes its totals to `<dir>/<pid>.json`
+at most every METRICS_FLUSH_INTERVAL seconds, and /metrics sums the files
+of all workers -- so whichever worker answers a scrape reports for the
+whole node. Files of exited workers are kept, so counters never go
+backwards; clear the directory when the server starts (gunicorn.conf.py
+does). The directory must be ours and writable by no one else, or anyone
+could add to the node's numbers; otherwise each worker reports only its
+own.
+
+/metrics only answers clients in METRICS_ALLOWED_IPS.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import (Response, abort, current_app, g, has_request_context,
+                   request)
+from sqlalchemy import event
+
+from models import db
+from startup import private_directory
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CHECKOUT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+logger = logging.getLogger(__name__)
+
+# name -> (type, help, buckets)
+METRICS = {
+    'warbler_http_requests_total': (
+        'counter', "HTTP requests, by endpoint, method and status.", None),
+    'warbler_http_request_duration_seconds': (
+        'histogram', "Time to handle a request, by endpoint and method.",
+        LATENCY_BUCKETS),
+    'warbler_db_pool_checkout_seconds': (
+        'histogram', "Time waiting for a connection from the DB pool.",
+        CHECKOUT_BUCKETS),
+    'warbler_db_queries_per_request': (
+        'histogram', "SQL statements run per request, by endpoint.",
+        QUERY_BUCKETS),
+    'warbler_admission_shed_total': (
+        'counter', "Requests turned away by admission control, by priority.",
+        None),
+    'warbler_cache_hits_total': (
+        'counter', "Cache lookups that found an entry, by cache.", None),
+    'warbler_cache_misses_total': (
+        'counter', "Cache lookups that missed, by cache.", None),
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Registry:
+    """Counters and histograms for this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, labels_key(labels))
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum
+                counts = self.histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(buckets)] += 1
+            counts[-1] += value
+
+    def add_collector(self, collect):
+        """Call `collect()` for extra counters at every snapshot; it
+        yields (name, labels, total) with this process's running totals."""
+
+        self.collectors.append(collect)
+
+    def snapshot(self):
+        """Everything recorded, as JSON-able lists."""
+
+        with self.lock:
+            counters = [[name, list(labels), value]
+                        for (name, labels), value in self.counters.items()]
+            histograms = [[name, list(labels), list(counts)]
+                          for (name, labels), counts
+                          in self.histograms.items()]
+
+        for collect in self.collectors:
+            for name, labels, total in collect():
+                counters.append([name, list(labels_key(labels)), total])
+
+        return {'counters': counters, 'histograms': histograms}
+
+
+def merge(snapshots):
+    """Sum snapshots (from several processes) into one."""
+
+    counters = {}
+    histograms = {}
+
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.setdefault(key, [0] * len(counts))
+            for i, count in enumerate(counts):
+                total[i] += count
+
+    return counters, histograms
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"')
+               .replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value
+                          in zip(pairs, escaped)) + '}'
+
+
+def exposition(snapshots):
+    """Prometheus text format for the sum of `snapshots`."""
+
+    counters, histograms = merge(snapshots)
+    lines = []
+
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            continue
+
+        for (metric, labels), counts in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{name}_bucket"
+                             f"{format_labels(labels, [('le', bound)])} "
+                             f"{cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {counts[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+
+    return '\n'.join(lines) + '\n'
+
+
+class FileStore:
+    """Per-process snapshot files in a directory shared by workers."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def private(directory):
+        """Whether `directory` is safe to share snapshots in, logging why
+        not."""
+
+        if private_directory(directory):
+            return True
+        logger.warning("metrics not shared between workers: %s is not a "
+                       "directory owned and only writable by this user",
+                       directory)
+        return False
+
+    def write(self, snapshot):
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp = path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                     | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+
+    def read_all(self):
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                continue
+        return snapshots
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(('.json', '.tmp')):
+                os.remove(os.path.join(self.directory, name))
+
+
+class Metrics:
+    """Records request metrics into a Registry, optionally shared through
+    a FileStore."""
+
+    def __init__(self, store=None, flush_interval=1.0):
+        self.registry = Registry()
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flushed_at = 0
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if self.store and (force or now - self.flushed_at
+                           >= self.flush_interval):
+            self.flushed_at = now
+            self.store.write(self.registry.snapshot())
+
+    def render(self):
+        if self.store is None:
+            return exposition([self.registry.snapshot()])
+        self.flush(force=True)
+        return exposition(self.store.read_all())
+
+    def instrument_pool(self, pool):
+        """Time every connection checkout from `pool`."""
+
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                self.registry.observe('warbler_db_pool_checkout_seconds', {},
+                                      time.perf_counter() - start)
+
+        pool.connect = timed_connect
+        pool.metrics_instrumented = True
+
+    def count_query(self, *args):
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_queries += 1
+
+    def before_request(self):
+        # engine.dispose() (e.g. after fork) replaces the pool
+        if not getattr(db.engine.pool, 'metrics_instrumented', False):
+            self.instrument_pool(db.engine.pool)
+
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+
+    def after_request(self, response):
+        if 'metrics_start' not in g:
+            return response
+
+        endpoint = request.endpoint or 'unknown'
+        labels = {'endpoint': endpoint, 'method': request.method}
+        self.registry.observe('warbler_http_request_duration_seconds', labels,
+                              time.perf_counter() - g.metrics_start)
+        self.registry.inc('warbler_http_requests_total',
+                          dict(labels, status=str(response.status_code)))
+        self.registry.observe('warbler_db_queries_per_request',
+                              {'endpoint': endpoint}, g.metrics_queries)
+        self.flush()
+        return response
+
+
+def cache_stats(app):
+    """Collector for the hit/miss counts of the app's caches."""
+
+    def collect():
+        caches = {}
+        if 'thumbnails' in app.extensions:
+            caches['thumbnails'] = app.extensions['thumbnails'].cache
+        if 'timeline' in app.extensions:
+            caches['timeline'] = app.extensions['timeline']
+
+        for name, cache in caches.items():
+            yield 'warbler_cache_hits_total', {'cache': name}, cache.hits
+            yield 'warbler_cache_misses_total', {'cache': name}, cache.misses
+
+    return collect
+
+
+def serve_metrics():
+    if request.remote_addr not in current_app.config['METRICS_ALLOWED_IPS']:
+        abort(404)
+
+    return Response(current_app.extensions['metrics'].render(),
+                    content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """Record metrics for `app` and serve them at /metrics."""
+
+    directory = app.config['METRICS_DIR']
+    store = (FileStore(directory)
+             if directory and FileStore.private(directory) else None)
+    metrics = Metrics(store, app.config['METRICS_FLUSH_INTERVAL'])
+    metrics.registry.add_collector(cache_stats(app))
+    app.extensions['metrics'] = metrics
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', metrics.count_query)
+
+    app.before_request(metrics.before_request)
+    app.after_request(metrics.after_request)
+    app.add_url_rule('/metrics', 'metrics', serve_metrics)
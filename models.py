@@ -4,11 +4,24 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import StaticPool
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+def dialect_insert(table):
+    """An INSERT for `table` that supports ON CONFLICT clauses on the
+    database in use (Postgres or SQLite)."""
+
+    if db.session.get_bind().dialect.name == 'sqlite':
+        return sqlite_insert(table)
+    return postgresql_insert(table)
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -26,6 +39,81 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # who a user follows, sorted (the primary key covers followers)
+        db.Index('ix_follows_user_following_id', 'user_following_id',
+                 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def follow_many(cls, follower_id, users):
+        """Make user `follower_id` follow every user matching `users`.
+
+        `users` is a filter on User, e.g. User.id.in_(ids) or
+        User.username.in_(names). Runs as one INSERT ... SELECT, skipping
+        existing follows and self-follows. Returns the number of new follows.
+        """
+
+        targets = (db.select(User.id, db.literal(follower_id))
+                   .where(users, User.id != follower_id))
+        stmt = (dialect_insert(cls.__table__)
+                .from_select(['user_being_followed_id', 'user_following_id'],
+                             targets)
+                .on_conflict_do_nothing())
+        return db.session.execute(stmt).rowcount
+
+    @classmethod
+    def unfollow_many(cls, follower_id, users):
+        """Make user `follower_id` stop following every user matching
+        `users`, in one DELETE. Returns the number of follows removed."""
+
+        stmt = (db.delete(cls)
+                .where(cls.user_following_id == follower_id,
+                       cls.user_being_followed_id.in_(
+                           db.select(User.id).where(users))))
+        return db.session.execute(stmt).rowcount
+
+    @classmethod
+    def following_ids(cls, user_id):
+        """Ids of the users `user_id` follows."""
+
+        return list(db.session.scalars(
+            db.select(cls.user_being_followed_id)
+            .where(cls.user_following_id == user_id)))
+
+    @classmethod
+    def followers_followed_by(cls, user_id, by_id):
+        """Ids of `user_id`'s followers that `by_id` follows.
+
+        With by_id == user_id these are `user_id`'s mutual follows. One
+        join of two index ranges, not a load of both follower lists.
+        """
+
+        by_follows = db.aliased(cls)
+        return list(db.session.scalars(
+            db.select(cls.user_following_id)
+            .join(by_follows, db.and_(
+                by_follows.user_following_id == by_id,
+                by_follows.user_being_followed_id == cls.user_following_id))
+            .where(cls.user_being_followed_id == user_id)
+            .order_by(cls.user_following_id)))
+
+    @classmethod
+    def following_count(cls, user_id):
+        """How many users `user_id` follows."""
+
+        return (db.session.query(db.func.count())
+                .filter(cls.user_following_id == user_id)
+                .scalar())
+
+    @classmethod
+    def followers_count(cls, user_id):
+        """How many users follow `user_id`."""
+
+        return (db.session.query(db.func.count())
+                .filter(cls.user_being_followed_id == user_id)
+                .scalar())
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -45,9 +133,60 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        # a user likes a message at most once
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_id_message_id'),
+        # like counts for a page of messages
+        db.Index('ix_likes_message_id_user_id', 'message_id', 'user_id'),
+        # likes page: a user's likes, newest first
+        db.Index('ix_likes_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    @classmethod
+    def state_query(cls, viewer_id, message_ids):
+        """Query for each of `message_ids` that has likes: (message_id,
+        like count, 1 if `viewer_id` liked it else 0)."""
+
+        if viewer_id is None:
+            liked = db.literal(0)
+        else:
+            liked = db.func.max(db.case((cls.user_id == viewer_id, 1),
+                                        else_=0))
+        return (db.select(cls.message_id, db.func.count(), liked)
+                .where(cls.message_id.in_(message_ids))
+                .group_by(cls.message_id))
+
+    @staticmethod
+    def split_state(rows):
+        """Rows of state_query as (set of liked ids, {id: like count})."""
+
+        liked = set()
+        counts = {}
+        for message_id, count, viewer_liked in rows:
+            counts[message_id] = count
+            if viewer_liked:
+                liked.add(message_id)
+        return liked, counts
+
+    @classmethod
+    def page_state(cls, viewer_id, message_ids):
+        """Like state of just the messages on a page, in one query: the set
+        of `message_ids` that `viewer_id` liked, and {id: like count}."""
+
+        if not message_ids:
+            return set(), {}
+        return cls.split_state(db.session.execute(
+            cls.state_query(viewer_id, message_ids)))
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +233,13 @@ class User(db.Model):
         nullable=False,
     )
 
+    # notifications updated after this are unread (see notifications.py);
+    # existing databases need it added: ALTER TABLE users ADD COLUMN
+    # notifications_seen_at timestamp
+    notifications_seen_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -121,13 +267,13 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
+        found_user_list = [user for user in self.followers if user.id == other_user.id]
         return len(found_user_list) == 1
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
+        found_user_list = [user for user in self.following if user.id == other_user.id]
         return len(found_user_list) == 1
 
     @classmethod
@@ -188,7 +334,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +345,249 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    __table_args__ = (
+        # timelines and profiles: an author's messages, newest first
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+
+class MessageArchive(db.Model):
+    """A compressed chunk of archived messages from one month (see
+    archive.py)."""
+
+    __tablename__ = 'message_archives'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    month = db.Column(
+        db.Date,
+        nullable=False,
+    )
+
+    first_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    last_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    data = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # finding the chunk holding a message id
+        db.Index('ix_message_archives_id_range', 'first_id', 'last_id'),
+    )
+
+
+class MessageArchiveUser(db.Model):
+    """Index of the archive chunks holding a user's messages or likes, so
+    exports and account deletion don't read every chunk."""
+
+    __tablename__ = 'message_archive_users'
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    archive_id = db.Column(
+        db.Integer,
+        db.ForeignKey('message_archives.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # False if the chunk only holds the user's likes
+    authored = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+
+class Notification(db.Model):
+    """Likes or follows for a user, aggregated per group and time bucket
+    (see notifications.py)."""
+
+    __tablename__ = 'notifications'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # "like:<message id>" or "follow": what the events are aggregated by
+    group_key = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    bucket = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # the liked message; no foreign key, since it outlives the message's
+    # move to the archive (deleting a message deletes its notifications,
+    # see notifications.message_deleted)
+    message_id = db.Column(
+        db.Integer,
+    )
+
+    last_actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='set null'),
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        # the upsert target: one row per group per bucket
+        db.UniqueConstraint('user_id', 'group_key', 'bucket',
+                            name='uq_notifications_user_id_group_key_bucket'),
+        # notifications page and unread count: a user's, newest first
+        db.Index('ix_notifications_user_id_updated_at', 'user_id',
+                 'updated_at', 'id'),
+    )
+
+
+class ShardBucket(db.Model):
+    """Which shard database holds the messages and likes of the users in a
+    bucket (see sharding.py)."""
+
+    __tablename__ = 'shard_buckets'
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class MessageOwner(db.Model):
+    """Id allocation and author of a message stored on a shard (see
+    sharding.py)."""
+
+    __tablename__ = 'message_owners'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+
+# Full-text search support for messages (see search.py).
+#
+# Postgres: a GIN index over the tsvector of the message text, kept up to
+# date by the database itself.
+# SQLite: an FTS5 table keyed by message id; rows are added/removed from the
+# message views, and `flask reindex-messages` rebuilds it.
+
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_messages_text_search ON messages "
+        "USING gin (to_tsvector('english', text))"
+        ).execute_if(dialect='postgresql'),
+)
+
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text)"
+        ).execute_if(dialect='sqlite'),
+)
+
+event.listen(
+    Message.__table__,
+    'before_drop',
+    DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect='sqlite'),
+)
+
+
+# SQLite tuning, applied to every new connection: WAL so readers don't block
+# the writer, NORMAL sync (safe in WAL; fsync only at checkpoints), memory-
+# mapped reads, and a busy timeout so concurrent writers wait, not fail.
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply SQLITE_PRAGMAS to a new SQLite connection."""
+
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def sqlite_engine_options(uri):
+    """Engine options for a SQLite database shared by worker threads."""
+
+    options = {
+        'connect_args': {
+            'check_same_thread': False,
+            'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000,
+        },
+    }
+
+    # an in-memory database only exists on its one connection
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        options['poolclass'] = StaticPool
+
+    return options
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -206,5 +595,15 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('sqlite'):
+        options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        for key, value in sqlite_engine_options(uri).items():
+            options.setdefault(key, value)
+
     db.app = app
     db.init_app(app)
+
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', set_sqlite_pragmas)
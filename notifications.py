@@ -0,0 +1,198 @@
+"""Like and follow notifications, aggregated as they're written.
+
+Rather than a row per event, each like or follow is an upsert into the
+row for its group -- the liked message, or "follow" -- and time bucket
+(NOTIFICATION_BUCKET_HOURS long), bumping its count, last actor and
+updated_at. So a message liked ten thousand times in a day is one row,
+shown as "X and 9999 others liked your warble", and a viral message
+makes one row per bucket it stays busy for.
+
+Counts are of events, not people: unliking and liking again counts twice.
+
+A user's notifications updated since `User.notifications_seen_at` are
+unread. The navbar badge counts them with one range read of the
+(user_id, updated_at) index, stopping at UNREAD_MAX.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app, g
+from sqlalchemy import tuple_
+
+from models import db, dialect_insert, Message, Notification, User
+import archive
+import sharding
+
+PAGE_SIZE = 20
+UNREAD_MAX = 99
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_start(when, hours):
+    """Start of the `hours`-long bucket holding `when`."""
+
+    size = hours * 3600
+    seconds = (when - EPOCH).total_seconds()
+    return EPOCH + timedelta(seconds=seconds // size * size)
+
+
+def record(user_id, kind, group_key, actor_id, message_id=None, now=None,
+           count=1):
+    """Add `count` events to `user_id`'s notification for `group_key` in
+    the current bucket, in one upsert. The caller commits."""
+
+    now = now or datetime.utcnow()
+    table = Notification.__table__
+    stmt = dialect_insert(table).values(
+        user_id=user_id, kind=kind, group_key=group_key,
+        bucket=bucket_start(now,
+                            current_app.config['NOTIFICATION_BUCKET_HOURS']),
+        message_id=message_id, last_actor_id=actor_id, count=count,
+        updated_at=now)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.group_key, table.c.bucket],
+        set_={'count': table.c.count + stmt.excluded.count,
+              'last_actor_id': stmt.excluded.last_actor_id,
+              'updated_at': stmt.excluded.updated_at})
+    db.session.execute(stmt)
+
+
+def record_like(message, actor):
+    """Notify `message`'s author that `actor` liked it."""
+
+    # a sharded message isn't in this database to reference
+    record(message.user_id, 'like', f"like:{message.id}", actor.id,
+           message_id=None if sharding.enabled() else message.id)
+
+
+def record_follow(user_id, actor):
+    """Notify user `user_id` that `actor` followed them."""
+
+    record(user_id, 'follow', 'follow', actor.id)
+
+
+def message_deleted(message):
+    """Drop the notifications about a deleted message. The caller
+    commits."""
+
+    db.session.execute(
+        db.delete(Notification)
+        .where(Notification.user_id == message.user_id,
+               Notification.group_key == f"like:{message.id}"))
+
+
+def unread_count(user):
+    """How many of `user`'s notifications are unread, up to UNREAD_MAX + 1."""
+
+    unread = (db.select(db.literal(1))
+              .where(Notification.user_id == user.id))
+    if user.notifications_seen_at is not None:
+        unread = unread.where(
+            Notification.updated_at > user.notifications_seen_at)
+    return db.session.scalar(
+        db.select(db.func.count())
+        .select_from(unread.limit(UNREAD_MAX + 1).subquery()))
+
+
+def unread_badge():
+    """The logged-in user's unread count for the navbar: '' for none,
+    '99+' past UNREAD_MAX."""
+
+    if not g.get('user'):
+        return ''
+
+    # once per request, however often the template asks
+    if 'unread_notifications' not in g:
+        g.unread_notifications = unread_count(g.user)
+    count = g.unread_notifications
+    if not count:
+        return ''
+    return f"{UNREAD_MAX}+" if count > UNREAD_MAX else str(count)
+
+
+def page(user_id, before='', size=PAGE_SIZE):
+    """A page of `user_id`'s notifications, most recently updated first,
+    with the last actor and liked message's text: (rows, cursor of the
+    next page or None).
+
+    `before` is the "<updated_at>_<id>" cursor of the previous page's last
+    row. Returns None for a malformed cursor.
+    """
+
+    actor = db.aliased(User)
+    query = (db.select(Notification.id,
+                       Notification.kind,
+                       Notification.group_key,
+                       Notification.message_id,
+                       Notification.count,
+                       Notification.updated_at,
+                       actor.id.label('actor_id'),
+                       actor.username.label('actor_username'),
+                       actor.image_url.label('actor_image_url'),
+                       Message.text.label('message_text'))
+             .outerjoin(actor, actor.id == Notification.last_actor_id)
+             .outerjoin(Message, Message.id == Notification.message_id)
+             .where(Notification.user_id == user_id))
+
+    updated_at, _, notification_id = before.rpartition('_')
+    if updated_at and notification_id.isdigit():
+        try:
+            updated_at = datetime.fromisoformat(updated_at)
+        except ValueError:
+            return None
+        query = query.where(tuple_(Notification.updated_at, Notification.id)
+                            < (updated_at, int(notification_id)))
+
+    rows = db.session.execute(
+        query.order_by(Notification.updated_at.desc(), Notification.id.desc())
+        .limit(size + 1)).all()
+
+    next_page = None
+    if len(rows) > size:
+        rows = rows[:size]
+        last = rows[-1]
+        next_page = f"{last.updated_at.isoformat()}_{last.id}"
+    return with_archived_text(rows), next_page
+
+
+def with_archived_text(rows):
+    """`rows` with the text of liked messages that have since been
+    archived filled in from the archive."""
+
+    archived = {row.message_id for row in rows
+                if row.message_id is not None and row.message_text is None}
+    if not archived:
+        return rows
+
+    texts = {}
+    for message_id in archived:
+        record = archive.find_record(
+            db.session.scalars(archive.chunks_holding(message_id)),
+            message_id)
+        if record is not None:
+            texts[message_id] = record[3]
+    # rows are immutable: copy them, the archived texts filled in
+    Row = namedtuple('NotificationRow', rows[0]._fields)
+    return [Row(*row)._replace(message_text=texts.get(row.message_id,
+                                                      row.message_text))
+            for row in rows]
+
+
+def mark_seen(user, now=None):
+    """Mark all of `user`'s notifications read. The caller commits."""
+
+    user.notifications_seen_at = now or datetime.utcnow()
+
+
+def forget_unread():
+    # g outlives a request when an app context was already pushed (tests,
+    # scripts)
+    g.pop('unread_notifications', None)
+
+
+def init_app(app):
+    """Register the navbar's unread badge helper."""
+
+    app.before_request(forget_unread)
+    app.add_template_global(unread_badge, 'unread_notifications')
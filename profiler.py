@@ -0,0 +1,197 @@
+"""Opt-in profiling of live requests.
+
+A request is profiled when either:
+
+- it carries `?__profile=<PROFILER_TOKEN>`, or
+- it is randomly sampled at PROFILER_SAMPLE_RATE (0..1), optionally only
+  for the endpoints in PROFILER_ENDPOINTS (e.g. "homepage,list_users").
+
+Profiles are written to PROFILER_DIR, and the response gets an
+X-Profile header naming the file. Two modes (PROFILER_MODE):
+
+- 'sample' (default): a background thread samples the request thread's
+  stack every PROFILER_INTERVAL seconds, writing collapsed stacks
+  (`.folded`, for flamegraph.pl / speedscope) and speedscope JSON.
+- 'deterministic': cProfile, writing a `.prof` pstats file.
+
+With no token and a zero sample rate the middleware is a single attribute
+check per request.
+"""
+
+import cProfile
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import ClosingIterator
+
+QUERY_FLAG = '__profile'
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='profiler-sampler')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename,
+                              code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def collapsed(self):
+        """Brendan Gregg's collapsed-stack format, one stack per line."""
+
+        lines = []
+        for stack, count in self.stacks.most_common():
+            frames = ";".join(f"{name} ({os.path.basename(filename)}:{line})"
+                              for name, filename, line in stack)
+            lines.append(f"{frames} {count}\n")
+        return "".join(lines)
+
+    def speedscope(self, name):
+        """A speedscope 'sampled' profile, as a JSON-able dict."""
+
+        frames = []
+        frame_index = {}
+        samples = []
+        weights = []
+        interval_ms = self.interval * 1000
+
+        for stack, count in self.stacks.items():
+            sample = []
+            for frame in stack:
+                if frame not in frame_index:
+                    frame_index[frame] = len(frames)
+                    frames.append({'name': frame[0], 'file': frame[1],
+                                   'line': frame[2]})
+                sample.append(frame_index[frame])
+            samples.append(sample)
+            weights.append(count * interval_ms)
+
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'warbler',
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': name,
+                'unit': 'milliseconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': samples,
+                'weights': weights,
+            }],
+        }
+
+
+class ProfilerMiddleware:
+    """WSGI middleware profiling selected requests to `flask_app`."""
+
+    def __init__(self, wsgi_app, flask_app):
+        config = flask_app.config
+        self.wsgi_app = wsgi_app
+        self.flask_app = flask_app
+        self.token = config['PROFILER_TOKEN']
+        self.sample_rate = config['PROFILER_SAMPLE_RATE']
+        self.endpoints = set(config['PROFILER_ENDPOINTS'])
+        self.mode = config['PROFILER_MODE']
+        self.interval = config['PROFILER_INTERVAL']
+        self.directory = config['PROFILER_DIR']
+        self.enabled = bool(self.token) or self.sample_rate > 0
+
+    def endpoint(self, environ):
+        try:
+            adapter = self.flask_app.url_map.bind_to_environ(environ)
+            return adapter.match()[0]
+        except HTTPException:
+            return None
+
+    def should_profile(self, environ):
+        query = environ.get('QUERY_STRING', '')
+        if self.token and QUERY_FLAG in query:
+            given = parse_qs(query).get(QUERY_FLAG, [''])[0]
+            # as bytes: compare_digest refuses non-ASCII str
+            if hmac.compare_digest(given.encode(), self.token.encode()):
+                return True
+
+        if self.sample_rate and random.random() < self.sample_rate:
+            return not self.endpoints or self.endpoint(environ) in self.endpoints
+
+        return False
+
+    def __call__(self, environ, start_response):
+        if not self.enabled or not self.should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+
+        name = "{}-{}-{}".format(
+            time.strftime('%Y%m%dT%H%M%S'),
+            self.endpoint(environ) or 'unknown',
+            f"{os.getpid()}-{threading.get_ident()}")
+        path = os.path.join(self.directory, name)
+        os.makedirs(self.directory, exist_ok=True)
+
+        def start_profiled_response(status, headers, exc_info=None):
+            headers = list(headers) + [('X-Profile', name)]
+            return start_response(status, headers, exc_info)
+
+        if self.mode == 'deterministic':
+            profile = cProfile.Profile()
+            profile.enable()
+
+            def finish():
+                profile.disable()
+                profile.dump_stats(path + '.prof')
+        else:
+            sampler = StackSampler(threading.get_ident(), self.interval)
+            sampler.start()
+
+            def finish():
+                sampler.stop()
+                with open(path + '.folded', 'w') as f:
+                    f.write(sampler.collapsed())
+                with open(path + '.speedscope.json', 'w') as f:
+                    json.dump(sampler.speedscope(name), f)
+
+        try:
+            app_iter = self.wsgi_app(environ, start_profiled_response)
+        except BaseException:
+            finish()
+            raise
+
+        # stop once the response body has been sent, so streamed bodies
+        # are profiled too
+        return ClosingIterator(app_iter, [finish])
+
+
+def init_app(app):
+    """Wrap `app` in the profiler middleware, per the PROFILER_* config."""
+
+    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app)
@@ -0,0 +1,234 @@
+"""Token-bucket rate limiting for Warbler routes.
+
+Each rule gives a route a bucket of `capacity` tokens per client, refilled
+at `capacity / period` tokens a second; a request takes one token or gets
+a 429 with Retry-After. Clients are keyed by IP, by logged-in user, or
+(for login) by the username being tried from an IP: a tighter limit on
+guessing one account's password than the per-IP one, which no one else
+can use to lock that account out.
+
+IP keys are request.remote_addr. Behind a reverse proxy or load balancer
+that is the proxy's address, and every client would share one bucket:
+set TRUSTED_PROXIES to the number of proxies in front of the app, and
+the client address is taken from X-Forwarded-For (see app.py). Only do
+so if those proxies set the header; otherwise clients can forge it.
+
+Buckets live in a backend:
+
+- MemoryBackend: a dict in this process. Cheapest; limits are per worker.
+- SQLiteBackend: a small SQLite file shared by every worker on the box
+  (e.g. all gunicorn workers), so limits hold across the node.
+
+A bucket that has refilled is the same as no bucket, so both drop those
+every SWEEP_INTERVAL seconds and only hold recently limited clients.
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from werkzeug.exceptions import TooManyRequests
+
+Limit = namedtuple('Limit', ['scope', 'capacity', 'period', 'methods'],
+                   defaults=[('POST',)])
+Limit.__doc__ = """Allow `capacity` requests per `period` seconds per
+`scope` ('ip', 'user' or 'username', which is per username and IP),
+counting only `methods`."""
+
+# endpoint -> limits; login/signup are bcrypt-heavy, so keyed by IP too,
+# and logins by the username tried (from that IP)
+DEFAULT_RULES = {
+    'login': [Limit('ip', 10, 60), Limit('username', 10, 600)],
+    'signup': [Limit('ip', 5, 60)],
+    'messages_add': [Limit('user', 30, 60), Limit('ip', 120, 60)],
+    'add_like': [Limit('user', 60, 60), Limit('ip', 240, 60)],
+    # called as users type; keeps username/email probing slow
+    'check_available': [Limit('ip', 60, 60, ('GET',))],
+}
+
+SWEEP_INTERVAL = 60
+
+
+class MemoryBackend:
+    """Token buckets in a dict, for a single process."""
+
+    def __init__(self):
+        # key -> (tokens, updated, when it's full again)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.swept = None
+
+    def take(self, key, capacity, rate, now):
+        """Take a token from bucket `key`.
+
+        Returns 0 if allowed, else seconds until a token is available.
+        """
+
+        with self.lock:
+            self.sweep(now)
+            tokens, updated, _ = self.buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+
+            self.buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            return wait
+
+    def sweep(self, now):
+        """Drop the buckets that have refilled, every SWEEP_INTERVAL."""
+
+        if self.swept is not None and now - self.swept < SWEEP_INTERVAL:
+            return
+        self.swept = now
+        for key in [key for key, (_, _, full_at) in self.buckets.items()
+                    if full_at <= now]:
+            del self.buckets[key]
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class SQLiteBackend:
+    """Token buckets in a SQLite file shared between worker processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.swept = None
+        with self.connect() as conn:
+            # the old table, without full_at; its buckets can go
+            conn.execute("DROP TABLE IF EXISTS buckets")
+            conn.execute("CREATE TABLE IF NOT EXISTS token_buckets ("
+                         "key TEXT PRIMARY KEY, tokens REAL, updated REAL, "
+                         "full_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_token_buckets_full_at "
+                         "ON token_buckets (full_at)")
+
+    def connect(self):
+        """This thread's connection (workers may run many threads).
+
+        Connections aren't shared across fork(): a worker forked from a
+        preloaded app opens its own.
+        """
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def take(self, key, capacity, rate, now):
+        """Take a token from bucket `key`.
+
+        Returns 0 if allowed, else seconds until a token is available.
+        """
+
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.swept is None or now - self.swept >= SWEEP_INTERVAL:
+                # buckets that have refilled, from every worker
+                conn.execute("DELETE FROM token_buckets WHERE full_at <= ?",
+                             (now,))
+                self.swept = now
+
+            row = conn.execute("SELECT tokens, updated FROM token_buckets "
+                               "WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+
+            conn.execute("INSERT OR REPLACE INTO token_buckets "
+                         "VALUES (?, ?, ?, ?)",
+                         (key, tokens, now, now + (capacity - tokens) / rate))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def reset(self):
+        self.connect().execute("DELETE FROM token_buckets")
+
+
+def make_backend(uri):
+    """Backend from a config string: 'memory' or 'sqlite:///path'."""
+
+    if uri == 'memory':
+        return MemoryBackend()
+    if uri.startswith('sqlite:///'):
+        return SQLiteBackend(uri[len('sqlite:///'):])
+    raise ValueError(f"Unknown rate limit backend: {uri}")
+
+
+class RateLimiter:
+    """Applies per-route rules against a bucket backend."""
+
+    def __init__(self, rules=None, backend=None, clock=time.time):
+        self.rules = DEFAULT_RULES if rules is None else rules
+        self.backend = backend or MemoryBackend()
+        self.clock = clock
+
+    def check(self, endpoint, method, ip, user_id, username=None):
+        """Take a token for every rule on `endpoint`; `username` is the one
+        a login form was submitted with.
+
+        Raises TooManyRequests (429, with Retry-After) if any bucket is empty.
+        """
+
+        limits = self.rules.get(endpoint)
+        if not limits:
+            return
+
+        now = self.clock()
+        wait = 0
+
+        for limit in limits:
+            if method not in limit.methods:
+                continue
+
+            if limit.scope == 'user':
+                if user_id is None:
+                    continue
+                who = user_id
+            elif limit.scope == 'username':
+                if not username:
+                    continue
+                who = f"{ip}:{username}"
+            else:
+                who = ip
+
+            key = f"{endpoint}:{limit.scope}:{who}"
+            rate = limit.capacity / limit.period
+            wait = max(wait, self.backend.take(key, limit.capacity, rate, now))
+
+        if wait:
+            raise TooManyRequests(retry_after=math.ceil(wait))
+
+    def needs_username(self, endpoint):
+        """Whether `endpoint` has a rule keyed by the submitted username
+        (so other requests' bodies needn't be parsed for one)."""
+
+        return any(limit.scope == 'username'
+                   for limit in self.rules.get(endpoint, ()))
+
+    def reset(self):
+        self.backend.reset()
@@ -0,0 +1,289 @@
+"""Replay captured traffic (see capture.py) against another instance.
+
+`flask replay-traffic` re-issues a capture log against --target at the
+captured pace (--speed 1), faster (--speed 10) or as fast as it will go
+(--speed max), and writes the latency of every request to a results file;
+`flask compare-replays` shows how the latency of each route moved between
+two such files, e.g. of the current and the next build on staging.
+
+The concurrency of the original is kept rather than invented:
+
+- each sender's requests are issued in order, one at a time, as from a
+  browser -- a request waits for its sender's previous one to finish;
+- across senders, requests start at their captured offsets divided by
+  the speed (all at once at max speed);
+- at most --concurrency requests are outstanding, by default the most
+  that were in flight at once in the capture (times the speed).
+
+Senders are replayed as target users 1..--users (a pseudonym always maps
+to the same one) with session cookies signed by this app's SECRET_KEY,
+which must match the target's. Form fields, and query string values
+captured as lengths, are sent as placeholders of those lengths, with a
+valid CSRF token; so writes happen on the target, but logins and signups
+fail.
+"""
+
+import heapq
+import http.client
+import itertools
+import json
+import math
+import re
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode, urlsplit
+
+from flask import session
+from flask_wtf.csrf import generate_csrf
+
+Result = namedtuple('Result', 'route status latency_ms original_ms')
+
+RULE_ARGUMENT = re.compile(r"<(?:[^:<>]+:)?(\w+)>")
+
+
+def route(entry):
+    """'METHOD /rule' of a captured request, e.g.
+    'GET /users/<int:user_id>'."""
+
+    return f"{entry['method']} {entry['rule']}"
+
+
+def path(entry):
+    """The URL path and query string of a captured request."""
+
+    url = RULE_ARGUMENT.sub(
+        lambda match: quote(str(entry['view_args'][match[1]]), safe=''),
+        entry['rule'])
+    if entry['args']:
+        url += '?' + urlencode({
+            name: 'x' * value if isinstance(value, int) else value
+            for name, value in entry['args'].items()})
+    return url
+
+
+def peak_concurrency(entries):
+    """Most captured requests in flight at once."""
+
+    events = []
+    for entry in entries:
+        events.append((entry['time'], 1))
+        events.append((entry['time'] + entry['duration_ms'] / 1000, -1))
+    # ends before starts at the same instant
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    peak = in_flight = 0
+    for _, change in events:
+        in_flight += change
+        peak = max(peak, in_flight)
+    return peak
+
+
+class Sessions:
+    """Session cookies and CSRF tokens for replayed senders."""
+
+    def __init__(self, app, user_key, users):
+        self.app = app
+        self.user_key = user_key
+        self.users = users
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def user_id(self, who):
+        """Target user id of a sender, or None for anonymous senders."""
+
+        if not who.startswith('u'):
+            return None
+        return int(who[1:], 16) % self.users + 1
+
+    def get(self, who):
+        """(cookie header, CSRF token) for `who`."""
+
+        user_id = self.user_id(who)
+        with self.lock:
+            if user_id not in self.cache:
+                # a fresh app context, so the CSRF token isn't cached in g
+                with self.app.app_context(), \
+                        self.app.test_request_context():
+                    if user_id is not None:
+                        session[self.user_key] = user_id
+                    token = generate_csrf()
+                    serializer = (self.app.session_interface
+                                  .get_signing_serializer(self.app))
+                    cookie = "{}={}".format(
+                        self.app.config['SESSION_COOKIE_NAME'],
+                        serializer.dumps(dict(session)))
+                self.cache[user_id] = (cookie, token)
+            return self.cache[user_id]
+
+
+class HTTPSender:
+    """Sends captured requests to `target`, one connection per thread."""
+
+    def __init__(self, target, sessions, timeout=30):
+        url = urlsplit(target)
+        self.connection_class = (http.client.HTTPSConnection
+                                 if url.scheme == 'https'
+                                 else http.client.HTTPConnection)
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.sessions = sessions
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = self.connection_class(
+                self.netloc, timeout=self.timeout)
+        return self.local.connection
+
+    def __call__(self, entry):
+        cookie, token = self.sessions.get(entry['who'])
+        headers = {'Cookie': cookie}
+        body = None
+        if entry['form']:
+            body = urlencode({
+                name: token if name == 'csrf_token' else 'x' * length
+                for name, length in entry['form'].items()})
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        start = time.perf_counter()
+        try:
+            conn = self.connection()
+            conn.request(entry['method'], self.prefix + path(entry),
+                         body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            self.local.connection = None
+            status = None
+        return Result(route(entry), status,
+                      round((time.perf_counter() - start) * 1000, 2),
+                      entry['duration_ms'])
+
+
+def replay(entries, send, speed=1.0, concurrency=None):
+    """Issue `entries` (captured requests in start order) with
+    `send(entry)`, which returns a Result; `speed` None is max speed.
+    Returns the Results, in completion order."""
+
+    if not entries:
+        return []
+    if concurrency is None:
+        concurrency = max(1, math.ceil(peak_concurrency(entries)
+                                       * (speed or 1)))
+
+    first = entries[0]['time']
+    senders = {}
+    for entry in entries:
+        senders.setdefault(entry['who'], deque()).append(entry)
+
+    def due(entry):
+        return 0 if speed is None else (entry['time'] - first) / speed
+
+    order = itertools.count()
+    # (seconds from the start, tie breaker, sender) of each sender's next
+    # request, once its previous one is done
+    ready = [(due(queue[0]), next(order), who)
+             for who, queue in senders.items()]
+    heapq.heapify(ready)
+
+    cond = threading.Condition()
+    results = []
+    outstanding = 0
+
+    def run(who, entry):
+        nonlocal outstanding
+        result = None
+        try:
+            result = send(entry)
+        finally:
+            with cond:
+                if result is not None:
+                    results.append(result)
+                queue = senders[who]
+                queue.popleft()
+                if queue:
+                    heapq.heappush(ready, (due(queue[0]), next(order), who))
+                outstanding -= 1
+                cond.notify()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        with cond:
+            while ready or outstanding:
+                if not ready or outstanding >= concurrency:
+                    cond.wait()
+                    continue
+                wait = start + ready[0][0] - time.perf_counter()
+                if wait > 0:
+                    cond.wait(wait)
+                    continue
+                _, _, who = heapq.heappop(ready)
+                outstanding += 1
+                executor.submit(run, who, senders[who][0])
+    return results
+
+
+def save(results, f, **info):
+    json.dump(dict(info, results=[list(result) for result in results]), f)
+
+
+def load(f):
+    """Results from a file written by `save`."""
+
+    return [Result(*row) for row in json.load(f)['results']]
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(results, latency='latency_ms'):
+    """{route: (count, errors, p50 ms, p95 ms)} of `results`; errors are
+    5xx statuses and failed connections."""
+
+    by_route = {}
+    for result in results:
+        by_route.setdefault(result.route, []).append(result)
+
+    summary = {}
+    for name, group in by_route.items():
+        latencies = sorted(getattr(result, latency) for result in group)
+        errors = sum(1 for result in group
+                     if result.status is None or result.status >= 500)
+        summary[name] = (len(group), errors, percentile(latencies, 0.5),
+                         percentile(latencies, 0.95))
+    return summary
+
+
+def compare(before, after):
+    """Per route, most requested first: (route, count, errors before,
+    errors after, p50 before, p50 after, p95 before, p95 after), from two
+    `summarize` results."""
+
+    def count(name):
+        return before.get(name, after.get(name))[0]
+
+    rows = []
+    for name in sorted(set(before) | set(after), key=count, reverse=True):
+        count, errors_before, p50_before, p95_before = before.get(
+            name, (0, 0, None, None))
+        count_after, errors_after, p50_after, p95_after = after.get(
+            name, (0, 0, None, None))
+        rows.append((name, max(count, count_after), errors_before,
+                     errors_after, p50_before, p50_after, p95_before,
+                     p95_after))
+    return rows
+
+
+def delta(before, after):
+    """'+12.3%' or the like; '' if either side is missing."""
+
+    if before is None or after is None:
+        return ''
+    if before == 0:
+        return 'n/a'
+    return f"{(after - before) / before * 100:+.1f}%"
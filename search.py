@@ -0,0 +1,202 @@
+"""Full-text search over messages.
+
+On Postgres this uses the GIN index over `to_tsvector(text)` (see models.py)
+and ranks with `ts_rank_cd`. On SQLite it uses the `messages_fts` FTS5 table
+and ranks with `bm25`.
+
+Results are ordered by (score desc, id desc) and paginated with an opaque
+cursor holding the last (score, id) seen, so deep pages cost the same as
+the first one.
+"""
+
+import base64
+import json
+import math
+import re
+
+from sqlalchemy import and_, cast, column, func, or_, select, table, text
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+from sqlalchemy.orm import joinedload
+
+from models import db, Message
+
+SEARCH_CONFIG = 'english'
+PAGE_SIZE = 20
+REINDEX_BATCH_SIZE = 1000
+
+messages_fts = table('messages_fts', column('rowid'), column('text'))
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def is_sqlite():
+    """Is the app's database SQLite?"""
+
+    return db.engine.dialect.name == 'sqlite'
+
+
+def encode_cursor(score, message_id):
+    """Turn the last (score, id) of a page into an opaque cursor string."""
+
+    raw = json.dumps([score, message_id]).encode('UTF-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor string back into (score, id), or None if invalid."""
+
+    try:
+        score, message_id = json.loads(base64.urlsafe_b64decode(cursor))
+        score, message_id = float(score), int(message_id)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    if not math.isfinite(score):
+        return None
+    return score, message_id
+
+
+def fts5_query(q):
+    """Turn free text into a safe FTS5 query: every word, quoted, AND-ed."""
+
+    return " ".join(f'"{word}"' for word in WORD_RE.findall(q))
+
+
+def search_messages(q, cursor=None, limit=PAGE_SIZE):
+    """Find messages matching `q`, best matches first.
+
+    Returns (messages, next_cursor); next_cursor is None on the last page.
+    """
+
+    if is_sqlite():
+        match = fts5_query(q)
+        if not match:
+            return [], None
+        score = -func.bm25(text('messages_fts'))
+        stmt = (select(Message, score.label('score'))
+                .join(messages_fts, messages_fts.c.rowid == Message.id)
+                .where(text('messages_fts MATCH :match')
+                       .bindparams(match=match)))
+    else:
+        if not WORD_RE.search(q):
+            return [], None
+        query = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+        vector = func.to_tsvector(SEARCH_CONFIG, Message.text)
+        # ts_rank_cd is float4: as float8, the score round-trips exactly
+        # through the cursor, so ties at a page boundary compare equal
+        score = cast(func.ts_rank_cd(vector, query), DOUBLE_PRECISION)
+        stmt = (select(Message, score.label('score'))
+                .where(vector.op('@@')(query)))
+
+    after = decode_cursor(cursor) if cursor else None
+    if after:
+        last_score, last_id = after
+        stmt = stmt.where(or_(score < last_score,
+                              and_(score == last_score,
+                                   Message.id < last_id)))
+
+    stmt = (stmt
+            .options(joinedload(Message.user))
+            .order_by(score.desc(), Message.id.desc())
+            .limit(limit + 1))
+
+    rows = db.session.execute(stmt).all()
+    messages = [row.Message for row in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last.score, last.Message.id)
+
+    return messages, next_cursor
+
+
+def index_message(msg):
+    """Add a new (flushed) message to the search index.
+
+    Postgres maintains its index itself; this only matters for SQLite.
+    """
+
+    if is_sqlite():
+        # rowids can be reused after deletes outside the views; replace
+        # rather than trip over a stale index row.
+        unindex_message(msg)
+        db.session.execute(
+            text("INSERT INTO messages_fts(rowid, text) VALUES (:id, :text)"),
+            {"id": msg.id, "text": msg.text})
+
+
+def unindex_message(msg):
+    """Remove a message from the search index."""
+
+    if is_sqlite():
+        db.session.execute(
+            text("DELETE FROM messages_fts WHERE rowid = :id"),
+            {"id": msg.id})
+
+
+def unindex_messages(message_ids):
+    """Remove messages from the search index by id, in one statement."""
+
+    if is_sqlite() and message_ids:
+        db.session.execute(
+            messages_fts.delete().where(messages_fts.c.rowid.in_(message_ids)))
+
+
+def rebuild_postgres_index():
+    """Create the GIN index if it's missing (it's only created along with
+    the messages table), else rebuild it, without blocking writes."""
+
+    # CONCURRENTLY can't run inside a transaction
+    with db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as conn:
+        exists = conn.scalar(text(
+            "SELECT to_regclass('ix_messages_text_search') IS NOT NULL"))
+        if exists:
+            # also repairs an index left invalid by a failed CREATE
+            conn.execute(text(
+                "REINDEX INDEX CONCURRENTLY ix_messages_text_search"))
+        else:
+            conn.execute(text(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                "ix_messages_text_search ON messages "
+                f"USING gin (to_tsvector('{SEARCH_CONFIG}', text))"))
+
+
+def reindex_messages(batch_size=REINDEX_BATCH_SIZE):
+    """Rebuild the search index from the messages table.
+
+    On SQLite, clears the FTS table and streams messages back in, in id
+    order, `batch_size` rows at a time; yields the running row count after
+    each batch. On Postgres the GIN index is built by one statement, which
+    can't be batched; it runs CONCURRENTLY instead, so writes go on.
+    """
+
+    if not is_sqlite():
+        db.session.commit()
+        rebuild_postgres_index()
+        yield db.session.query(func.count(Message.id)).scalar()
+        return
+
+    db.session.execute(text("DELETE FROM messages_fts"))
+
+    done = 0
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            select(Message.id, Message.text)
+            .where(Message.id > last_id)
+            .order_by(Message.id)
+            .limit(batch_size)).all()
+        if not batch:
+            break
+
+        db.session.execute(
+            text("INSERT INTO messages_fts(rowid, text) VALUES (:id, :text)"),
+            [{"id": row.id, "text": row.text} for row in batch])
+        db.session.commit()
+
+        last_id = batch[-1].id
+        done += len(batch)
+        yield done
+
+    db.session.commit()
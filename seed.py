@@ -1,20 +1,34 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
+from datetime import datetime
+from app import app, db
 from models import User, Message, Follows
+import search
 
 
-db.drop_all()
-db.create_all()
+def read_messages(messages):
+    """Message rows with timestamps parsed (SQLite won't take strings)."""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    for row in DictReader(messages):
+        row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+        yield row
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+with app.app_context():
+    db.drop_all()
+    db.create_all()
 
-db.session.commit()
+    with open('generator/users.csv') as users:
+        db.session.bulk_insert_mappings(User, DictReader(users))
+
+    with open('generator/messages.csv') as messages:
+        db.session.bulk_insert_mappings(Message, read_messages(messages))
+
+    with open('generator/follows.csv') as follows:
+        db.session.bulk_insert_mappings(Follows, DictReader(follows))
+
+    db.session.commit()
+
+    for _ in search.reindex_messages():
+        pass
@@ -0,0 +1,634 @@
+"""Horizontal sharding of messages and likes by user id.
+
+With SHARD_DATABASE_URLS set (comma-separated database URLs, SQLite or
+Postgres), messages and likes no longer live in the main database but are
+spread over those shard databases by author:
+
+- each user id falls in one of BUCKETS virtual buckets (id % BUCKETS);
+- `shard_buckets`, in the main database, says which shard holds each
+  bucket. Workers cache it, rereading it every SHARD_MAP_REFRESH seconds;
+- a message's likes live on its author's shard, next to the message, so
+  like counts and the likes page join locally.
+
+Users, follows and notifications stay in the main database. Message ids
+stay global: `message_owners` (main database) allocates them and records
+each message's author, so /messages/<id> finds its shard.
+
+A single author's messages (`users_show`) are one query on one shard. A
+multi-author read (the home timeline) groups the authors by shard, queries
+those shards in parallel and merges their newest-first results on
+timestamp. Like state for a page goes to the shards of the page's authors;
+a user's likes page and like count go to every shard. So does a user's
+data export for their likes; their messages come from their own shard.
+The live timeline's reconnect backfill reads the followed authors' shards.
+
+`flask rebalance-shards` evens out the buckets -- after adding a shard URL,
+or with --drain to empty shards before removing their URLs. Each bucket is
+copied, switched over in the map, copied again (after SHARD_MAP_REFRESH,
+to pick up writes from workers still on the old map) and then deleted
+from its old shard. Unlikes and deletes made on the old shard during that
+window can come back.
+
+Search, the archive, the cache timeline engine and WARBLER_ASYNC read
+messages from the main database and aren't supported with shards.
+"""
+
+import heapq
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from itertools import chain, islice
+
+from flask import current_app
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer,
+                        MetaData, String, Table, UniqueConstraint,
+                        create_engine, delete, event, func, select, tuple_,
+                        update)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import (db, set_sqlite_pragmas, sqlite_engine_options, Likes,
+                    Message, MessageOwner, ShardBucket, User)
+
+BUCKETS = 256
+COPY_BATCH = 1000
+USER_BATCH = 500
+
+# The shard schema: the main database's messages and likes tables, minus
+# the foreign keys to users, which live elsewhere.
+metadata = MetaData()
+
+messages = Table(
+    'messages', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('text', String(140), nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('user_id', Integer, nullable=False),
+    Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+)
+
+likes = Table(
+    'likes', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer),
+    Column('message_id', Integer,
+           ForeignKey('messages.id', ondelete='cascade')),
+    Column('timestamp', DateTime, nullable=False),
+    UniqueConstraint('user_id', 'message_id',
+                     name='uq_likes_user_id_message_id'),
+    Index('ix_likes_message_id_user_id', 'message_id', 'user_id'),
+    Index('ix_likes_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+)
+
+LikedMessage = namedtuple('LikedMessage', [
+    'like_id', 'liked_at', 'id', 'text', 'timestamp', 'author_id',
+    'author_username', 'author_image_url'])
+
+
+def bucket_of(user_id):
+    return user_id % BUCKETS
+
+
+def make_engine(url):
+    if url.startswith('sqlite'):
+        engine = create_engine(url, **sqlite_engine_options(url))
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+        return engine
+    return create_engine(url)
+
+
+def insert_ignore(engine, table):
+    """INSERT into `table` skipping rows that are already there."""
+
+    if engine.dialect.name == 'sqlite':
+        return sqlite_insert(table).on_conflict_do_nothing()
+    return postgresql_insert(table).on_conflict_do_nothing()
+
+
+class Shards:
+    """The shard databases, and the map of buckets to them."""
+
+    def __init__(self, urls, map_refresh=5, clock=time.monotonic):
+        self.engines = [make_engine(url) for url in urls]
+        self.sessions = [sessionmaker(engine, expire_on_commit=False)
+                         for engine in self.engines]
+        self.executor = ThreadPoolExecutor(len(urls),
+                                           thread_name_prefix='warbler-shard')
+        self.map_refresh = map_refresh
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.buckets = None
+        self.loaded_at = 0
+
+    def __len__(self):
+        return len(self.engines)
+
+    def create_all(self):
+        for engine in self.engines:
+            metadata.create_all(engine)
+
+    def after_fork(self):
+        """Drop the shard connections (and executor threads) inherited from
+        the parent process, as dispose_engine_after_fork does for the main
+        engine."""
+
+        for engine in self.engines:
+            engine.dispose(close=False)
+        self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(len(self.engines),
+                                           thread_name_prefix='warbler-shard')
+
+    def load_map(self):
+        """Read the bucket map, creating an even one on first use."""
+
+        buckets = dict(db.session.execute(
+            select(ShardBucket.bucket, ShardBucket.shard)).all())
+        if not buckets:
+            buckets = {bucket: bucket % len(self) for bucket in range(BUCKETS)}
+            db.session.add_all([ShardBucket(bucket=bucket, shard=shard)
+                                for bucket, shard in buckets.items()])
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # another worker got there first
+                db.session.rollback()
+                return self.load_map()
+
+        self.buckets = [buckets[bucket] for bucket in range(BUCKETS)]
+        self.loaded_at = self.clock()
+
+    def shard_for(self, user_id):
+        """The shard holding `user_id`'s messages."""
+
+        with self.lock:
+            if (self.buckets is None
+                    or self.clock() - self.loaded_at >= self.map_refresh):
+                self.load_map()
+            return self.buckets[bucket_of(user_id)]
+
+    def group(self, user_ids):
+        """`user_ids` grouped by shard: {shard: [user id, ...]}."""
+
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard_for(user_id), []).append(user_id)
+        return groups
+
+    def run(self, shard, fn):
+        """`fn(session)` in a new session on `shard`."""
+
+        with self.sessions[shard]() as session:
+            return fn(session)
+
+    def scatter(self, calls):
+        """Run each `fn(session)` of {shard: fn} on its shard, in parallel.
+        Returns {shard: result}."""
+
+        if len(calls) == 1:
+            (shard, fn), = calls.items()
+            return {shard: self.run(shard, fn)}
+
+        futures = {shard: self.executor.submit(self.run, shard, fn)
+                   for shard, fn in calls.items()}
+        return {shard: future.result() for shard, future in futures.items()}
+
+    def everywhere(self, fn):
+        """Run `fn(session)` on every shard, in parallel."""
+
+        return self.scatter({shard: fn for shard in range(len(self))})
+
+
+def shards():
+    return current_app.extensions['shards']
+
+
+def enabled():
+    """Are messages sharded?"""
+
+    return 'shards' in current_app.extensions
+
+
+def attach_users(messages):
+    """Set each message's `user` from the main database (messages loaded
+    from a shard can't lazy-load it). Drops messages of deleted users."""
+
+    user_ids = {msg.user_id for msg in messages}
+    users = ({user.id: user
+              for user in User.query.filter(User.id.in_(user_ids))}
+             if user_ids else {})
+
+    kept = []
+    for msg in messages:
+        user = users.get(msg.user_id)
+        if user is not None:
+            set_committed_value(msg, 'user', user)
+            kept.append(msg)
+    return kept
+
+
+def newest(session, author_ids, limit):
+    return session.scalars(select(Message)
+                           .where(Message.user_id.in_(author_ids))
+                           .order_by(Message.timestamp.desc())
+                           .limit(limit)).all()
+
+
+def user_messages(user_id, limit=100):
+    """`user_id`'s newest `limit` messages, from their shard."""
+
+    return attach_users(shards().run(shards().shard_for(user_id),
+                                     partial(newest, author_ids=[user_id],
+                                             limit=limit)))
+
+
+def home_messages(author_ids, limit=100):
+    """The newest `limit` messages by `author_ids`: each shard's newest
+    from the authors it holds, queried in parallel and merged."""
+
+    results = shards().scatter({
+        shard: partial(newest, author_ids=ids, limit=limit)
+        for shard, ids in shards().group(author_ids).items()})
+    merged = heapq.merge(*results.values(), key=lambda msg: msg.timestamp,
+                         reverse=True)
+    return attach_users(list(islice(merged, limit)))
+
+
+def messages_after(author_ids, after_id, limit=100):
+    """The newest `limit` messages by `author_ids` with ids above
+    `after_id`, newest first, from the authors' shards."""
+
+    def since(session, author_ids):
+        return session.scalars(select(Message)
+                               .where(Message.user_id.in_(author_ids),
+                                      Message.id > after_id)
+                               .order_by(Message.id.desc())
+                               .limit(limit)).all()
+
+    results = shards().scatter({
+        shard: partial(since, author_ids=ids)
+        for shard, ids in shards().group(author_ids).items()})
+    merged = heapq.merge(*results.values(), key=lambda msg: msg.id,
+                         reverse=True)
+    return attach_users(list(islice(merged, limit)))
+
+
+def page_state(viewer_id, messages):
+    """Likes.page_state for sharded `messages`, asking only their authors'
+    shards."""
+
+    if not messages:
+        return set(), {}
+
+    ids = {}
+    for msg in messages:
+        ids.setdefault(shards().shard_for(msg.user_id), []).append(msg.id)
+
+    def state(session, message_ids):
+        return session.execute(
+            Likes.state_query(viewer_id, message_ids)).all()
+
+    results = shards().scatter({shard: partial(state, message_ids=message_ids)
+                                for shard, message_ids in ids.items()})
+    return Likes.split_state(chain.from_iterable(results.values()))
+
+
+def add_message(user, text):
+    """Post a message by `user` to their shard; returns it."""
+
+    owner = MessageOwner(user_id=user.id)
+    db.session.add(owner)
+    db.session.flush()
+
+    msg = Message(id=owner.id, user_id=user.id, text=text,
+                  timestamp=datetime.utcnow())
+
+    def save(session):
+        session.add(msg)
+        session.commit()
+
+    shards().run(shards().shard_for(user.id), save)
+    db.session.commit()
+    set_committed_value(msg, 'user', user)
+    return msg
+
+
+def find_message(message_id):
+    """Message `message_id`, with its user, or None."""
+
+    owner = db.session.get(MessageOwner, message_id)
+    if owner is None:
+        return None
+
+    msg = shards().run(shards().shard_for(owner.user_id),
+                       lambda session: session.get(Message, message_id))
+    if msg is None:
+        return None
+    found = attach_users([msg])
+    return found[0] if found else None
+
+
+def delete_message(msg):
+    """Delete a message (and its likes) from its shard."""
+
+    def remove(session):
+        session.execute(delete(Likes).where(Likes.message_id == msg.id))
+        session.execute(delete(Message).where(Message.id == msg.id))
+        session.commit()
+
+    shards().run(shards().shard_for(msg.user_id), remove)
+    db.session.execute(delete(MessageOwner).where(MessageOwner.id == msg.id))
+    db.session.commit()
+
+
+def toggle_like(user_id, msg):
+    """Like `msg` as `user_id`, or unlike it if they already do. Returns
+    whether it's now liked."""
+
+    def toggle(session):
+        like = session.scalar(select(Likes).where(Likes.user_id == user_id,
+                                                  Likes.message_id == msg.id))
+        if like is None:
+            session.add(Likes(user_id=user_id, message_id=msg.id))
+        else:
+            session.delete(like)
+        session.commit()
+        return like is None
+
+    return shards().run(shards().shard_for(msg.user_id), toggle)
+
+
+def liked_messages(user_id, before=None, limit=20):
+    """`user_id`'s newest `limit` likes before the (liked_at, like id)
+    `before`, merged from every shard, as LikedMessage tuples.
+
+    Like ids are per shard, so two likes with the same timestamp on
+    different shards may straddle a page boundary out of order.
+    """
+
+    def page(session):
+        query = (select(Likes.id.label('like_id'),
+                        Likes.timestamp.label('liked_at'),
+                        Message.id,
+                        Message.text,
+                        Message.timestamp,
+                        Message.user_id.label('author_id'))
+                 .join(Message, Message.id == Likes.message_id)
+                 .where(Likes.user_id == user_id))
+        if before is not None:
+            query = query.where(tuple_(Likes.timestamp, Likes.id) < before)
+        return session.execute(query
+                               .order_by(Likes.timestamp.desc(),
+                                         Likes.id.desc())
+                               .limit(limit)).all()
+
+    merged = heapq.merge(*shards().everywhere(page).values(),
+                         key=lambda row: (row.liked_at, row.like_id),
+                         reverse=True)
+    rows = list(islice(merged, limit))
+
+    authors = ({user.id: user for user in User.query.filter(
+        User.id.in_({row.author_id for row in rows}))} if rows else {})
+    return [LikedMessage(*row, authors[row.author_id].username,
+                         authors[row.author_id].image_url)
+            for row in rows if row.author_id in authors]
+
+
+def message_count(user_id):
+    """Template helper: how many messages `user_id` has posted."""
+
+    if not enabled():
+        return (db.session.query(func.count(Message.id))
+                .filter(Message.user_id == user_id)
+                .scalar())
+
+    return shards().run(
+        shards().shard_for(user_id),
+        lambda session: session.scalar(select(func.count(Message.id))
+                                       .where(Message.user_id == user_id)))
+
+
+def like_count(user_id):
+    """Template helper: how many messages `user_id` has liked."""
+
+    query = select(func.count(Likes.id)).where(Likes.user_id == user_id)
+    if not enabled():
+        return db.session.scalar(query)
+    return sum(shards().everywhere(
+        lambda session: session.scalar(query)).values())
+
+
+def export_messages(user_id):
+    """(id, text, timestamp) of all of `user_id`'s messages, by id, read
+    from their shard COPY_BATCH at a time."""
+
+    shard = shards().shard_for(user_id)
+    after = 0
+    while True:
+        rows = shards().run(shard, lambda session: session.execute(
+            select(Message.id, Message.text, Message.timestamp)
+            .where(Message.user_id == user_id, Message.id > after)
+            .order_by(Message.id)
+            .limit(COPY_BATCH)).all())
+        yield from rows
+        if len(rows) < COPY_BATCH:
+            return
+        after = rows[-1].id
+
+
+def export_likes(user_id):
+    """(message_id, timestamp, user_id, text) of every message `user_id`
+    liked -- user_id is the author's -- read from each shard in turn,
+    COPY_BATCH at a time."""
+
+    for shard in range(len(shards())):
+        after = 0
+        while True:
+            rows = shards().run(shard, lambda session: session.execute(
+                select(Likes.id, Likes.message_id, Likes.timestamp,
+                       Message.user_id, Message.text)
+                .join(Message, Message.id == Likes.message_id)
+                .where(Likes.user_id == user_id, Likes.id > after)
+                .order_by(Likes.id)
+                .limit(COPY_BATCH)).all())
+            yield from rows
+            if len(rows) < COPY_BATCH:
+                break
+            after = rows[-1].id
+
+
+def forget_user(user_id):
+    """Delete a user's messages and likes from the shards."""
+
+    def messages_of(session):
+        ids = select(Message.id).where(Message.user_id == user_id)
+        session.execute(delete(Likes).where(Likes.message_id.in_(ids)))
+        session.execute(delete(Message).where(Message.user_id == user_id))
+        session.commit()
+
+    def likes_by(session):
+        session.execute(delete(Likes).where(Likes.user_id == user_id))
+        session.commit()
+
+    shards().run(shards().shard_for(user_id), messages_of)
+    shards().everywhere(likes_by)
+
+
+##############################################################################
+# Rebalancing
+
+
+def plan(buckets, shard_count, drain=()):
+    """Bucket moves that spread `buckets` (bucket -> shard) evenly over
+    shards 0..shard_count-1 except `drain`, moving as few as possible.
+    Returns [(bucket, from shard, to shard)]."""
+
+    targets = [shard for shard in range(shard_count) if shard not in drain]
+    if not targets:
+        raise ValueError("can't drain every shard")
+
+    owned = {shard: [] for shard in targets}
+    spare = []
+    for bucket, shard in enumerate(buckets):
+        if shard in owned:
+            owned[shard].append(bucket)
+        else:
+            spare.append((bucket, shard))
+
+    # the shards that already hold the most keep the remainder
+    base, extra = divmod(len(buckets), len(targets))
+    ranked = sorted(targets, key=lambda shard: -len(owned[shard]))
+    quota = {shard: base + (i < extra) for i, shard in enumerate(ranked)}
+
+    for shard in targets:
+        while len(owned[shard]) > quota[shard]:
+            spare.append((owned[shard].pop(), shard))
+
+    moves = []
+    for shard in targets:
+        while len(owned[shard]) < quota[shard]:
+            bucket, source = spare.pop()
+            owned[shard].append(bucket)
+            moves.append((bucket, source, shard))
+    return sorted(moves)
+
+
+def bucket_user_ids(bucket):
+    """Ids of the users in `bucket`, in batches."""
+
+    user_ids = list(db.session.scalars(
+        select(User.id).where(User.id % BUCKETS == bucket).order_by(User.id)))
+    for i in range(0, len(user_ids), USER_BATCH):
+        yield user_ids[i:i + USER_BATCH]
+
+
+def copy_users(source, target, user_ids):
+    """Copy `user_ids`' messages and their likes from engine `source` to
+    `target`, skipping rows already there. Returns messages copied."""
+
+    copied = 0
+    last_id = 0
+    while True:
+        with source.connect() as conn:
+            rows = conn.execute(select(messages)
+                                .where(messages.c.user_id.in_(user_ids),
+                                       messages.c.id > last_id)
+                                .order_by(messages.c.id)
+                                .limit(COPY_BATCH)).mappings().all()
+            if not rows:
+                return copied
+            message_ids = [row['id'] for row in rows]
+            like_rows = conn.execute(
+                select(likes.c.user_id, likes.c.message_id, likes.c.timestamp)
+                .where(likes.c.message_id.in_(message_ids))).mappings().all()
+
+        with target.begin() as conn:
+            conn.execute(insert_ignore(target, messages), [dict(row)
+                                                          for row in rows])
+            if like_rows:
+                conn.execute(insert_ignore(target, likes),
+                             [dict(row) for row in like_rows])
+
+        copied += len(rows)
+        last_id = message_ids[-1]
+
+
+def delete_users(engine, user_ids):
+    """Delete `user_ids`' messages and their likes from `engine`."""
+
+    with engine.begin() as conn:
+        ids = select(messages.c.id).where(messages.c.user_id.in_(user_ids))
+        conn.execute(delete(likes).where(likes.c.message_id.in_(ids)))
+        conn.execute(delete(messages).where(messages.c.user_id.in_(user_ids)))
+
+
+def move_bucket(shards, bucket, source, target, settle):
+    """Move `bucket` from shard `source` to `target`. Returns messages
+    moved."""
+
+    source_engine = shards.engines[source]
+    target_engine = shards.engines[target]
+
+    for user_ids in bucket_user_ids(bucket):
+        copy_users(source_engine, target_engine, user_ids)
+
+    db.session.execute(update(ShardBucket)
+                       .where(ShardBucket.bucket == bucket)
+                       .values(shard=target))
+    db.session.commit()
+    with shards.lock:
+        shards.buckets[bucket] = target
+
+    # let other workers reread the map, then pick up what they wrote to
+    # the old shard meanwhile
+    time.sleep(settle)
+
+    moved = 0
+    for user_ids in bucket_user_ids(bucket):
+        moved += copy_users(source_engine, target_engine, user_ids)
+        delete_users(source_engine, user_ids)
+    return moved
+
+
+def rebalance(shards, drain=(), settle=None, dry_run=False):
+    """Even out the buckets over the shards (emptying `drain`). Yields
+    (bucket, from, to, messages moved or None on a dry run) per move."""
+
+    with shards.lock:
+        shards.load_map()
+        buckets = list(shards.buckets)
+    settle = shards.map_refresh + 1 if settle is None else settle
+
+    for bucket, source, target in plan(buckets, len(shards), drain):
+        if dry_run:
+            yield bucket, source, target, None
+        else:
+            yield (bucket, source, target,
+                   move_bucket(shards, bucket, source, target, settle))
+
+
+def init_app(app):
+    """Shard messages over SHARD_DATABASE_URLS, if set, and add the count
+    template helpers."""
+
+    app.add_template_global(message_count)
+    app.add_template_global(like_count)
+
+    urls = app.config['SHARD_DATABASE_URLS']
+    if not urls:
+        return
+
+    if (app.config['TIMELINE_ENGINE'] == 'cache'
+            or os.environ.get('WARBLER_ASYNC') == '1'):
+        raise RuntimeError("sharded messages don't support "
+                           "TIMELINE_ENGINE=cache or WARBLER_ASYNC")
+
+    app.extensions['shards'] = shards = Shards(
+        urls, app.config['SHARD_MAP_REFRESH'])
+    shards.create_all()
@@ -0,0 +1,280 @@
+"""Slow query log.
+
+Statements that take longer than SLOW_QUERY_MS are appended, one JSON
+object per line, to the log file SLOW_QUERY_LOG, with:
+
+- the SQL, and how many parameters it was run with: the values (emails,
+  password hashes...) only with SLOW_QUERY_LOG_PARAMETERS=1
+- the endpoint, method and path of the request that ran it
+- where in Warbler's own code it was run from
+- its query plan: EXPLAIN (ANALYZE, BUFFERS) on Postgres, EXPLAIN QUERY
+  PLAN on SQLite. Only for SELECTs (ANALYZE runs the statement again), and
+  at most once per SLOW_QUERY_EXPLAIN_INTERVAL seconds per statement.
+
+Without SLOW_QUERY_LOG_PARAMETERS, string literals in plans (where
+Postgres shows the values a statement ran with) are logged as '?'.
+
+Each line is written with a single O_APPEND write, so every worker can
+share one log. Rotate it externally (logrotate, without copytruncate):
+writers reopen the file once it's been renamed away, and `flask
+slow-queries` also reads the rotated backups SLOW_QUERY_LOG.1, .2, ...
+
+SLOW_QUERY_ENDPOINTS limits the log to some endpoints, e.g.
+"homepage,users_show,list_users". `flask slow-queries` summarizes the log.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+from models import db
+from ratelimit import MemoryBackend
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STACK_DEPTH = 5
+MAX_PARAMETERS_CHARS = 2000
+
+# a list of bind placeholders, as in "IN (?, ?, ?)" or "IN (%(id_1)s, ...)"
+PLACEHOLDER_LIST = re.compile(
+    r"\(\s*(?:\?|%\(\w+\)s|%s|:\w+|\$\d+)(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+|\$\d+))*\s*\)")
+WHITESPACE = re.compile(r"\s+")
+# a quoted string literal, as in "Filter: (email = 'u@example.com'::text)"
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def normalize(statement):
+    """`statement` with whitespace and placeholder lists collapsed, so the
+    same query with different IN list lengths groups together."""
+
+    return PLACEHOLDER_LIST.sub('(...)', WHITESPACE.sub(' ', statement).strip())
+
+
+def app_stack():
+    """The innermost frames of the call stack that are Warbler's code."""
+
+    frames = []
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame.filename)
+        if (filename == os.path.abspath(__file__)
+                or not filename.startswith(ROOT)
+                or 'site-packages' in filename):
+            continue
+        frames.append(f"{os.path.relpath(filename, ROOT)}:{frame.lineno} "
+                      f"in {frame.name}")
+        if len(frames) == STACK_DEPTH:
+            break
+    return frames
+
+
+def explain(conn, statement, parameters):
+    """Query plan lines for `statement`, run on `conn`'s DBAPI connection
+    (so it isn't itself logged)."""
+
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        sql = 'EXPLAIN (ANALYZE, BUFFERS) ' + statement
+    elif dialect == 'sqlite':
+        sql = 'EXPLAIN QUERY PLAN ' + statement
+    else:
+        return None
+
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        if dialect == 'postgresql':
+            # a failed EXPLAIN mustn't abort the request's transaction
+            cursor.execute('SAVEPOINT slow_query_explain')
+            try:
+                cursor.execute(sql, parameters)
+                rows = cursor.fetchall()
+            finally:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        else:
+            cursor.execute(sql, parameters)
+            rows = cursor.fetchall()
+    except Exception as exc:
+        return [f"EXPLAIN failed: {exc}"]
+    finally:
+        cursor.close()
+
+    # Postgres: one text column; SQLite: (id, parent, notused, detail)
+    return [str(row[-1]) for row in rows]
+
+
+class SlowQueryLog:
+    """Times every statement on an engine, logging those over the
+    threshold."""
+
+    def __init__(self, path, threshold_ms, endpoints=(), explain_interval=60,
+                 log_parameters=False, clock=time.time):
+        self.path = path
+        self.threshold = threshold_ms / 1000
+        self.endpoints = set(endpoints)
+        self.explain_rate = 1 / explain_interval
+        self.explains = MemoryBackend()
+        self.log_parameters = log_parameters
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.fd = None
+        self.pid = None
+        self.file_id = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def listen(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+        event.listen(engine, 'handle_error', self.handle_error)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('slow_query_start', []).append(
+            time.perf_counter())
+
+    def handle_error(self, context):
+        starts = context.connection and context.connection.info.get(
+            'slow_query_start')
+        if starts:
+            starts.pop()
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        elapsed = time.perf_counter() - conn.info['slow_query_start'].pop()
+        if elapsed < self.threshold:
+            return
+
+        endpoint = request.endpoint if has_request_context() else None
+        if self.endpoints and endpoint not in self.endpoints:
+            return
+
+        entry = {
+            'time': datetime.utcnow().isoformat(),
+            'duration_ms': round(elapsed * 1000, 3),
+            'statement': statement,
+            'parameters': self.parameters(parameters, executemany),
+            'endpoint': endpoint,
+            'method': request.method if has_request_context() else None,
+            'path': request.path if has_request_context() else None,
+            'stack': app_stack(),
+            'plan': None,
+        }
+
+        # capacity-1 token bucket per statement: one plan per interval
+        if (not executemany
+                and statement.lstrip()[:6].upper() == 'SELECT'
+                and self.explains.take(normalize(statement), 1,
+                                       self.explain_rate, self.clock()) == 0):
+            entry['plan'] = explain(conn, statement, parameters)
+            if entry['plan'] and not self.log_parameters:
+                entry['plan'] = [STRING_LITERAL.sub("'?'", line)
+                                 for line in entry['plan']]
+
+        self.write(entry)
+
+    def parameters(self, parameters, executemany):
+        if executemany:
+            return f"<{len(parameters)} rows>"
+        if not self.log_parameters:
+            return f"<{len(parameters or ())} parameters>"
+        return str(parameters)[:MAX_PARAMETERS_CHARS]
+
+    def open(self):
+        """The log's descriptor, reopened after a fork and after the file
+        was rotated away."""
+
+        try:
+            stat = os.stat(self.path)
+            file_id = (stat.st_dev, stat.st_ino)
+        except FileNotFoundError:
+            file_id = None
+        if (self.fd is not None and self.pid == os.getpid()
+                and file_id == self.file_id):
+            return self.fd
+
+        self.close()
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0o600)
+        self.pid = os.getpid()
+        stat = os.fstat(self.fd)
+        self.file_id = (stat.st_dev, stat.st_ino)
+        return self.fd
+
+    def write(self, entry):
+        line = json.dumps(entry, default=str) + '\n'
+        with self.lock:
+            os.write(self.open(), line.encode())
+
+    def close(self):
+        if self.fd is not None and self.pid == os.getpid():
+            os.close(self.fd)
+        self.fd = self.pid = self.file_id = None
+
+
+def read_entries(path):
+    """Entries from the log at `path` and its rotated backups."""
+
+    paths = [path]
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        paths.append(f"{path}.{i}")
+        i += 1
+
+    for log_path in reversed(paths):
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def summarize(entries, sort='total'):
+    """Entries grouped by normalized statement, worst first by `sort`
+    ('total', 'count' or 'max' duration)."""
+
+    groups = {}
+    for entry in entries:
+        key = normalize(entry['statement'])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {'statement': key, 'count': 0,
+                                   'total_ms': 0, 'max_ms': 0,
+                                   'endpoints': Counter(), 'stack': [],
+                                   'plan': None}
+        group['count'] += 1
+        group['total_ms'] += entry['duration_ms']
+        if entry['duration_ms'] >= group['max_ms']:
+            group['max_ms'] = entry['duration_ms']
+            group['stack'] = entry['stack']
+        group['endpoints'][entry['endpoint'] or '-'] += 1
+        if entry['plan']:
+            group['plan'] = entry['plan']
+
+    key = {'total': 'total_ms', 'count': 'count', 'max': 'max_ms'}[sort]
+    return sorted(groups.values(), key=lambda group: group[key], reverse=True)
+
+
+def init_app(app):
+    """Log slow statements on the app's engine, if SLOW_QUERY_MS is set."""
+
+    if not app.config['SLOW_QUERY_MS']:
+        return
+
+    log = SlowQueryLog(app.config['SLOW_QUERY_LOG'],
+                       app.config['SLOW_QUERY_MS'],
+                       app.config['SLOW_QUERY_ENDPOINTS'],
+                       app.config['SLOW_QUERY_EXPLAIN_INTERVAL'],
+                       app.config['SLOW_QUERY_LOG_PARAMETERS'])
+    with app.app_context():
+        log.listen(db.engine)
+    app.extensions['slow_queries'] = log
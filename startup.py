@@ -0,0 +1,105 @@
+"""Production startup helpers: template precompilation and fork safety.
+
+Used by wsgi.py and gunicorn.conf.py.
+"""
+
+import logging
+import os
+import stat
+import tempfile
+
+from jinja2 import FileSystemBytecodeCache
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# per user, as Jinja's own default: the cache holds code we'll run
+DEFAULT_TEMPLATE_CACHE_DIR = os.path.join(
+    tempfile.gettempdir(), f"warbler-jinja-cache-{os.getuid()}")
+
+
+def private_directory(directory):
+    """Create `directory` (mode 0700) if needed; whether it's a real
+    directory of ours that no one else can write to."""
+
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid()
+            and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+def enable_bytecode_cache(app, directory=DEFAULT_TEMPLATE_CACHE_DIR):
+    """Cache compiled templates on disk, shared by every worker.
+
+    Compiled templates are loaded and run from there, so a directory
+    someone else owns or can write to is refused (templates are then
+    compiled in each process). Returns whether the cache is enabled.
+    """
+
+    if not private_directory(directory):
+        logger.warning("not caching templates in %s: not a directory "
+                       "owned and only writable by this user", directory)
+        return False
+
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    return True
+
+
+def precompile_templates(app):
+    """Compile every template now, rather than on its first request.
+
+    Compiled templates stay in the Jinja environment's in-memory cache
+    (inherited by workers forked from a preloaded app) and, with the
+    bytecode cache enabled, are written to disk for other processes.
+    Returns the names compiled.
+    """
+
+    env = app.jinja_env
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        env.get_template(name)
+    return names
+
+
+def dispose_engine_after_fork(app):
+    """Drop pooled DB connections inherited from the parent process.
+
+    Call in each worker after fork (gunicorn's post_fork hook); the
+    parent's sockets are left open for the parent rather than closed.
+    Shard engines (see sharding.py) are created in the parent too.
+    """
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+    if 'shards' in app.extensions:
+        app.extensions['shards'].after_fork()
+
+
+def make_psycopg2_cooperative():
+    """Have psycopg2 wait for the database through gevent, so a query
+    blocks only its own greenlet, not the whole worker.
+
+    Call in each gevent worker (gunicorn's post_fork hook does).
+    """
+
+    import psycopg2
+    from psycopg2 import extensions
+    from gevent.socket import wait_read, wait_write
+
+    def wait(conn, timeout=None):
+        while True:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                return
+            elif state == extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError(f"bad poll state: {state}")
+
+    extensions.set_wait_callback(wait)
@@ -0,0 +1,238 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+
+
+import os
+import threading
+import time
+from collections import Counter
+from unittest import TestCase
+
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, CURR_USER_KEY
+import admission
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class AIMDLimitTestCase(TestCase):
+    """Test the adaptive limit."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limit = admission.AIMDLimit(initial=10, minimum=2, maximum=12,
+                                         cooldown=1, clock=self.clock)
+
+    def test_additive_increase_when_busy(self):
+        for _ in range(10):
+            self.limit.update(0.01, 0, in_flight=10)
+        self.assertAlmostEqual(self.limit.limit, 11, delta=0.05)
+
+        for _ in range(100):
+            self.limit.update(0.01, 0, in_flight=12)
+        self.assertEqual(self.limit.limit, 12)
+
+    def test_no_increase_when_idle(self):
+        self.limit.update(0.01, 0, in_flight=1)
+        self.assertEqual(self.limit.limit, 10)
+
+    def test_multiplicative_decrease(self):
+        self.limit.update(0.01, 0.2, in_flight=10)
+        self.assertEqual(self.limit.limit, 9)
+
+        # the rest of the same burst doesn't count again
+        self.limit.update(5, 0, in_flight=10)
+        self.assertEqual(self.limit.limit, 9)
+
+        self.clock.now = 1
+        self.limit.update(5, 0, in_flight=10)
+        self.assertAlmostEqual(self.limit.limit, 8.1)
+
+        for _ in range(50):
+            self.clock.now += 1
+            self.limit.update(0.01, float('inf'), in_flight=1)
+        self.assertEqual(self.limit.limit, 2)
+
+
+class AdmissionControllerTestCase(TestCase):
+    """Test admitting by priority."""
+
+    def test_classify(self):
+        self.assertEqual(admission.classify('list_users', 'GET', True),
+                         admission.EXPENSIVE)
+        self.assertEqual(admission.classify('messages_add', 'POST', True),
+                         admission.WRITE)
+        self.assertEqual(admission.classify('login', 'POST', False),
+                         admission.READ)
+        self.assertEqual(admission.classify('users_show', 'GET', True),
+                         admission.READ)
+        self.assertIsNone(admission.classify('static', 'GET', False))
+        self.assertIsNone(admission.classify(None, 'GET', False))
+
+    def test_shares(self):
+        controller = admission.AdmissionController(
+            admission.AIMDLimit(initial=10))
+
+        admitted = Counter()
+        for priority in (admission.EXPENSIVE, admission.READ, admission.WRITE):
+            while controller.acquire(priority):
+                admitted[priority] += 1
+
+        self.assertEqual(admitted, {admission.EXPENSIVE: 5,
+                                    admission.READ: 3, admission.WRITE: 2})
+        self.assertEqual(controller.in_flight, 10)
+        self.assertEqual(controller.shed, {admission.EXPENSIVE: 1,
+                                           admission.READ: 1,
+                                           admission.WRITE: 1})
+
+        controller.release(0.01, 0)
+        self.assertEqual(controller.in_flight, 9)
+        self.assertFalse(controller.acquire(admission.EXPENSIVE))
+        self.assertTrue(controller.acquire(admission.WRITE))
+
+
+class AdmissionViewTestCase(TestCase):
+    """Test shedding in the request pipeline."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(id=1, username="user1", email="u1@test.com",
+                            password="x"))
+        db.session.commit()
+
+        self.enabled = app.config['ADMISSION_ENABLED']
+        app.config['ADMISSION_ENABLED'] = True
+        self.controller = app.extensions['admission']
+        self.limit = self.controller.limit
+        self.controller.limit = admission.AIMDLimit(initial=4)
+
+        self.pool = db.engine.pool
+        self.connect = self.pool.connect
+
+    def tearDown(self):
+        self.pool.connect = self.connect
+        self.pool.admission_instrumented = True
+        self.controller.limit = self.limit
+        app.config['ADMISSION_ENABLED'] = self.enabled
+        db.session.rollback()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def test_expensive_reads_shed_before_writes(self):
+        client = app.test_client()
+        self.login(client)
+        # two requests in flight elsewhere: half the limit
+        self.controller.in_flight += 2
+        try:
+            resp = client.get("/users")
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+
+            self.assertEqual(client.get("/users/1").status_code, 200)
+            resp = client.post("/messages/new", data={"text": "still up"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(self.controller.in_flight, 2)
+        finally:
+            self.controller.in_flight -= 2
+
+    def test_streamed_export_keeps_limit(self):
+        client = app.test_client()
+        self.login(client)
+        # every request is "slow"
+        self.controller.limit = admission.AIMDLimit(
+            initial=4, latency_target=0)
+
+        resp = client.get("/users/export")
+        self.assertEqual(resp.status_code, 200)
+        resp.get_data()
+        resp.close()
+        self.assertEqual(self.controller.limit.limit, 4)
+        self.assertEqual(self.controller.in_flight, 0)
+
+        client.get("/users")
+        self.assertEqual(self.controller.limit.limit, 4 * 0.9)
+
+    def test_disabled(self):
+        app.config['ADMISSION_ENABLED'] = False
+        self.controller.in_flight += 10
+        try:
+            self.assertEqual(app.test_client().get("/users").status_code, 200)
+        finally:
+            self.controller.in_flight -= 10
+
+    def test_pool_timeout(self):
+        def timeout():
+            raise PoolTimeout("QueuePool limit reached")
+
+        self.pool.connect = timeout
+        self.pool.admission_instrumented = False
+
+        resp = app.test_client().get("/users")
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp.headers)
+        self.assertEqual(self.controller.limit.limit, 4 * 0.9)
+        self.assertEqual(self.controller.in_flight, 0)
+
+    def test_load(self):
+        """Overload a worker whose pool makes requests wait: the excess is
+        shed and the limit backs off, instead of everything queueing."""
+
+        connect = self.connect
+
+        def slow_connect():
+            time.sleep(0.06)
+            return connect()
+
+        self.pool.connect = slow_connect
+        self.pool.admission_instrumented = False
+        self.controller.limit = admission.AIMDLimit(initial=8, minimum=2,
+                                                    cooldown=0.01)
+
+        statuses = Counter()
+        retry_after = set()
+        lock = threading.Lock()
+
+        def client():
+            test_client = app.test_client()
+            for _ in range(8):
+                resp = test_client.get("/users")
+                with lock:
+                    statuses[resp.status_code] += 1
+                    if resp.status_code == 503:
+                        retry_after.add(resp.headers.get('Retry-After'))
+
+        threads = [threading.Thread(target=client) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(set(statuses), {200, 503})
+        self.assertEqual(retry_after, {'1'})
+        self.assertEqual(sum(statuses.values()), 96)
+        self.assertLess(self.controller.limit.limit, 8)
+        self.assertEqual(self.controller.in_flight, 0)
@@ -0,0 +1,157 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+
+import os
+from datetime import date, datetime
+from unittest import TestCase
+
+from models import db, Likes, Message, MessageArchive, MessageArchiveUser, User
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app
+import archive
+import export
+import search
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ArchiveTestCase(TestCase):
+    """Test moving old messages to the archive and reading them back."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.author = User(id=1, username="author", email="a@test.com",
+                           password="x")
+        self.fan = User(id=2, username="fan", email="f@test.com",
+                        password="x")
+        db.session.add_all([self.author, self.fan])
+        db.session.commit()
+
+        # five messages a month from Jan to Jun 2024
+        n = 0
+        for month in range(1, 7):
+            for day in range(1, 6):
+                n += 1
+                msg = Message(id=n, text=f"old warble {n}", user_id=1,
+                              timestamp=datetime(2024, month, day * 5))
+                db.session.add(msg)
+                db.session.flush()
+                search.index_message(msg)
+        db.session.add(Likes(user_id=2, message_id=3))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_add_months(self):
+        self.assertEqual(archive.add_months(date(2024, 11, 20), 2),
+                         date(2025, 1, 1))
+        self.assertEqual(archive.cutoff(3, today=date(2024, 2, 10)),
+                         datetime(2023, 11, 1))
+
+    def test_archive_before(self):
+        months = list(archive.archive_before(datetime(2024, 4, 1),
+                                             chunk_size=2))
+
+        self.assertEqual(months, [(date(2024, 1, 1), 5), (date(2024, 2, 1), 5),
+                                  (date(2024, 3, 1), 5)])
+        self.assertEqual(Message.query.count(), 15)
+        self.assertEqual(Message.query.order_by(Message.timestamp)
+                         .first().timestamp, datetime(2024, 4, 5))
+        # 5 messages a month in chunks of 2: 3 chunks a month
+        self.assertEqual(MessageArchive.query.count(), 9)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(search.search_messages("warble", limit=50)[0],
+                         Message.query.order_by(Message.id.desc()).all())
+
+        # nothing left to archive
+        self.assertEqual(list(archive.archive_before(datetime(2024, 4, 1))),
+                         [])
+
+    def test_find_message(self):
+        list(archive.archive_before(datetime(2024, 4, 1), chunk_size=2))
+
+        msg = archive.find_message(3)
+        self.assertEqual(msg.text, "old warble 3")
+        self.assertEqual(msg.timestamp, datetime(2024, 1, 15))
+        self.assertEqual(msg.user.username, "author")
+        self.assertIsNone(archive.find_message(20))
+        self.assertIsNone(archive.find_message(999))
+
+        chunk = MessageArchive.query.filter_by(first_id=3).one()
+        self.assertEqual(archive.unpack(chunk.data)[0][4], [2])
+
+    def test_show_archived_message(self):
+        list(archive.archive_before(datetime(2024, 4, 1)))
+
+        res = self.client.get('/messages/3')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("old warble 3", res.get_data(as_text=True))
+
+        self.assertEqual(self.client.get('/messages/999').status_code, 404)
+
+    def test_export_includes_archive(self):
+        list(archive.archive_before(datetime(2024, 4, 1)))
+
+        ids = sorted(record['id'] for record in export.records(1)
+                     if record['type'] == 'message')
+        self.assertEqual(ids, list(range(1, 31)))
+
+        # the fan's like of message 3, archived with it
+        likes = [record for record in export.records(2)
+                 if record['type'] == 'like']
+        self.assertEqual([(like['id'], like['user_id'], like['text'])
+                          for like in likes], [(3, 1, "old warble 3")])
+
+    def test_forget_user(self):
+        db.session.add(Message(id=100, text="fan warble", user_id=2,
+                               timestamp=datetime(2024, 1, 2)))
+        db.session.commit()
+        list(archive.archive_before(datetime(2024, 2, 1)))
+
+        archive.forget_user(2)
+        db.session.commit()
+
+        records = [record for chunk in MessageArchive.query
+                   for record in archive.unpack(chunk.data)]
+        self.assertEqual(sorted(record[0] for record in records),
+                         [1, 2, 3, 4, 5])
+        self.assertTrue(all(record[4] == [] for record in records))
+        self.assertFalse(MessageArchiveUser.query.filter_by(user_id=2).all())
+        self.assertEqual(MessageArchive.query.count(),
+                         MessageArchiveUser.query.count())
+
+    def test_user_index(self):
+        list(archive.archive_before(datetime(2024, 4, 1), chunk_size=2))
+
+        chunks = db.session.scalars(archive.chunks_of(2)).all()
+        self.assertEqual([chunk.first_id for chunk in chunks], [3])
+        self.assertEqual(db.session.scalars(
+            archive.chunks_of(2, authored=True)).all(), [])
+
+        # chunks archived before the index existed
+        MessageArchiveUser.query.delete()
+        db.session.commit()
+        self.assertEqual(list(archive.user_records(1)), [])
+        self.assertEqual(archive.index_unindexed(batch_size=3),
+                         MessageArchive.query.count())
+        self.assertEqual(len(list(archive.user_records(1))), 15)
+
+    def test_cli(self):
+        result = app.test_cli_runner().invoke(
+            args=['archive-messages', '--keep-months', '0'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("archived 5 messages from 2024-06", result.output)
+        self.assertEqual(Message.query.count(), 0)
@@ -0,0 +1,86 @@
+"""Static asset fingerprinting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app
+import assets
+
+app.app_context().push()
+db.create_all()
+
+
+class AssetsTestCase(TestCase):
+    """Test fingerprinted static URLs and their caching."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, 'stylesheets'))
+        with open(os.path.join(self.tmp.name, 'stylesheets', 'style.css'), 'w') as f:
+            f.write("body { color: red; }")
+
+        self.static_folder = app.static_folder
+        self.extension = app.extensions['assets']
+        app.static_folder = self.tmp.name
+        app.static_url_path = '/static'
+        assets.refresh(app)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.static_folder = self.static_folder
+        app.extensions['assets'] = self.extension
+        self.tmp.cleanup()
+
+    def test_asset_url(self):
+        url = assets.asset_url('stylesheets/style.css')
+        self.assertRegex(url, r"^/static/stylesheets/style\.[0-9a-f]{12}\.css$")
+        self.assertEqual(assets.asset_url('/static/stylesheets/style.css'), url)
+
+        # unknown files and remote URLs pass through
+        self.assertEqual(assets.asset_url('images/missing.png'),
+                         '/static/images/missing.png')
+        self.assertEqual(assets.asset_url('http://example.com/a.jpg'),
+                         'http://example.com/a.jpg')
+
+    def test_fingerprint_changes_with_content(self):
+        before = assets.asset_url('stylesheets/style.css')
+        with open(os.path.join(self.tmp.name, 'stylesheets', 'style.css'), 'w') as f:
+            f.write("body { color: blue; }")
+        assets.refresh(app)
+        self.assertNotEqual(assets.asset_url('stylesheets/style.css'), before)
+
+    def test_fingerprinted_caching(self):
+        res = self.client.get(assets.asset_url('stylesheets/style.css'))
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("color: red", res.get_data(as_text=True))
+        self.assertIn("immutable", res.headers['Cache-Control'])
+        self.assertIn("max-age=31536000", res.headers['Cache-Control'])
+        res.close()
+
+        res = self.client.get('/static/stylesheets/style.css')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("immutable", res.headers['Cache-Control'])
+        res.close()
+
+    def test_pages_not_cached(self):
+        res = self.client.get('/login')
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=0')
+        self.assertIn(assets.asset_url('stylesheets/style.css'),
+                      res.get_data(as_text=True))
+
+    def test_manifest_file(self):
+        manifest = assets.write_manifest(self.tmp.name)
+        self.assertEqual(assets.load_manifest(self.tmp.name), manifest)
+        self.assertIn('stylesheets/style.css', manifest)
@@ -0,0 +1,117 @@
+"""Async view tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_async_views.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, CURR_USER_KEY
+import archive
+import async_views
+
+app.app_context().push()
+db.create_all()
+
+
+class AsyncViewTestCase(TestCase):
+    """Test the async versions of the read-heavy views."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sync_views = dict(app.view_functions)
+        cls.sync_async_to_sync = app.async_to_sync
+        async_views.init_app(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        app.view_functions.update(cls.sync_views)
+        app.async_to_sync = cls.sync_async_to_sync
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        u1 = User(id=1111, username="test1", email="u1@test.com", password="x")
+        u2 = User(id=2222, username="test2", email="u2@test.com", password="x")
+        u3 = User(id=3333, username="test3", email="u3@test.com", password="x")
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=2222, user_following_id=1111),
+            Message(id=1, text="from user one", user_id=1111),
+            Message(id=2, text="from user two", user_id=2222),
+            Message(id=3, text="from user three", user_id=3333),
+        ])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=1111, message_id=2))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_views_are_async(self):
+        self.assertIs(app.view_functions['homepage'], async_views.homepage)
+
+    def test_homepage(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1111
+
+            res = c.get('/')
+            self.assertEqual(res.status_code, 200)
+            self.assertIn("from user one", str(res.data))
+            self.assertIn("from user two", str(res.data))
+            self.assertNotIn("from user three", str(res.data))
+            self.assertIn("btn-primary", str(res.data))
+
+    def test_homepage_anon(self):
+        res = self.client.get('/')
+        self.assertIn("Sign up now", str(res.data))
+
+    def test_users_show(self):
+        res = self.client.get('/users/2222')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("@test2", str(res.data))
+        self.assertIn("from user two", str(res.data))
+
+        self.assertEqual(self.client.get('/users/9999').status_code, 404)
+
+    def test_messages_show(self):
+        res = self.client.get('/messages/3')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("from user three", str(res.data))
+
+        self.assertEqual(self.client.get('/messages/999').status_code, 404)
+
+    def test_messages_show_archived(self):
+        Message.query.get(3).timestamp = datetime(2024, 1, 15)
+        db.session.commit()
+        list(archive.archive_before(datetime(2024, 4, 1)))
+        self.assertIsNone(Message.query.get(3))
+
+        res = self.client.get('/messages/3')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("from user three", str(res.data))
+
+    def test_list_users(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1111
+
+            res = c.get('/users?q=test2')
+            self.assertIn("@test2", str(res.data))
+            self.assertNotIn("@test3", str(res.data))
+            self.assertIn("Unfollow", str(res.data))
@@ -0,0 +1,136 @@
+"""Username/email availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+
+import os
+from unittest import TestCase, mock
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, CURR_USER_KEY
+import availability
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the Bloom filter itself."""
+
+    def test_no_false_negatives(self):
+        bloom = availability.BloomFilter(1000)
+        values = [f"user{i}" for i in range(1000)]
+        for value in values:
+            bloom.add(value)
+
+        self.assertTrue(all(value in bloom for value in values))
+        self.assertEqual(bloom.count, 1000)
+
+    def test_false_positive_rate(self):
+        bloom = availability.BloomFilter(10_000, error_rate=0.01)
+        for i in range(10_000):
+            bloom.add(f"taken{i}")
+
+        false_positives = sum(f"free{i}" in bloom for i in range(10_000))
+        self.assertLess(false_positives, 200)
+
+
+class AvailabilityTestCase(TestCase):
+    """Test availability checks, the endpoint and the signup pre-check."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup("taken", "taken@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.original = app.extensions['availability']
+        self.checker = availability.Availability(refresh_interval=0)
+        app.extensions['availability'] = self.checker
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions['availability'] = self.original
+
+    def test_is_taken(self):
+        self.assertTrue(availability.is_taken('username', 'taken'))
+        self.assertTrue(availability.is_taken('email', 'taken@test.com'))
+        self.assertFalse(availability.is_taken('username', 'free'))
+        self.assertFalse(availability.is_taken('username', 'taken',
+                                               self.user_id))
+
+    def test_free_values_skip_the_database(self):
+        self.checker.current()
+        self.checker.refresh_interval = 3600
+
+        with mock.patch.object(db.session, 'scalar') as scalar:
+            self.assertFalse(availability.is_taken('username', 'free'))
+        scalar.assert_not_called()
+
+    def test_picks_up_users_created_elsewhere(self):
+        self.checker.current()
+        db.session.add(User(username="direct", email="direct@test.com",
+                            password="x"))
+        db.session.commit()
+
+        self.assertTrue(availability.is_taken('username', 'direct'))
+
+    def test_rename_rebuilds_when_stale(self):
+        self.checker.current()
+        user = db.session.get(User, self.user_id)
+        user.username = "renamed"
+        db.session.commit()
+        availability.user_changed("taken", "taken@test.com", user)
+
+        self.assertTrue(availability.is_taken('username', 'renamed'))
+        # the old name lingers in the filter, but the lookup clears it
+        self.assertFalse(availability.is_taken('username', 'taken'))
+        self.assertEqual(self.checker.stale, 1)
+
+        self.checker.stale = 10_000
+        self.assertFalse(availability.is_taken('username', 'taken'))
+        self.assertEqual(self.checker.stale, 0)
+
+    def test_endpoint(self):
+        res = self.client.get('/users/available?username=taken&email=new@test.com')
+        self.assertEqual(res.json, {'username': False, 'email': True})
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        res = self.client.get('/users/available?username=taken')
+        self.assertEqual(res.json, {'username': True})
+
+        self.assertEqual(self.client.get('/users/available').status_code, 400)
+
+    def test_signup_rejects_before_hashing(self):
+        with mock.patch('models.bcrypt.generate_password_hash') as hash_:
+            res = self.client.post('/signup', data={
+                'username': 'taken', 'email': 'other@test.com',
+                'password': 'password'}, follow_redirects=True)
+        hash_.assert_not_called()
+        self.assertIn("Username already taken", res.get_data(as_text=True))
+
+        res = self.client.post('/signup', data={
+            'username': 'other', 'email': 'taken@test.com',
+            'password': 'password'}, follow_redirects=True)
+        self.assertIn("Email already taken", res.get_data(as_text=True))
+
+    def test_signup_adds_to_filter(self):
+        self.checker.current()
+        self.checker.refresh_interval = 3600
+
+        self.client.post('/signup', data={
+            'username': 'newbie', 'email': 'newbie@test.com',
+            'password': 'password'})
+        self.assertTrue(availability.is_taken('username', 'newbie'))
@@ -0,0 +1,241 @@
+"""Traffic capture and replay tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_capture.py
+
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from werkzeug.serving import make_server
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, CURR_USER_KEY
+import capture
+import replay
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def entry(start, who, duration_ms=10, method='GET',
+          rule='/users/<int:user_id>', view_args=None, args=None, form=None):
+    return {'time': start, 'duration_ms': duration_ms, 'status': 200,
+            'method': method, 'endpoint': 'users_show', 'rule': rule,
+            'view_args': view_args or {'user_id': 1}, 'args': args or {},
+            'form': form or {}, 'who': who}
+
+
+class CaptureTestCase(TestCase):
+    """Test what's written to the capture log."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([User(id=i, username=f"user{i}",
+                                 email=f"u{i}@test.com", password="x")
+                            for i in range(1, 3)])
+        db.session.commit()
+
+        self.path = os.path.join(tempfile.mkdtemp(), 'capture.log')
+        self.log = capture.CaptureLog(self.path, 'key', CURR_USER_KEY)
+        app.extensions['capture'] = self.log
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions.pop('capture', None)
+        self.log.close()
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_capture(self):
+        self.login(1)
+        self.client.get("/users/2?page=3&q=private")
+        self.client.post("/messages/new", data={"text": "secret plans"})
+        self.client.get("/static/stylesheets/style.css")
+
+        entries = capture.read_entries(self.path)
+        self.assertEqual(len(entries), 2)
+
+        show, add = entries
+        self.assertEqual(show['endpoint'], 'users_show')
+        self.assertEqual(show['rule'], '/users/<int:user_id>')
+        self.assertEqual(show['view_args'], {'user_id': 2})
+        self.assertEqual(show['args'], {'page': '3', 'q': 7})
+        self.assertEqual(show['status'], 200)
+        self.assertGreater(show['duration_ms'], 0)
+
+        self.assertEqual((add['method'], add['status']), ('POST', 302))
+        self.assertEqual(add['form'], {'text': 12})
+        with open(self.path) as f:
+            log = f.read()
+        self.assertNotIn('secret', log)
+        self.assertNotIn('private', log)
+
+        # the same stable pseudonym for both, not the user's id
+        self.assertEqual(show['who'], add['who'])
+        self.assertEqual(show['who'], self.log.pseudonym('user', 1))
+        self.assertTrue(show['who'].startswith('u'))
+        self.assertNotEqual(show['who'], self.log.pseudonym('user', 2))
+
+    def test_sender_as_request_arrived(self):
+        self.client.get("/login")
+        self.login(1)
+        self.client.get("/logout")
+
+        anonymous, logout = capture.read_entries(self.path)
+        self.assertTrue(anonymous['who'].startswith('a'))
+        self.assertEqual(logout['who'], self.log.pseudonym('user', 1))
+
+    def test_sample_by_sender(self):
+        self.log.sample_rate = 0.5
+        kept = [user_id for user_id in range(200)
+                if self.log.sampled(self.log.pseudonym('user', user_id))]
+        self.assertTrue(60 < len(kept) < 140)
+
+    def test_truncated_line(self):
+        self.client.get("/users/1")
+        with open(self.path, 'a') as f:
+            f.write('[1700000000.0,3.2,200,"GET"')
+        self.assertEqual(len(capture.read_entries(self.path)), 1)
+
+
+class ReplayTestCase(TestCase):
+    """Test replay scheduling and reports."""
+
+    def test_path(self):
+        self.assertEqual(replay.path(entry(0, 'u1', view_args={'user_id': 7},
+                                           args={'q': 3,
+                                                 'cursor': 'a b'})),
+                         '/users/7?q=xxx&cursor=a+b')
+        self.assertEqual(replay.route(entry(0, 'u1')),
+                         'GET /users/<int:user_id>')
+
+    def test_peak_concurrency(self):
+        entries = [entry(0, 'u1', 1000), entry(0.5, 'u2', 1000),
+                   entry(0.9, 'u3', 50), entry(1, 'u4', 10)]
+        self.assertEqual(replay.peak_concurrency(entries), 3)
+
+    def replay(self, entries, speed, delay=0.02, **options):
+        lock = threading.Lock()
+        running = set()
+        log = []
+        start = time.perf_counter()
+
+        def send(entry):
+            with lock:
+                self.assertNotIn(entry['who'], running)
+                running.add(entry['who'])
+                log.append((entry['time'], time.perf_counter() - start))
+            time.sleep(delay)
+            with lock:
+                running.discard(entry['who'])
+            return replay.Result(replay.route(entry), 200, delay * 1000,
+                                 entry['duration_ms'])
+
+        results = replay.replay(entries, send, speed, **options)
+        self.assertEqual(len(results), len(entries))
+        return log
+
+    def test_paced(self):
+        entries = [entry(100 + i * 0.5, f"u{i}") for i in range(4)]
+        log = self.replay(entries, speed=10)
+        for captured, sent in log:
+            self.assertAlmostEqual(sent, (captured - 100) / 10, delta=0.02)
+
+    def test_sender_waits_for_previous_request(self):
+        # captured back to back, but the replay is slower than the capture
+        entries = [entry(100 + i * 0.001, 'u1') for i in range(3)]
+        log = self.replay(entries, speed=1, delay=0.05)
+        sent = [offset for _, offset in log]
+        self.assertGreater(sent[2] - sent[0], 0.09)
+
+    def test_max_speed_concurrency(self):
+        entries = [entry(100 + i * 10, f"u{i % 5}") for i in range(20)]
+        start = time.perf_counter()
+        self.replay(entries, speed=None, concurrency=5)
+        # five senders of four requests each, side by side
+        self.assertLess(time.perf_counter() - start, 0.3)
+
+    def test_compare(self):
+        before = replay.summarize(
+            [replay.Result('GET /', 200, ms, 0) for ms in (10, 20, 30)]
+            + [replay.Result('GET /users', 500, 100, 0)])
+        after = replay.summarize(
+            [replay.Result('GET /', 200, ms, 0) for ms in (5, 10, 15)])
+        self.assertEqual(before['GET /'], (3, 0, 20, 30))
+        self.assertEqual(before['GET /users'], (1, 1, 100, 100))
+
+        rows = replay.compare(before, after)
+        self.assertEqual(rows[0], ('GET /', 3, 0, 0, 20, 10, 30, 15))
+        self.assertEqual(rows[1], ('GET /users', 1, 1, 0, 100, None, 100,
+                                   None))
+        self.assertEqual(replay.delta(20, 10), '-50.0%')
+        self.assertEqual(replay.delta(100, None), '')
+
+
+class ReplayServerTestCase(TestCase):
+    """Test replaying captured traffic against a running server."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([User(id=i, username=f"user{i}",
+                                 email=f"u{i}@test.com", password="x")
+                            for i in range(1, 4)])
+        db.session.commit()
+        db.session.add(Message(id=10, text="hello", user_id=2))
+        db.session.commit()
+
+        self.server = make_server('127.0.0.1', 0, app)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        app.config['WTF_CSRF_ENABLED'] = True
+
+    def tearDown(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.server.shutdown()
+        db.session.rollback()
+
+    def test_replay(self):
+        sessions = replay.Sessions(app, CURR_USER_KEY, users=3)
+        log = capture.CaptureLog(os.devnull, 'key', CURR_USER_KEY)
+        who = log.pseudonym('user', 1)
+        user_id = sessions.user_id(who)
+        other = 1 if user_id != 1 else 2
+
+        entries = [
+            entry(100, who, view_args={'user_id': other}),
+            entry(100.01, who, method='POST', rule='/messages/new',
+                  view_args={}, form={'csrf_token': 91, 'text': 5}),
+            entry(100.02, log.pseudonym('anonymous', 'x'),
+                  rule='/messages/<int:message_id>',
+                  view_args={'message_id': 10}),
+        ]
+        send = replay.HTTPSender(f"http://127.0.0.1:{self.server.port}",
+                                 sessions)
+        results = replay.replay(entries, send, speed=None)
+
+        self.assertEqual(sorted((result.route, result.status)
+                                for result in results),
+                         [('GET /messages/<int:message_id>', 200),
+                          ('GET /users/<int:user_id>', 200),
+                          ('POST /messages/new', 302)])
+        db.session.expire_all()
+        message = Message.query.filter_by(text='xxxxx').one()
+        self.assertEqual(message.user_id, user_id)
@@ -0,0 +1,258 @@
+"""Social graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph.py
+
+
+import os
+import random
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Follows
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, CURR_USER_KEY
+import graph
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class IntersectTestCase(TestCase):
+    """Test the sorted-array helpers."""
+
+    def test_intersect_sorted(self):
+        a = np.array([1, 3, 5, 7, 9], dtype=np.int32)
+        b = np.array([2, 3, 4, 9, 10, 11], dtype=np.int32)
+        self.assertEqual(graph.intersect_sorted(a, b).tolist(), [3, 9])
+        self.assertEqual(graph.intersect_sorted(b, a).tolist(), [3, 9])
+        self.assertEqual(graph.intersect_sorted(a, graph.EMPTY).tolist(), [])
+        self.assertEqual(graph.intersect_sorted(
+            a, np.array([10, 20], dtype=np.int32)).tolist(), [])
+
+    def test_contains_sorted(self):
+        ids = np.array([2, 4, 6], dtype=np.int32)
+        self.assertTrue(graph.contains_sorted(ids, 4))
+        self.assertFalse(graph.contains_sorted(ids, 5))
+        self.assertFalse(graph.contains_sorted(ids, 7))
+
+    def test_delta_merged_once_per_change(self):
+        ids = np.array([2, 4, 6], dtype=np.int32)
+        delta = graph.Delta()
+        delta.add(5)
+        delta.remove(4)
+
+        merged = delta.apply(ids)
+        self.assertEqual(merged.tolist(), [2, 5, 6])
+        self.assertIs(delta.apply(ids), merged)
+
+        delta.add(4)
+        self.assertEqual(delta.apply(ids).tolist(), [2, 4, 5, 6])
+        delta.remove(5)
+        self.assertEqual(delta.apply(ids).tolist(), [2, 4, 6])
+
+
+class SocialGraphTestCase(TestCase):
+    """Test the CSR graph against the follows table."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([User(id=i, username=f"user{i}",
+                                 email=f"u{i}@test.com", password="x")
+                            for i in range(1, 31)])
+        db.session.commit()
+        rng = random.Random(42)
+        self.edges = {(a, b) for a in range(1, 31) for b in range(1, 31)
+                      if a != b and rng.random() < 0.3}
+        db.session.add_all([Follows(user_following_id=a,
+                                    user_being_followed_id=b)
+                            for a, b in self.edges])
+        db.session.commit()
+
+        self.graph = graph.SocialGraph(app)
+        self.graph.build()
+
+        self.engine = app.config['GRAPH_ENGINE']
+        self.original = app.extensions.get('graph')
+
+    def tearDown(self):
+        app.config['GRAPH_ENGINE'] = self.engine
+        if self.original is None:
+            app.extensions.pop('graph', None)
+        else:
+            app.extensions['graph'] = self.original
+
+    def check_against(self, edges):
+        for user_id in range(1, 32):
+            following = sorted(b for a, b in edges if a == user_id)
+            followers = sorted(a for a, b in edges if b == user_id)
+            self.assertEqual(self.graph.following(user_id).tolist(), following)
+            self.assertEqual(self.graph.followers(user_id).tolist(), followers)
+            self.assertEqual(self.graph.following_count(user_id), len(following))
+            self.assertEqual(self.graph.followers_count(user_id), len(followers))
+            self.assertEqual(self.graph.mutuals(user_id).tolist(),
+                             sorted(set(following) & set(followers)))
+
+    def test_build(self):
+        self.check_against(self.edges)
+        a, b = next(iter(self.edges))
+        self.assertTrue(self.graph.is_following(a, b))
+        self.assertFalse(self.graph.is_following(a, a))
+        self.assertFalse(self.graph.is_following(999, 1))
+
+    def test_memory(self):
+        # 4 bytes per edge each way, plus 8 bytes per id per direction
+        self.assertEqual(self.graph.nbytes(),
+                         8 * len(self.edges) + 2 * 8 * 32)
+
+    def test_deltas(self):
+        edges = set(self.edges)
+        following = {b for a, b in edges if a == 1}
+        follow, unfollow = min(set(range(2, 31)) - following), min(following)
+
+        Follows.follow_many(1, User.id == follow)
+        Follows.unfollow_many(1, User.id == unfollow)
+        db.session.commit()
+        self.graph.resync(1)
+        edges = edges - {(1, unfollow)} | {(1, follow)}
+        self.check_against(edges)
+
+        # unfollowing again undoes the delta
+        Follows.unfollow_many(1, User.id == follow)
+        db.session.commit()
+        self.graph.resync(1)
+        self.check_against(edges - {(1, follow)})
+
+    def test_remove_user(self):
+        self.graph.remove_user(5)
+        self.check_against({(a, b) for a, b in self.edges if 5 not in (a, b)})
+
+    def test_rebuild_replays_changes(self):
+        self.graph.rebuilding = True
+        Follows.unfollow_many(2, User.id.in_(range(1, 31)))
+        db.session.commit()
+        self.graph.resync(2)
+        self.assertEqual(self.graph.changed_during_rebuild, {2})
+
+        self.graph.build()
+        self.graph.rebuilding = False
+        self.check_against({(a, b) for a, b in self.edges if a != 2})
+
+    def test_views_use_graph(self):
+        app.config['GRAPH_ENGINE'] = 'csr'
+        app.extensions['graph'] = self.graph
+        target = next(b for b in range(2, 31) if (1, b) not in self.edges)
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+        res = client.get(f'/users/{target}')
+        self.assertIn(f'action="/users/follow/{target}"', res.get_data(as_text=True))
+
+        client.post(f'/users/follow/{target}')
+        self.assertTrue(self.graph.is_following(1, target))
+        res = client.get(f'/users/{target}')
+        self.assertIn(f'action="/users/stop-following/{target}"',
+                      res.get_data(as_text=True))
+
+    def test_followers_followed_by(self):
+        app.config['GRAPH_ENGINE'] = 'csr'
+        app.extensions['graph'] = self.graph
+
+        for user_id, by_id in ((1, 1), (1, 2), (7, 3), (30, 30)):
+            expected = sorted(a for a, b in self.edges if b == user_id
+                              and (by_id, a) in self.edges)
+            self.assertEqual(graph.followers_followed_by(user_id, by_id),
+                             expected)
+            self.assertEqual(Follows.followers_followed_by(user_id, by_id),
+                             expected)
+
+    def test_known_followers(self):
+        target = max(range(2, 31), key=lambda b: len(
+            [a for a, f in self.edges if f == b and (1, a) in self.edges]))
+        known = sorted(a for a, b in self.edges
+                       if b == target and (1, a) in self.edges)
+        self.assertGreater(len(known), 3)
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+        for engine in ('sql', 'csr'):
+            app.config['GRAPH_ENGINE'] = engine
+            if engine == 'csr':
+                app.extensions['graph'] = self.graph
+            else:
+                app.extensions.pop('graph', None)
+
+            with app.test_request_context():
+                graph.g.user = db.session.get(User, 1)
+                result = graph.known_followers(target)
+                self.assertEqual(result.count, len(known))
+                self.assertEqual(len(result.sample), 3)
+                self.assertTrue({user.id for user in result.sample} <= set(known))
+
+                # most followed first
+                counts = [len([a for a, b in self.edges if b == user.id])
+                          for user in result.sample]
+                self.assertEqual(counts, sorted(counts, reverse=True))
+
+                graph.g.user = db.session.get(User, target)
+                self.assertEqual(graph.known_followers(target).count, 0)
+
+            html = client.get(f'/users/{target}').get_data(as_text=True)
+            self.assertIn(f"{len(known)} people you follow also", html)
+            self.assertIn(f'href="/users/{result.sample[0].id}">'
+                          f'@{result.sample[0].username}</a>', html)
+
+    def test_viewer_follows_seen_by_other_workers(self):
+        """A follow made through another worker shows in the viewer's own
+        buttons at once, before this worker's graph is rebuilt."""
+
+        app.config['GRAPH_ENGINE'] = 'csr'
+        app.extensions['graph'] = self.graph
+        target = next(b for b in range(2, 31) if (1, b) not in self.edges)
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        client.get(f'/users/{target}')
+
+        # another worker's follow: in the database, not in this graph
+        db.session.add(Follows(user_following_id=1,
+                               user_being_followed_id=target))
+        db.session.commit()
+        self.assertFalse(self.graph.is_following(1, target))
+
+        res = client.get(f'/users/{target}')
+        self.assertIn(f'action="/users/stop-following/{target}"',
+                      res.get_data(as_text=True))
+
+    def test_mutual_followers_filter(self):
+        user_id = 4
+        followers = {a for a, b in self.edges if b == user_id}
+        mutuals = {a for a in followers if (user_id, a) in self.edges}
+        self.assertNotEqual(followers, mutuals)
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+        def listed(url):
+            html = client.get(url).get_data(as_text=True)
+            return {a for a in range(1, 31)
+                    if f'<p>@user{a}</p>' in html}
+
+        self.assertEqual(listed(f'/users/{user_id}/followers'), followers)
+        self.assertEqual(listed(f'/users/{user_id}/followers?filter=mutual'),
+                         mutuals)
@@ -0,0 +1,175 @@
+"""Buffered like write tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likebuffer.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from models import db, User, Message, Likes, Notification
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, CURR_USER_KEY
+import likebuffer
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LikeBufferTestCase(TestCase):
+    """Test coalescing, group commits and the overlay."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([User(id=i, username=f"user{i}",
+                                 email=f"u{i}@test.com", password="x")
+                            for i in range(1, 6)])
+        db.session.commit()
+        db.session.add_all([Message(id=100 + i, text=f"message {i}",
+                                    user_id=1)
+                            for i in range(3)])
+        db.session.commit()
+
+        self.buffers = []
+
+    def tearDown(self):
+        app.extensions.pop('like_buffer', None)
+        for buffer in self.buffers:
+            buffer.stop()
+        db.session.rollback()
+
+    def make_buffer(self, **options):
+        options.setdefault('flush_ms', 50)
+        buffer = likebuffer.LikeBuffer(app, **options)
+        self.buffers.append(buffer)
+        return buffer
+
+    def likes(self):
+        db.session.expire_all()
+        return {(like.user_id, like.message_id) for like in Likes.query}
+
+    def test_like_then_unlike_cancels_out(self):
+        buffer = self.make_buffer(durability='async', flush_ms=200)
+        self.assertTrue(buffer.toggle(2, 100, 1))
+        self.assertFalse(buffer.toggle(2, 100, 1))
+        self.assertEqual(buffer.size, 0)
+        self.assertEqual(buffer.pending, {})
+
+        buffer.stop()
+        self.assertEqual(self.likes(), set())
+
+    def test_group_commit(self):
+        buffer = self.make_buffer(durability='async', flush_ms=200)
+        db.session.add(Likes(user_id=3, message_id=101))
+        db.session.commit()
+
+        commits = []
+        listener = lambda conn: commits.append(1)
+        event.listen(db.engine, 'commit', listener)
+        try:
+            for user_id in (2, 3, 4, 5):
+                buffer.toggle(user_id, 100, 1)
+            buffer.toggle(3, 101, 1)
+            buffer.stop()
+        finally:
+            event.remove(db.engine, 'commit', listener)
+
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(self.likes(), {(2, 100), (3, 100), (4, 100),
+                                        (5, 100)})
+        notification = Notification.query.filter_by(user_id=1).one()
+        self.assertEqual(notification.count, 4)
+
+    def test_commit_durability_waits(self):
+        buffer = self.make_buffer(durability='commit', flush_ms=1)
+        self.assertTrue(buffer.toggle(2, 100, 1))
+        self.assertEqual(self.likes(), {(2, 100)})
+
+        # toggling back once written goes through the database state
+        self.assertFalse(buffer.toggle(2, 100, 1))
+        self.assertEqual(self.likes(), set())
+
+    def test_failed_write_not_acknowledged(self):
+        buffer = self.make_buffer(durability='commit', flush_ms=1)
+        apply = likebuffer.apply
+
+        def database_down(likes, unlikes):
+            raise OperationalError("INSERT", {}, Exception("down"))
+
+        likebuffer.apply = database_down
+        try:
+            with self.assertRaises(likebuffer.LikeNotSaved):
+                buffer.toggle(2, 100, 1)
+        finally:
+            likebuffer.apply = apply
+        self.assertEqual(self.likes(), set())
+
+        # the flush thread carries on
+        self.assertTrue(buffer.toggle(2, 100, 1))
+        self.assertEqual(self.likes(), {(2, 100)})
+
+    def test_flush_thread_survives_errors(self):
+        buffer = self.make_buffer(durability='commit', flush_ms=1)
+        write = buffer.write
+        buffer.write = lambda toggles: 1 / 0
+        with self.assertLogs('likebuffer', 'ERROR'):
+            with self.assertRaises(likebuffer.LikeNotSaved):
+                buffer.toggle(2, 100, 1)
+
+        buffer.write = write
+        self.assertTrue(buffer.toggle(2, 100, 1))
+        self.assertEqual(self.likes(), {(2, 100)})
+
+    def test_batch_with_deleted_message(self):
+        buffer = self.make_buffer(durability='async', flush_ms=200)
+        buffer.toggle(2, 100, 1)
+        buffer.toggle(2, 999, 1)
+        buffer.stop()
+
+        self.assertEqual(self.likes(), {(2, 100)})
+
+    def test_overlay(self):
+        buffer = self.make_buffer(durability='async', flush_ms=10000)
+        db.session.add(Likes(user_id=2, message_id=101))
+        db.session.commit()
+
+        buffer.start()
+        buffer.toggle(2, 100, 1)
+        buffer.toggle(2, 101, 1)
+
+        liked, counts = buffer.overlay(2, [100, 101, 102], {101}, {101: 1})
+        self.assertEqual(liked, {100})
+        self.assertEqual(counts, {100: 1})
+        # nothing buffered for other viewers
+        self.assertEqual(buffer.overlay(3, [100], set(), {}), (set(), {}))
+
+    def test_view(self):
+        app.extensions['like_buffer'] = buffer = self.make_buffer(
+            durability='async', flush_ms=10000)
+        buffer.start()
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 2
+
+        resp = client.post("/users/add_like/100")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.likes(), set())
+
+        # the liker sees their like before it's written
+        html = client.get("/users/1").get_data(as_text=True)
+        self.assertIn('btn-primary"', html.replace(" ", "").replace("\n", ""))
+
+        buffer.stop()
+        self.assertEqual(self.likes(), {(2, 100)})
@@ -0,0 +1,252 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import json
+import os
+import socket
+import tempfile
+import threading
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, CURR_USER_KEY
+import live
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def event(message_id, user_id):
+    return {'id': message_id, 'user_id': user_id, 'username': 'u',
+            'image_url': '', 'text': 'hi', 'timestamp': ''}
+
+
+class HubTestCase(TestCase):
+    """Test in-process pub/sub."""
+
+    def test_publish_by_author(self):
+        hub = live.Hub()
+        sub1 = hub.subscribe({1, 2})
+        sub2 = hub.subscribe({2})
+
+        hub.publish(event(10, 1))
+        hub.publish(event(11, 2))
+        hub.publish(event(12, 3))
+
+        self.assertEqual([sub1.get(0)['id'], sub1.get(0)['id']], [10, 11])
+        self.assertIsNone(sub1.get(0))
+        self.assertEqual(sub2.get(0)['id'], 11)
+        self.assertIsNone(sub2.get(0))
+
+        hub.unsubscribe(sub1)
+        hub.unsubscribe(sub1)
+        self.assertEqual(hub.streams, 1)
+        self.assertEqual(set(hub.by_author), {2})
+
+    def test_max_streams_and_overflow(self):
+        hub = live.Hub(max_streams=1, queue_size=2)
+        sub = hub.subscribe({1})
+        self.assertIsNone(hub.subscribe({1}))
+
+        for i in range(3):
+            hub.publish(event(i, 1))
+        self.assertTrue(sub.overflowed)
+
+
+class UnixSocketChannelTestCase(TestCase):
+    """Test delivery between processes' sockets."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hub = live.Hub()
+        self.channel = live.UnixSocketChannel(self.hub, self.directory)
+
+    def tearDown(self):
+        self.channel.close()
+
+    def test_publish_reaches_other_sockets(self):
+        sub = self.hub.subscribe({1})
+        other = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        other.bind(os.path.join(self.directory, 'other.sock'))
+        other.settimeout(1)
+        # an exited worker's socket is cleaned up
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(os.path.join(self.directory, 'stale.sock'))
+        stale.close()
+
+        self.channel.publish(event(10, 1))
+
+        self.assertEqual(sub.get(0)['id'], 10)
+        self.assertEqual(json.loads(other.recv(live.MAX_DATAGRAM))['id'], 10)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'stale.sock')))
+        other.close()
+
+    def test_receive(self):
+        sub = self.hub.subscribe({1})
+        self.channel.start()
+
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.sendto(json.dumps(event(10, 1)).encode(), self.channel.path)
+        sender.close()
+
+        self.assertEqual(sub.get(1)['id'], 10)
+
+    def test_refuses_shared_directory(self):
+        os.chmod(self.directory, 0o777)
+        sub = self.hub.subscribe({1})
+        with self.assertLogs('live', 'WARNING'):
+            self.channel.publish(event(10, 1))
+
+        self.assertEqual(sub.get(0)['id'], 10)
+        self.assertIsNone(self.channel.sock)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class FakeNotify:
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class FakePgConnection:
+    """Enough of a psycopg2 connection (and its pool wrapper) to LISTEN."""
+
+    def __init__(self, payloads):
+        self.ours, self.theirs = socket.socketpair()
+        self.payloads = list(payloads)
+        self.notifies = []
+        self.invalidated = False
+        self.dbapi_connection = self
+
+    def fileno(self):
+        return self.ours.fileno()
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql):
+        self.theirs.send(b'x')
+
+    def poll(self):
+        if not self.payloads:
+            raise OSError("server closed the connection unexpectedly")
+        self.ours.recv(1)
+        self.notifies.append(FakeNotify(self.payloads.pop(0)))
+        # wake the next select: another payload, or the lost connection
+        self.theirs.send(b'x')
+
+    def invalidate(self):
+        self.invalidated = True
+        self.ours.close()
+        self.theirs.close()
+
+
+class FakeEngine:
+    def __init__(self, connections):
+        self.connections = list(connections)
+
+    def raw_connection(self):
+        if not self.connections:
+            threading.Event().wait()
+        return self.connections.pop(0)
+
+
+class PostgresChannelTestCase(TestCase):
+    """Test the LISTEN loop."""
+
+    def test_reconnects(self):
+        first = FakePgConnection([json.dumps(event(10, 1))])
+        second = FakePgConnection([json.dumps(event(11, 1))])
+        hub = live.Hub()
+        sub = hub.subscribe({1})
+        channel = live.PostgresChannel(hub, FakeEngine([first, second]))
+
+        delay = live.PG_RECONNECT_DELAY
+        live.PG_RECONNECT_DELAY = 0
+        try:
+            with self.assertLogs('live', 'ERROR'):
+                channel.start()
+                self.assertEqual(sub.get(1)['id'], 10)
+                self.assertEqual(sub.get(1)['id'], 11)
+        finally:
+            live.PG_RECONNECT_DELAY = delay
+        self.assertTrue(first.invalidated)
+
+
+class StreamViewTestCase(TestCase):
+    """Test the /timeline/stream endpoint."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([User(id=i, username=f"user{i}",
+                                 email=f"u{i}@test.com", password="x")
+                            for i in range(1, 4)])
+        db.session.commit()
+        db.session.add(Follows(user_following_id=1, user_being_followed_id=2))
+        db.session.add_all([Message(id=10, text="old", user_id=2),
+                            Message(id=11, text="missed", user_id=2),
+                            Message(id=12, text="unfollowed", user_id=3)])
+        db.session.commit()
+
+        self.config = {key: app.config[key]
+                       for key in ('LIVE_UPDATES', 'LIVE_HEARTBEAT')}
+        app.config['LIVE_UPDATES'] = True
+        app.config['LIVE_HEARTBEAT'] = 0.05
+        self.hub = app.extensions['live']['hub']
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def tearDown(self):
+        app.config.update(self.config)
+        db.session.rollback()
+
+    def test_stream(self):
+        resp = self.client.get("/timeline/stream",
+                               headers={'Last-Event-ID': '10'})
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        body = iter(resp.response)
+
+        self.assertEqual(next(body), b"retry: 3000\n\n")
+        self.assertIn(b'"text": "missed"', next(body))
+
+        self.hub.publish(event(20, 3))
+        self.hub.publish(event(21, 2))
+        chunk = next(body)
+        self.assertTrue(chunk.startswith(b"id: 21\nevent: message\n"))
+        self.assertEqual(next(body), b": keepalive\n\n")
+
+        resp.close()
+        self.assertEqual(self.hub.streams, 0)
+
+    def test_messages_add_publishes(self):
+        sub = self.hub.subscribe({1})
+        self.client.post("/messages/new", data={"text": "live!"})
+
+        pushed = sub.get(1)
+        self.hub.unsubscribe(sub)
+        self.assertEqual(pushed['text'], "live!")
+        self.assertEqual(pushed['username'], "user1")
+
+    def test_stream_off(self):
+        app.config['LIVE_UPDATES'] = False
+        self.assertEqual(self.client.get("/timeline/stream").status_code, 404)
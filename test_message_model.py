@@ -14,9 +14,11 @@ from models import db, User, Message, Follows, Likes
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
-# connected to the database
+# connected to the database). That's a SQLite file by default; set
+# TEST_DATABASE_URL=postgresql:///warbler-test to test against Postgres.
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
 
 
 # Now we can import app
@@ -92,4 +94,41 @@ class MessageModelTestCase(TestCase):
         
         u2liked = Likes.query.filter(Likes.user_id == u2.id).all()
         self.assertEqual(len(u2liked),1)
-        self.assertEqual(u2liked[0].message_id, msg1.id)
\ No newline at end of file
+        self.assertEqual(u2liked[0].message_id, msg1.id)
+
+    def test_many_users_like_a_message(self):
+        msg = Message(text="popular", user_id=self.uid)
+        u2 = User.signup("user2", "user2@email.com", "password2", None)
+        u3 = User.signup("user3", "user3@email.com", "password3", None)
+        db.session.add(msg)
+        db.session.commit()
+
+        u2.likes.append(msg)
+        u3.likes.append(msg)
+        db.session.commit()
+        self.assertEqual(Likes.query.filter_by(message_id=msg.id).count(), 2)
+
+        db.session.add(Likes(user_id=u2.id, message_id=msg.id))
+        with self.assertRaises(exc.IntegrityError):
+            db.session.commit()
+
+    def test_page_like_state(self):
+        msgs = [Message(text=f"message {i}", user_id=self.uid)
+                for i in range(3)]
+        u2 = User.signup("user2", "user2@email.com", "password2", None)
+        u3 = User.signup("user3", "user3@email.com", "password3", None)
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        u2.likes = [msgs[0], msgs[1]]
+        u3.likes = [msgs[0]]
+        db.session.commit()
+        ids = [msg.id for msg in msgs]
+
+        self.assertEqual(Likes.page_state(u3.id, ids),
+                         ({msgs[0].id}, {msgs[0].id: 2, msgs[1].id: 1}))
+        # only the messages asked about
+        self.assertEqual(Likes.page_state(u2.id, [msgs[1].id]),
+                         ({msgs[1].id}, {msgs[1].id: 1}))
+        self.assertEqual(Likes.page_state(None, ids)[0], set())
+        self.assertEqual(Likes.page_state(u2.id, []), (set(), {}))
@@ -6,21 +6,24 @@
 
 
 import os
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 
 from models import db, connect_db, Message, User
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
-# connected to the database
+# connected to the database). That's a SQLite file by default; set
+# TEST_DATABASE_URL=postgresql:///warbler-test to test against Postgres.
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
 
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import search
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -165,4 +168,85 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(res.status_code, 200)
             
             msgT = Message.query.get(6666)
-            self.assertIsNotNone(msgT)
\ No newline at end of file
+            self.assertIsNotNone(msgT)
+
+    def test_message_search(self):
+        """Messages posted through the view are searchable"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "singing birds at dawn"})
+            c.post("/messages/new", data={"text": "coffee and code"})
+
+            res = c.get("/messages/search?q=birds")
+            self.assertEqual(res.status_code, 200)
+            self.assertIn("singing birds at dawn", str(res.data))
+            self.assertNotIn("coffee and code", str(res.data))
+
+    def test_message_search_after_delete(self):
+        """Deleted messages drop out of search results"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "delete me later"})
+            msg = Message.query.one()
+            c.post(f"/messages/{msg.id}/delete")
+
+            res = c.get("/messages/search?q=delete")
+            self.assertIn("Sorry, no warbles found", str(res.data))
+
+    def test_message_search_pages(self):
+        """Cursor pagination walks every match exactly once"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for i in range(5):
+                c.post("/messages/new", data={"text": f"warble number {i}"})
+
+        seen = []
+        cursor = None
+        while True:
+            messages, cursor = search.search_messages("warble", cursor=cursor, limit=2)
+            seen.extend(msg.text for msg in messages)
+            if cursor is None:
+                break
+
+        self.assertEqual(sorted(seen), [f"warble number {i}" for i in range(5)])
+
+    def test_bad_search_cursor(self):
+        for value in ('[1e400, 1]', '[1, 1e400]', '["x", 1]', '[1]'):
+            cursor = search.base64.urlsafe_b64encode(value.encode()).decode()
+            self.assertIsNone(search.decode_cursor(cursor))
+
+        res = self.client.get("/messages/search?q=warble&cursor="
+                              + search.encode_cursor(float('inf'), 1))
+        self.assertEqual(res.status_code, 200)
+
+    @skipUnless(os.environ['DATABASE_URL'].startswith('postgresql'),
+                "ts_rank_cd ties only matter on Postgres")
+    def test_message_search_pages_tied_ranks(self):
+        """Pages of equally ranked matches join up exactly (the score is
+        float4 in Postgres, float8 in the cursor)"""
+
+        db.session.add_all([Message(text="tied rank warble",
+                                    user_id=self.testuser.id)
+                            for _ in range(7)])
+        db.session.commit()
+
+        seen = []
+        cursor = None
+        while True:
+            messages, cursor = search.search_messages("tied", cursor=cursor,
+                                                      limit=3)
+            seen.extend(msg.id for msg in messages)
+            if cursor is None:
+                break
+
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)
@@ -0,0 +1,153 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app
+import metrics
+
+app.app_context().push()
+db.create_all()
+
+
+def sample(text, line_start):
+    """Value of the metric line starting with `line_start`."""
+
+    for line in text.splitlines():
+        if line.startswith(line_start):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+class RegistryTestCase(TestCase):
+    """Test recording and exposition, without the app."""
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        for value in (0.001, 0.02, 0.02, 30):
+            registry.observe('warbler_http_request_duration_seconds',
+                             {'endpoint': 'homepage', 'method': 'GET'}, value)
+
+        text = metrics.exposition([registry.snapshot()])
+        labels = 'endpoint="homepage",method="GET"'
+        name = 'warbler_http_request_duration_seconds'
+        self.assertEqual(sample(text, f'{name}_bucket{{{labels},le="0.005"}}'), 1)
+        self.assertEqual(sample(text, f'{name}_bucket{{{labels},le="0.025"}}'), 3)
+        self.assertEqual(sample(text, f'{name}_bucket{{{labels},le="10"}}'), 3)
+        self.assertEqual(sample(text, f'{name}_bucket{{{labels},le="+Inf"}}'), 4)
+        self.assertEqual(sample(text, f'{name}_count{{{labels}}}'), 4)
+        self.assertAlmostEqual(sample(text, f'{name}_sum{{{labels}}}'), 30.041)
+        self.assertIn(f'# TYPE {name} histogram', text)
+
+    def test_merge_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = metrics.FileStore(directory)
+
+            for pid, count in ((101, 2), (102, 3)):
+                registry = metrics.Registry()
+                registry.inc('warbler_http_requests_total',
+                             {'endpoint': 'login', 'method': 'GET',
+                              'status': '200'}, count)
+                with open(os.path.join(directory, f'{pid}.json'), 'w') as f:
+                    metrics.json.dump(registry.snapshot(), f)
+
+            text = metrics.exposition(store.read_all())
+            self.assertEqual(sample(
+                text, 'warbler_http_requests_total{endpoint="login",'
+                      'method="GET",status="200"}'), 5)
+
+            store.clear()
+            self.assertEqual(store.read_all(), [])
+
+    def test_shared_directory_refused(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertTrue(metrics.FileStore.private(directory))
+            os.chmod(directory, 0o777)
+            with self.assertLogs('metrics', 'WARNING'):
+                self.assertFalse(metrics.FileStore.private(directory))
+
+    def test_write_refuses_symlink(self):
+        with tempfile.TemporaryDirectory() as directory:
+            target = os.path.join(directory, 'target')
+            open(target, 'w').close()
+            os.symlink(target, os.path.join(directory,
+                                            f'{os.getpid()}.json.tmp'))
+
+            with self.assertRaises(OSError):
+                metrics.FileStore(directory).write({})
+            with open(target) as f:
+                self.assertEqual(f.read(), '')
+
+    def test_label_escaping(self):
+        self.assertEqual(metrics.format_labels([('q', 'a"b\\c\n')]),
+                         r'{q="a\"b\\c\n"}')
+
+
+class MetricsViewTestCase(TestCase):
+    """Test request metrics and the /metrics endpoint."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        db.session.add(User.signup("testuser", "test@test.com", "password",
+                                   None))
+        db.session.commit()
+
+        # record into a fresh registry for each test
+        self.metrics = app.extensions['metrics']
+        self.registry = self.metrics.registry
+        self.metrics.registry = metrics.Registry()
+        self.metrics.registry.add_collector(metrics.cache_stats(app))
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.metrics.registry = self.registry
+
+    def test_request_metrics(self):
+        self.client.get('/users')
+        self.client.get('/users')
+        self.client.get('/no-such-page')
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertEqual(sample(
+            text, 'warbler_http_requests_total{endpoint="list_users",'
+                  'method="GET",status="200"}'), 2)
+        self.assertEqual(sample(
+            text, 'warbler_http_requests_total{endpoint="unknown",'
+                  'method="GET",status="404"}'), 1)
+        self.assertEqual(sample(
+            text, 'warbler_http_request_duration_seconds_count'
+                  '{endpoint="list_users",method="GET"}'), 2)
+        self.assertGreater(sample(
+            text, 'warbler_db_queries_per_request_sum'
+                  '{endpoint="list_users"}'), 0)
+        self.assertIn('warbler_cache_hits_total{cache="thumbnails"}', text)
+
+    def test_pool_checkout(self):
+        db.engine.dispose()
+
+        self.client.get('/users')
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertGreater(
+            sample(text, 'warbler_db_pool_checkout_seconds_count'), 0)
+
+    def test_metrics_restricted(self):
+        res = self.client.get('/metrics',
+                              environ_base={'REMOTE_ADDR': '203.0.113.9'})
+        self.assertEqual(res.status_code, 404)
+
+        res = self.client.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
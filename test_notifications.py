@@ -0,0 +1,160 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Notification
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, CURR_USER_KEY
+import archive
+import notifications
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class NotificationsTestCase(TestCase):
+    """Test aggregation, unread counts and the notifications page."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([User(id=i, username=f"user{i}",
+                                 email=f"u{i}@test.com", password="x")
+                            for i in range(1, 6)])
+        db.session.commit()
+        db.session.add(Message(id=100, text="viral", user_id=1))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_bucket_start(self):
+        when = datetime(2024, 3, 5, 17, 30)
+        self.assertEqual(notifications.bucket_start(when, 24),
+                         datetime(2024, 3, 5))
+        self.assertEqual(notifications.bucket_start(when, 6),
+                         datetime(2024, 3, 5, 12))
+
+    def test_likes_aggregate_per_bucket(self):
+        message = db.session.get(Message, 100)
+        day = datetime(2024, 3, 5, 9)
+        for actor_id in (2, 3, 4):
+            notifications.record(1, 'like', 'like:100', actor_id,
+                                 message_id=message.id,
+                                 now=day + timedelta(hours=actor_id))
+        notifications.record(1, 'like', 'like:100', 5, message_id=100,
+                             now=day + timedelta(days=1))
+        db.session.commit()
+
+        rows = (Notification.query
+                .order_by(Notification.bucket).all())
+        self.assertEqual([(n.count, n.last_actor_id) for n in rows],
+                         [(3, 4), (1, 5)])
+        self.assertEqual(rows[0].updated_at, day + timedelta(hours=4))
+
+    def test_like_and_follow_views_notify(self):
+        self.login(2)
+        self.client.post("/users/add_like/100")
+        self.client.post("/users/follow/1")
+        self.client.post("/users/follow/1")
+        self.login(3)
+        self.client.post("/users/add_like/100")
+        # unliking doesn't notify
+        self.client.post("/users/add_like/100")
+
+        rows = {n.group_key: n for n in Notification.query.all()}
+        self.assertEqual(set(rows), {'like:100', 'follow'})
+        self.assertEqual(rows['like:100'].count, 2)
+        self.assertEqual(rows['like:100'].last_actor_id, 3)
+        self.assertEqual(rows['follow'].count, 1)
+
+    def test_unread_count_and_page(self):
+        for actor_id in (2, 3):
+            notifications.record_like(db.session.get(Message, 100),
+                                      db.session.get(User, actor_id))
+        notifications.record_follow(1, db.session.get(User, 4))
+        db.session.commit()
+
+        user = db.session.get(User, 1)
+        self.assertEqual(notifications.unread_count(user), 2)
+
+        self.login(1)
+        resp = self.client.get("/notifications")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@user3", html)
+        self.assertIn("and 1 other", html)
+        self.assertIn("liked your", html)
+        self.assertIn("followed you", html)
+
+        db.session.expire_all()
+        self.assertEqual(
+            notifications.unread_count(db.session.get(User, 1)), 0)
+
+        notifications.record_follow(1, db.session.get(User, 5))
+        db.session.commit()
+        resp = self.client.get("/")
+        self.assertIn('<span class="badge badge-danger">1</span>',
+                      resp.get_data(as_text=True))
+
+    def test_page_cursor(self):
+        start = datetime(2024, 3, 5)
+        for i in range(5):
+            notifications.record(1, 'like', f"like:{i}", 2,
+                                 now=start + timedelta(days=i))
+        db.session.commit()
+
+        rows, next_page = notifications.page(1, size=2)
+        seen = [row.id for row in rows]
+        while next_page:
+            rows, next_page = notifications.page(1, next_page, size=2)
+            seen += [row.id for row in rows]
+
+        self.assertEqual(seen, [5, 4, 3, 2, 1])
+        self.assertIsNone(notifications.page(1, "bad_1"))
+
+    def test_page_requires_login(self):
+        resp = self.client.get("/notifications", follow_redirects=True)
+        self.assertIn("Access unauthorized", resp.get_data(as_text=True))
+
+    def test_survives_archiving(self):
+        db.session.get(Message, 100).timestamp = datetime(2024, 1, 15)
+        notifications.record_like(db.session.get(Message, 100),
+                                  db.session.get(User, 2))
+        db.session.commit()
+        list(archive.archive_before(datetime(2024, 4, 1)))
+
+        rows, _ = notifications.page(1)
+        self.assertEqual([(row.group_key, row.message_text) for row in rows],
+                         [('like:100', 'viral')])
+
+    def test_deleted_message(self):
+        notifications.record_like(db.session.get(Message, 100),
+                                  db.session.get(User, 2))
+        notifications.record_follow(1, db.session.get(User, 3))
+        db.session.commit()
+
+        self.login(1)
+        self.client.post("/messages/100/delete")
+
+        self.assertEqual([n.group_key for n in Notification.query.all()],
+                         ['follow'])
@@ -0,0 +1,113 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from werkzeug.test import Client
+
+from models import db
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app
+from profiler import ProfilerMiddleware, StackSampler
+
+app.app_context().push()
+db.create_all()
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class ProfilerTestCase(TestCase):
+    """Test opt-in request profiling."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = dict(app.config)
+        app.config.update(PROFILER_TOKEN='s3cret', PROFILER_SAMPLE_RATE=0,
+                          PROFILER_ENDPOINTS=[], PROFILER_MODE='sample',
+                          PROFILER_INTERVAL=0.001, PROFILER_DIR=self.tmp.name)
+
+    def tearDown(self):
+        app.config.clear()
+        app.config.update(self.config)
+        self.tmp.cleanup()
+
+    def client(self):
+        return Client(ProfilerMiddleware(app.wsgi_app, app))
+
+    def get(self, client, url):
+        # buffered: close the app iterator, which finishes the profile
+        return client.get(url, buffered=True)
+
+    def test_disabled_by_default(self):
+        app.config.update(PROFILER_TOKEN='')
+        middleware = ProfilerMiddleware(app.wsgi_app, app)
+        self.assertFalse(middleware.enabled)
+
+        res = self.get(Client(middleware), '/login?__profile=')
+        self.assertNotIn('X-Profile', res.headers)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_token_required(self):
+        res = self.get(self.client(), '/login?__profile=wrong')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('X-Profile', res.headers)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+        res = self.get(self.client(), '/login?__profile=%C3%A9')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('X-Profile', res.headers)
+
+    def test_sampled_profile(self):
+        res = self.get(self.client(), '/login?__profile=s3cret')
+        self.assertEqual(res.status_code, 200)
+
+        name = res.headers['X-Profile']
+        self.assertIn('login', name)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, name + '.folded')))
+        with open(os.path.join(self.tmp.name, name + '.speedscope.json')) as f:
+            self.assertEqual(json.load(f)['profiles'][0]['type'], 'sampled')
+
+    def test_deterministic_profile(self):
+        app.config.update(PROFILER_MODE='deterministic')
+        res = self.get(self.client(), '/login?__profile=s3cret')
+
+        path = os.path.join(self.tmp.name, res.headers['X-Profile'] + '.prof')
+        stats = pstats.Stats(path)
+        self.assertTrue(any(func[2] == 'login' for func in stats.stats))
+
+    def test_sample_rate_endpoint_filter(self):
+        app.config.update(PROFILER_TOKEN='', PROFILER_SAMPLE_RATE=1.0,
+                          PROFILER_ENDPOINTS=['signup'])
+        client = self.client()
+
+        self.assertNotIn('X-Profile', self.get(client, '/login').headers)
+        self.assertIn('signup', self.get(client, '/signup').headers['X-Profile'])
+
+    def test_stack_sampler(self):
+        sampler = StackSampler(threading.get_ident(), 0.001)
+        sampler.start()
+        busy_wait(0.05)
+        sampler.stop()
+
+        folded = sampler.collapsed()
+        self.assertIn('busy_wait', folded)
+        stack, count = folded.splitlines()[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+        self.assertIn(';', stack)
@@ -0,0 +1,169 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from werkzeug.exceptions import TooManyRequests
+
+from models import db
+from ratelimit import RateLimiter, Limit, MemoryBackend, SQLiteBackend
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, limiter
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeClock:
+    """A clock the tests can move by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class BucketTestCase(TestCase):
+    """Test token buckets on both backends."""
+
+    def make_limiter(self, backend):
+        self.clock = FakeClock()
+        rules = {'login': [Limit('ip', 3, 60)],
+                 'messages_add': [Limit('user', 2, 10)]}
+        return RateLimiter(rules=rules, backend=backend, clock=self.clock)
+
+    def check_buckets(self, backend):
+        rl = self.make_limiter(backend)
+
+        for _ in range(3):
+            rl.check('login', 'POST', '1.2.3.4', None)
+
+        with self.assertRaises(TooManyRequests) as context:
+            rl.check('login', 'POST', '1.2.3.4', None)
+        self.assertIn(('Retry-After', '20'), context.exception.get_headers())
+
+        # other IPs, other methods and unlisted routes are unaffected
+        rl.check('login', 'POST', '5.6.7.8', None)
+        rl.check('login', 'GET', '1.2.3.4', None)
+        rl.check('homepage', 'POST', '1.2.3.4', None)
+
+        # one token back after 20s
+        self.clock.now += 20
+        rl.check('login', 'POST', '1.2.3.4', None)
+        with self.assertRaises(TooManyRequests):
+            rl.check('login', 'POST', '1.2.3.4', None)
+
+        # user-scoped rules skip anonymous requests
+        for _ in range(5):
+            rl.check('messages_add', 'POST', '1.2.3.4', None)
+        rl.check('messages_add', 'POST', '1.2.3.4', 1)
+        rl.check('messages_add', 'POST', '1.2.3.4', 1)
+        with self.assertRaises(TooManyRequests):
+            rl.check('messages_add', 'POST', '1.2.3.4', 1)
+
+        # refilled buckets are swept away
+        self.clock.now += 3600
+        rl.check('login', 'POST', '5.6.7.8', None)
+        self.assertEqual(self.bucket_count(backend), 1)
+
+    def bucket_count(self, backend):
+        if isinstance(backend, MemoryBackend):
+            return len(backend.buckets)
+        return backend.connect().execute(
+            "SELECT count(*) FROM token_buckets").fetchone()[0]
+
+    def test_memory_backend(self):
+        self.check_buckets(MemoryBackend())
+
+    def test_sqlite_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.check_buckets(SQLiteBackend(os.path.join(tmp, 'rl.db')))
+
+    def test_sqlite_backend_shared(self):
+        """Two backends on one file share their buckets"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rl.db')
+            a = self.make_limiter(SQLiteBackend(path))
+            b = self.make_limiter(SQLiteBackend(path))
+
+            a.check('login', 'POST', '1.2.3.4', None)
+            b.check('login', 'POST', '1.2.3.4', None)
+            a.check('login', 'POST', '1.2.3.4', None)
+            with self.assertRaises(TooManyRequests):
+                b.check('login', 'POST', '1.2.3.4', None)
+
+    def test_username_scope(self):
+        rl = RateLimiter(rules={'login': [Limit('username', 2, 60)]},
+                         clock=FakeClock())
+
+        rl.check('login', 'POST', '1.2.3.4', None, 'victim')
+        rl.check('login', 'POST', '1.2.3.4', None, 'victim')
+        with self.assertRaises(TooManyRequests):
+            rl.check('login', 'POST', '1.2.3.4', None, 'victim')
+        rl.check('login', 'POST', '1.2.3.4', None, 'someone')
+        rl.check('login', 'POST', '1.2.3.4', None, None)
+
+        # guesses from elsewhere don't lock the account out
+        rl.check('login', 'POST', '5.6.7.8', None, 'victim')
+
+    def test_needs_username(self):
+        rl = RateLimiter(rules={'login': [Limit('username', 2, 60)],
+                                'signup': [Limit('ip', 2, 60)]})
+
+        self.assertTrue(rl.needs_username('login'))
+        self.assertFalse(rl.needs_username('signup'))
+        self.assertFalse(rl.needs_username(None))
+
+
+class RateLimitViewTestCase(TestCase):
+    """Test rate limiting in the app."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        limiter.reset()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        limiter.reset()
+        db.session.rollback()
+
+    def test_login_throttled(self):
+        with self.client as c:
+            for _ in range(10):
+                res = c.post('/login', data={"username": "nobody",
+                                             "password": "password"})
+                self.assertEqual(res.status_code, 200)
+
+            res = c.post('/login', data={"username": "nobody",
+                                         "password": "password"})
+            self.assertEqual(res.status_code, 429)
+            self.assertIn('Retry-After', res.headers)
+
+            # the login form itself is never throttled
+            self.assertEqual(c.get('/login').status_code, 200)
+
+    def test_login_not_locked_out_by_others(self):
+        for i in range(10):
+            res = self.client.post(
+                '/login', data={"username": "victim", "password": "guess"},
+                environ_base={'REMOTE_ADDR': f"10.0.0.{i}"})
+            self.assertEqual(res.status_code, 200)
+
+        res = self.client.post(
+            '/login', data={"username": "victim", "password": "guess"},
+            environ_base={'REMOTE_ADDR': "10.0.1.1"})
+        self.assertEqual(res.status_code, 200)
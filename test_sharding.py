@@ -0,0 +1,255 @@
+"""Message sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import func, select
+
+from models import db, User, Follows, ShardBucket
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, CURR_USER_KEY
+import export
+import live
+import sharding
+import startup
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PlanTestCase(TestCase):
+    """Test rebalancing plans."""
+
+    def balance(self, buckets, shard_count, drain=()):
+        buckets = list(buckets)
+        for bucket, source, target in sharding.plan(buckets, shard_count,
+                                                    drain):
+            self.assertEqual(buckets[bucket], source)
+            buckets[bucket] = target
+        return [buckets.count(shard) for shard in range(shard_count)]
+
+    def test_add_shard(self):
+        buckets = [bucket % 2 for bucket in range(sharding.BUCKETS)]
+        moves = sharding.plan(buckets, 3)
+        self.assertEqual(len(moves), 85)
+        self.assertEqual(self.balance(buckets, 3), [86, 85, 85])
+
+    def test_drain(self):
+        buckets = [bucket % 3 for bucket in range(sharding.BUCKETS)]
+        self.assertEqual(self.balance(buckets, 3, drain=[1]), [128, 0, 128])
+        with self.assertRaises(ValueError):
+            sharding.plan(buckets, 1, drain=[0])
+
+    def test_balanced(self):
+        buckets = [bucket % 4 for bucket in range(sharding.BUCKETS)]
+        self.assertEqual(sharding.plan(buckets, 4), [])
+
+
+class ShardedTestCase(TestCase):
+    """Test the views with messages sharded over SQLite databases."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.directory = tempfile.mkdtemp()
+        self.shards = self.make_shards(3)
+        app.extensions['shards'] = self.shards
+
+        db.session.add_all([User(id=i, username=f"user{i}",
+                                 email=f"u{i}@test.com", password="x")
+                            for i in range(1, 7)])
+        db.session.commit()
+        db.session.add_all([Follows(user_following_id=1,
+                                    user_being_followed_id=i)
+                            for i in range(2, 6)])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions.pop('shards', None)
+        self.shards.executor.shutdown()
+        db.session.rollback()
+
+    def make_shards(self, count):
+        shards = sharding.Shards(
+            [f"sqlite:///{self.directory}/shard{i}.db" for i in range(count)],
+            map_refresh=0)
+        shards.create_all()
+        return shards
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text):
+        self.login(user_id)
+        with app.test_request_context():
+            return sharding.add_message(db.session.get(User, user_id),
+                                        text).id
+
+    def shard_messages(self, shards, shard):
+        return shards.run(shard, lambda session: session.execute(
+            select(sharding.messages.c.user_id,
+                   sharding.messages.c.text)).all())
+
+    def test_after_fork(self):
+        post_id = self.post(2, "before the fork")
+        self.assertGreater(self.shards.engines[2].pool.checkedin(), 0)
+
+        startup.dispose_engine_after_fork(app)
+
+        self.assertEqual([engine.pool.checkedin()
+                          for engine in self.shards.engines], [0, 0, 0])
+        with app.test_request_context():
+            self.assertEqual(sharding.find_message(post_id).text,
+                             "before the fork")
+
+    def test_messages_routed_by_author(self):
+        self.login(2)
+        resp = self.client.post("/messages/new", data={"text": "from two"})
+        self.assertEqual(resp.status_code, 302)
+        self.post(3, "from three")
+
+        self.assertEqual(self.shards.shard_for(2), 2)
+        self.assertEqual(self.shard_messages(self.shards, 2),
+                         [(2, "from two")])
+        self.assertEqual(self.shard_messages(self.shards, 0),
+                         [(3, "from three")])
+        self.assertEqual(self.shard_messages(self.shards, 1), [])
+
+        html = self.client.get("/users/2").get_data(as_text=True)
+        self.assertIn("from two", html)
+        self.assertNotIn("from three", html)
+
+    def test_home_timeline_merges_shards(self):
+        ids = [self.post(author, f"message {i}")
+               for i, author in enumerate([2, 3, 4, 5, 6, 1, 2, 3])]
+
+        with app.test_request_context():
+            messages = sharding.home_messages([1, 2, 3, 4, 5], limit=5)
+        # newest first, across shards; user 6 isn't followed
+        self.assertEqual([msg.id for msg in messages],
+                         [ids[7], ids[6], ids[5], ids[3], ids[2]])
+        self.assertEqual(messages[0].user.username, "user3")
+
+        self.login(1)
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("message 7", html)
+        self.assertNotIn("message 4", html)
+
+    def test_likes(self):
+        message_id = self.post(2, "likeable")
+
+        self.login(1)
+        self.client.post(f"/users/add_like/{message_id}")
+        self.login(3)
+        self.client.post(f"/users/add_like/{message_id}")
+
+        # likes live with the message, on its author's shard
+        with app.test_request_context():
+            msg = sharding.find_message(message_id)
+            self.assertEqual(sharding.page_state(1, [msg]),
+                             ({message_id}, {message_id: 2}))
+            self.assertEqual(sharding.like_count(1), 1)
+            self.assertEqual(sharding.message_count(2), 1)
+
+        html = self.client.get("/users/1/likes").get_data(as_text=True)
+        self.assertIn("likeable", html)
+
+        self.login(1)
+        self.client.post(f"/users/add_like/{message_id}")
+        with app.test_request_context():
+            self.assertEqual(sharding.like_count(1), 0)
+
+    def test_likes_page_bad_cursor(self):
+        message_id = self.post(2, "likeable")
+        self.login(1)
+        self.client.post(f"/users/add_like/{message_id}")
+
+        for before in ("5", "_5", "x_y"):
+            html = self.client.get(f"/users/1/likes?before={before}"
+                                   ).get_data(as_text=True)
+            self.assertIn("likeable", html)
+
+    def test_export(self):
+        mine = self.post(1, "my own")
+        liked = self.post(2, "theirs")
+        self.login(1)
+        self.client.post(f"/users/add_like/{liked}")
+
+        with app.test_request_context():
+            records = [json.loads(line) for line
+                       in b''.join(export.export_chunks(1)).splitlines()]
+        self.assertIn({'type': 'message', 'id': mine, 'text': "my own",
+                       'timestamp': records[1]['timestamp']}, records)
+        like, = [record for record in records if record['type'] == 'like']
+        self.assertEqual((like['id'], like['user_id'], like['text']),
+                         (liked, 2, "theirs"))
+
+    def test_live_backfill(self):
+        ids = [self.post(author, f"message {i}")
+               for i, author in enumerate([2, 3, 4, 6])]
+
+        with app.test_request_context():
+            events = live.missed_events([2, 3, 4], ids[0])
+        self.assertEqual([event['id'] for event in events], ids[1:3])
+        self.assertEqual(events[0]['username'], "user3")
+
+    def test_show_and_delete(self):
+        message_id = self.post(4, "short-lived")
+
+        resp = self.client.get(f"/messages/{message_id}")
+        self.assertIn("short-lived", resp.get_data(as_text=True))
+
+        self.login(4)
+        self.client.post(f"/messages/{message_id}/delete")
+        self.assertEqual(self.client.get(f"/messages/{message_id}")
+                         .status_code, 404)
+        self.assertEqual(self.shard_messages(self.shards, 1), [])
+
+    def test_rebalance_onto_new_shard(self):
+        self.shards.executor.shutdown()
+        self.shards = self.make_shards(2)
+        app.extensions['shards'] = self.shards
+
+        ids = {author: self.post(author, f"by {author}")
+               for author in range(1, 7)}
+        self.login(1)
+        self.client.post(f"/users/add_like/{ids[2]}")
+
+        bigger = self.make_shards(3)
+        moves = list(sharding.rebalance(bigger, settle=0))
+        self.assertEqual(len(moves), 85)
+        self.assertEqual(
+            db.session.scalar(select(func.count())
+                              .where(ShardBucket.shard == 2)), 85)
+
+        self.shards.executor.shutdown()
+        self.shards = bigger
+        app.extensions['shards'] = bigger
+
+        # every message is on its author's shard, and only there
+        with app.test_request_context():
+            for author, message_id in ids.items():
+                shard = bigger.shard_for(author)
+                self.assertIn((author, f"by {author}"),
+                              self.shard_messages(bigger, shard))
+                self.assertEqual(sharding.find_message(message_id).text,
+                                 f"by {author}")
+            self.assertEqual(sum(len(self.shard_messages(bigger, shard))
+                                 for shard in range(3)), 6)
+            self.assertEqual(sharding.like_count(1), 1)
@@ -0,0 +1,163 @@
+"""Slow query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slowlog.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app
+import slowlog
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test logging, plan capture and the summary."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        db.session.add(User.signup("testuser", "test@test.com", "password",
+                                   None))
+        db.session.commit()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'slow.log')
+        self.client = app.test_client()
+        self.log = None
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        if self.log is None:
+            return
+        for name, fn in (('before_cursor_execute', self.log.before_execute),
+                         ('after_cursor_execute', self.log.after_execute),
+                         ('handle_error', self.log.handle_error)):
+            event.remove(db.engine, name, fn)
+        self.log.close()
+
+    def start(self, **kwargs):
+        # a threshold of 0 logs every statement
+        self.log = slowlog.SlowQueryLog(self.path, 0, **kwargs)
+        self.log.listen(db.engine)
+
+    def entries(self):
+        return list(slowlog.read_entries(self.path))
+
+    def test_logs_request_queries(self):
+        self.start()
+        self.client.get('/users')
+
+        entries = [entry for entry in self.entries()
+                   if entry['endpoint'] == 'list_users']
+        self.assertTrue(entries)
+        entry = entries[0]
+        self.assertEqual(entry['method'], 'GET')
+        self.assertEqual(entry['path'], '/users')
+        self.assertIn('users', entry['statement'])
+        self.assertTrue(entry['stack'][0].startswith('app.py:'))
+        self.assertIn('list_users', entry['stack'][0])
+        self.assertTrue(entry['plan'])
+
+    def test_explain_rate_limited(self):
+        self.start(explain_interval=3600)
+        User.query.filter_by(username='testuser').all()
+        User.query.filter_by(username='nobody').all()
+
+        first, second = self.entries()
+        self.assertEqual(first['statement'], second['statement'])
+        self.assertTrue(first['plan'])
+        self.assertIsNone(second['plan'])
+        self.assertEqual(second['parameters'], '<1 parameters>')
+
+    def test_log_parameters(self):
+        self.start(log_parameters=True)
+        User.query.filter_by(username='nobody').all()
+
+        entry, = self.entries()
+        self.assertIn("'nobody'", entry['parameters'])
+
+    def test_no_parameters_by_default(self):
+        self.start()
+        self.client.post('/login', data={'username': 'testuser',
+                                         'password': 'password'})
+
+        with open(self.path) as f:
+            log = f.read()
+        self.assertIn('users', log)
+        self.assertNotIn('testuser', log)
+        self.assertNotIn('$2b$', log)
+
+    def test_redact_plan_literals(self):
+        self.assertEqual(
+            slowlog.STRING_LITERAL.sub(
+                "'?'", "Filter: ((email)::text = 'o''neil@test.com'::text)"),
+            "Filter: ((email)::text = '?'::text)")
+
+    def test_reopen_after_rotation(self):
+        self.start()
+        User.query.all()
+        os.rename(self.path, self.path + '.1')
+        User.query.count()
+
+        self.assertEqual(len(self.entries()), 2)
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_no_explain_for_writes(self):
+        self.start()
+        db.session.add(User(username="other", email="o@test.com",
+                            password="x"))
+        db.session.commit()
+
+        insert = [entry for entry in self.entries()
+                  if entry['statement'].startswith('INSERT')]
+        self.assertEqual(len(insert), 1)
+        self.assertIsNone(insert[0]['plan'])
+
+    def test_endpoint_filter(self):
+        self.start(endpoints=['homepage'])
+        self.client.get('/users')
+        User.query.all()
+
+        self.assertEqual(self.entries(), [])
+
+    def test_summarize(self):
+        self.start()
+        User.query.filter(User.id.in_([1, 2])).all()
+        User.query.filter(User.id.in_([1, 2, 3])).all()
+        User.query.count()
+
+        groups = slowlog.summarize(self.entries(), 'count')
+        self.assertEqual(groups[0]['count'], 2)
+        self.assertIn('IN (...)', groups[0]['statement'])
+
+    def test_cli(self):
+        self.start()
+        self.client.get('/users')
+
+        config = app.config['SLOW_QUERY_LOG']
+        app.config['SLOW_QUERY_LOG'] = self.path
+        try:
+            result = app.test_cli_runner().invoke(
+                args=['slow-queries', '--top', '2', '--plans'])
+        finally:
+            app.config['SLOW_QUERY_LOG'] = config
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('list_users', result.output)
+        self.assertIn('calls', result.output)
@@ -0,0 +1,65 @@
+"""Production startup tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_startup.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app
+import startup
+
+app.app_context().push()
+db.create_all()
+
+
+class StartupTestCase(TestCase):
+    """Test template precompilation and fork-safe engine disposal."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bytecode_cache = app.jinja_env.bytecode_cache
+
+    def tearDown(self):
+        app.jinja_env.bytecode_cache = self.bytecode_cache
+        self.tmp.cleanup()
+
+    def test_precompile_templates(self):
+        startup.enable_bytecode_cache(app, self.tmp.name)
+        app.jinja_env.cache.clear()
+
+        names = startup.precompile_templates(app)
+
+        self.assertIn('base.html', names)
+        self.assertIn('users/detail.html', names)
+        self.assertEqual(len(os.listdir(self.tmp.name)), len(names))
+
+        # already compiled: served from the in-memory cache
+        template = app.jinja_env.get_template('base.html')
+        self.assertIs(app.jinja_env.get_template('base.html'), template)
+
+    def test_unsafe_cache_directory_refused(self):
+        app.jinja_env.bytecode_cache = None
+        os.chmod(self.tmp.name, 0o777)
+        self.assertFalse(startup.enable_bytecode_cache(app, self.tmp.name))
+        self.assertIsNone(app.jinja_env.bytecode_cache)
+
+        link = os.path.join(self.tmp.name, 'link')
+        os.symlink(tempfile.mkdtemp(), link)
+        self.assertFalse(startup.enable_bytecode_cache(app, link))
+
+        private = os.path.join(self.tmp.name, 'private')
+        self.assertTrue(startup.enable_bytecode_cache(app, private))
+        self.assertEqual(os.stat(private).st_mode & 0o777, 0o700)
+
+    def test_dispose_engine_after_fork(self):
+        startup.dispose_engine_after_fork(app)
+        db.session.execute(db.text("SELECT 1"))
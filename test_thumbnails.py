@@ -0,0 +1,176 @@
+"""Thumbnail cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_thumbnails.py
+
+
+import io
+import os
+import tempfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase
+
+from flask import Flask
+from PIL import Image
+
+from models import db
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app
+import thumbnails
+
+app.app_context().push()
+db.create_all()
+
+
+def make_png(width, height):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(out, 'PNG')
+    return out.getvalue()
+
+
+class StubImageHandler(BaseHTTPRequestHandler):
+    """Serves a 400x300 PNG at /avatar.png, redirecting to it from
+    /redirect, and counts requests."""
+
+    png = make_png(400, 300)
+    hits = 0
+
+    def do_GET(self):
+        StubImageHandler.hits += 1
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/avatar.png')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path != '/avatar.png':
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(self.png)))
+        self.end_headers()
+        self.wfile.write(self.png)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThumbnailTestCase(TestCase):
+    """Test the thumbnail endpoint against a local stub image server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StubImageHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.thumbnailer = app.extensions['thumbnails']
+        app.extensions['thumbnails'] = thumbnails.Thumbnailer(
+            thumbnails.ThumbnailCache(self.tmp.name, 10 * 1024 * 1024), 2,
+            allow_private=True)
+        StubImageHandler.hits = 0
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions['thumbnails'] = self.thumbnailer
+        self.tmp.cleanup()
+
+    def test_thumbnail_fetched_once(self):
+        with app.test_request_context():
+            url = thumbnails.thumbnail_url(f"{self.base}/avatar.png", 'sm')
+
+        for _ in range(3):
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.mimetype, 'image/jpeg')
+            with Image.open(io.BytesIO(res.data)) as image:
+                self.assertEqual(image.size, thumbnails.SIZES['sm'])
+            self.assertNotIn('no-cache', res.headers['Cache-Control'])
+            res.close()
+
+        self.assertEqual(StubImageHandler.hits, 1)
+
+    def test_local_images_not_proxied(self):
+        with app.test_request_context():
+            self.assertEqual(
+                thumbnails.thumbnail_url("/static/images/default-pic.png"),
+                "/static/images/default-pic.png")
+
+    def test_shared_cache_directory_refused(self):
+        shared = os.path.join(self.tmp.name, 'shared')
+        os.mkdir(shared)
+        os.chmod(shared, 0o777)
+        other = Flask(__name__)
+        other.config.update(app.config, THUMBNAIL_CACHE_DIR=shared)
+
+        with self.assertLogs('thumbnails', 'WARNING'):
+            thumbnails.init_app(other)
+        self.assertNotIn('thumbnails', other.extensions)
+        with other.test_request_context():
+            self.assertEqual(thumbnails.thumbnail_url(f"{self.base}/a.png"),
+                             f"{self.base}/a.png")
+
+    def test_bad_token(self):
+        res = self.client.get(f"/thumbs/sm/{self.base}/avatar.png")
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(StubImageHandler.hits, 0)
+
+    def test_missing_source(self):
+        with app.test_request_context():
+            url = thumbnails.thumbnail_url(f"{self.base}/missing.png", 'sm')
+        self.assertEqual(self.client.get(url).status_code, 502)
+
+        # the failure is remembered for a while
+        self.assertEqual(self.client.get(url).status_code, 502)
+        self.assertEqual(StubImageHandler.hits, 1)
+
+    def test_redirect(self):
+        with app.test_request_context():
+            url = thumbnails.thumbnail_url(f"{self.base}/redirect", 'md')
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        res.close()
+        self.assertEqual(StubImageHandler.hits, 2)
+
+    def test_private_addresses_refused(self):
+        app.extensions['thumbnails'].allow_private = False
+        with app.test_request_context():
+            url = thumbnails.thumbnail_url(f"{self.base}/avatar.png", 'sm')
+        self.assertEqual(self.client.get(url).status_code, 502)
+        self.assertEqual(StubImageHandler.hits, 0)
+
+        for url in ("http://169.254.169.254/latest/meta-data/",
+                    "http://10.0.0.1/a.png", "http://localhost:8080/a.png",
+                    "http://[::1]/a.png", "http://[::ffff:127.0.0.1]/a.png",
+                    "file:///etc/passwd"):
+            with self.assertRaises(ValueError):
+                thumbnails.fetch(url)
+
+    def test_lru_eviction(self):
+        cache = thumbnails.ThumbnailCache(os.path.join(self.tmp.name, 'lru'), 250)
+
+        cache.put('a' * 64, b'x' * 100)
+        cache.put('b' * 64, b'x' * 100)
+        os.utime(cache.path('a' * 64), (1, 1))
+        os.utime(cache.path('b' * 64), (2, 2))
+        cache.get('a' * 64)  # a is now the most recently used
+
+        cache.put('c' * 64, b'x' * 100)
+
+        self.assertIsNotNone(cache.get('a' * 64))
+        self.assertIsNone(cache.get('b' * 64))
+        self.assertIsNotNone(cache.get('c' * 64))
+        self.assertLessEqual(cache.total_bytes, 250)
@@ -0,0 +1,117 @@
+"""Timeline cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
+
+from app import app, CURR_USER_KEY
+import timeline
+
+app.app_context().push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineCacheTestCase(TestCase):
+    """Test the cached/merged home timeline against the SQL one."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.users = [User(id=i, username=f"user{i}", email=f"u{i}@test.com",
+                           password="x") for i in range(1, 6)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+        # viewer 1 follows 2, 3 and 4; 5 is a stranger
+        db.session.add_all([Follows(user_being_followed_id=i, user_following_id=1)
+                            for i in (2, 3, 4)])
+
+        start = datetime(2024, 1, 1)
+        db.session.add_all([
+            Message(text=f"message {n} by {n % 5 + 1}", user_id=n % 5 + 1,
+                    timestamp=start + timedelta(minutes=n * 7 % 300))
+            for n in range(300)
+        ])
+        db.session.commit()
+
+        self.config = app.config['TIMELINE_ENGINE']
+        self.extension = app.extensions.get('timeline')
+        app.config['TIMELINE_ENGINE'] = 'cache'
+        app.extensions['timeline'] = self.cache = timeline.TimelineCache(per_author=20)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['TIMELINE_ENGINE'] = self.config
+        if self.extension is None:
+            app.extensions.pop('timeline')
+        else:
+            app.extensions['timeline'] = self.extension
+        db.session.rollback()
+
+    def sql_home_ids(self, author_ids, limit):
+        return [msg.id for msg in (Message.query
+                                   .filter(Message.user_id.in_(author_ids))
+                                   .order_by(Message.timestamp.desc(), Message.id.desc())
+                                   .limit(limit))]
+
+    def test_matches_sql(self):
+        for limit in (1, 10, 20, 50):
+            self.assertEqual(self.cache.home_ids([1, 2, 3, 4], limit)[:20],
+                             self.sql_home_ids([1, 2, 3, 4], limit)[:20])
+
+    def test_per_author_bound(self):
+        self.cache.home_ids([1, 2], 10)
+        self.assertEqual(len(self.cache.authors[1].ids), 20)
+
+    def test_invalidation(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            c.get('/')
+            c.post('/messages/new', data={"text": "brand new warble"})
+            new = Message.query.filter_by(text="brand new warble").one()
+
+            self.assertEqual(self.cache.home_ids([1, 2, 3, 4], 1), [new.id])
+
+            c.post(f'/messages/{new.id}/delete')
+            self.assertNotIn(new.id, self.cache.home_ids([1, 2, 3, 4], 20))
+            self.assertEqual(self.cache.home_ids([1, 2, 3, 4], 20),
+                             self.sql_home_ids([1, 2, 3, 4], 20))
+
+    def test_homepage(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            res = c.get('/')
+            self.assertEqual(res.status_code, 200)
+            html = str(res.data)
+            newest = Message.query.get(self.sql_home_ids([1, 2, 3, 4], 1)[0])
+            self.assertIn(newest.text, html)
+            self.assertNotIn("by 5<", html)
+
+    def test_recent_messages_add_out_of_order(self):
+        recent = timeline.RecentMessages([], 0)
+        for msg_stamp, msg_id in [(10, 1), (30, 3), (20, 2)]:
+            recent.add(msg_stamp, msg_id, limit=2)
+        self.assertEqual(list(recent.newest()), [(30, 3), (20, 2), (10, 1)])
+
+        # trimmed back to `limit` once it doubles
+        recent.add(5, 0, limit=2)
+        self.assertEqual(list(recent.newest()), [(30, 3), (20, 2)])
+        self.assertEqual(len(recent.ids), 2)
@@ -6,6 +6,9 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
+import csv
+import io
+import json
 import os
 from unittest import TestCase
 
@@ -15,14 +18,16 @@ from bs4 import BeautifulSoup
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
-# connected to the database
+# connected to the database). That's a SQLite file by default; set
+# TEST_DATABASE_URL=postgresql:///warbler-test to test against Postgres.
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "sqlite:///warbler-test.db")
 
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, LIKES_PAGE_SIZE
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -30,6 +35,10 @@ from app import app, CURR_USER_KEY
 app.app_context().push()
 db.create_all()
 
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
 
 class UserViewTestCase(TestCase):
     """Test views for user."""
@@ -133,6 +142,31 @@ class UserViewTestCase(TestCase):
             #test for a count of 1 liked
             self.assertIn("1", found[3].text)  
             
+    def test_home_like_state(self):
+        self.setup_likes()
+        db.session.add_all([
+            Follows(user_being_followed_id=self.user1_id,
+                    user_following_id=self.userT_id),
+            Likes(user_id=self.user2_id, message_id=123),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.userT_id
+
+            res = c.get('/')
+            soup = BeautifulSoup(res.data, 'html.parser')
+            form = soup.find('form', {'action': '/users/add_like/123'})
+            self.assertIn('btn-primary', form.button['class'])
+            self.assertEqual(form.button.text.strip(), '2')
+
+            # userT's own messages: not liked, no likes
+            for msg in Message.query.filter_by(user_id=self.userT_id):
+                form = soup.find('form', {'action': f'/users/add_like/{msg.id}'})
+                self.assertIn('btn-secondary', form.button['class'])
+                self.assertEqual(form.button.text.strip(), '')
+
     def test_add_like(self):
         msg = Message(id=234, text="Hello world!", user_id=self.user2_id)
         db.session.add(msg)
@@ -260,3 +294,139 @@ class UserViewTestCase(TestCase):
             self.assertEqual(res.status_code,200)
             self.assertNotIn("@test3", str(res.data))
             self.assertIn("Access unauthorized", str(res.data))
+
+    def test_show_likes(self):
+        self.setup_likes()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.userT_id
+
+            res = c.get(f"/users/{self.userT_id}/likes")
+            self.assertEqual(res.status_code, 200)
+            self.assertIn("user1 is here", str(res.data))
+            self.assertIn("@test1", str(res.data))
+            self.assertNotIn("first message", str(res.data))
+
+    def test_show_likes_pages(self):
+        msgs = [Message(text=f"liked message {i}", user_id=self.user1_id)
+                for i in range(LIKES_PAGE_SIZE + 5)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        db.session.add_all([Likes(user_id=self.userT_id, message_id=msg.id)
+                            for msg in msgs])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.userT_id
+
+            res = c.get(f"/users/{self.userT_id}/likes")
+            soup = BeautifulSoup(res.data, 'html.parser')
+            self.assertEqual(len(soup.find_all("li", {"class": "list-group-item"})),
+                             LIKES_PAGE_SIZE)
+
+            more = soup.find("a", string="More")["href"]
+            res = c.get(more)
+            soup = BeautifulSoup(res.data, 'html.parser')
+            self.assertEqual(len(soup.find_all("li", {"class": "list-group-item"})), 5)
+            self.assertIsNone(soup.find("a", string="More"))
+
+    def test_bulk_follow(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.userT_id
+
+            res = c.post("/users/follow", json={"user_ids": [
+                self.user1_id, self.user2_id, self.userT_id, 123456]})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json, {"followed": 2, "following_count": 2})
+
+            # already-followed users are skipped
+            res = c.post("/users/follow", json={"user_ids": [
+                self.user1_id, self.user3_id]})
+            self.assertEqual(res.json, {"followed": 1, "following_count": 3})
+
+            res = c.post("/users/stop-following", json={"user_ids": [
+                self.user1_id, self.user4_id]})
+            self.assertEqual(res.json, {"unfollowed": 1, "following_count": 2})
+
+        following = {f.user_being_followed_id for f in
+                     Follows.query.filter_by(user_following_id=self.userT_id)}
+        self.assertEqual(following, {self.user2_id, self.user3_id})
+
+    def test_bulk_follow_bad_request(self):
+        with self.client as c:
+            self.assertEqual(c.post("/users/follow", json={"user_ids": [1]}).status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.userT_id
+
+            self.assertEqual(c.post("/users/follow", json={"user_ids": ["x"]}).status_code, 400)
+            self.assertEqual(c.post("/users/follow", json={"user_ids": []}).status_code, 400)
+
+    def test_import_following(self):
+        csv_data = b"username\ntest1\n@test3\nnobody\n"
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.userT_id
+
+            res = c.post("/users/following/import",
+                         data={"csv_file": (io.BytesIO(csv_data), "follows.csv")},
+                         content_type="multipart/form-data",
+                         follow_redirects=True)
+            self.assertEqual(res.status_code, 200)
+            self.assertIn("Followed 2 new users", str(res.data))
+            self.assertIn("@test1", str(res.data))
+            self.assertIn("@test3", str(res.data))
+            self.assertNotIn("@test2", str(res.data))
+
+    def test_follow_and_unfollow(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.userT_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+            c.post(f"/users/follow/{self.user1_id}")
+            self.assertEqual(Follows.following_count(self.userT_id), 1)
+
+            c.post(f"/users/stop-following/{self.user1_id}")
+            c.post(f"/users/stop-following/{self.user1_id}")
+            self.assertEqual(Follows.following_count(self.userT_id), 0)
+
+    def test_export_ndjson(self):
+        self.setup_likes()
+        self.setup_followers()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.userT_id
+
+            res = c.get("/users/export")
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(res.is_streamed)
+            self.assertEqual(res.mimetype, "application/x-ndjson")
+
+            records = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+            types = [record["type"] for record in records]
+            self.assertEqual(types, ["profile", "message", "message", "like",
+                                     "following", "following", "follower"])
+            self.assertEqual(records[0]["username"], "userT")
+            self.assertEqual(records[3]["id"], 123)
+            self.assertEqual(records[6]["username"], "test3")
+
+    def test_export_csv(self):
+        self.setup_likes()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.userT_id
+
+            res = c.get("/users/export?format=csv")
+            self.assertEqual(res.mimetype, "text/csv")
+            rows = list(csv.DictReader(io.StringIO(res.get_data(as_text=True))))
+            self.assertEqual([row["type"] for row in rows],
+                             ["profile", "message", "message", "like"])
+            self.assertEqual(rows[3]["text"], "user1 is here")
+
+    def test_export_unauthorized(self):
+        with self.client as c:
+            res = c.get("/users/export", follow_redirects=True)
+            self.assertIn("Access unauthorized", str(res.data))
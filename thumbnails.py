@@ -0,0 +1,365 @@
+"""Local thumbnail cache for user avatars and header images.
+
+Users' image_url/header_image_url can point at any full-size image on the
+web. Templates instead link to `/thumbs/<size>/<token>` (via the
+`thumbnail` filter), where <token> is the signed source URL -- so the
+endpoint can't be used to fetch arbitrary URLs.
+
+The token only proves the URL came from a profile, and users choose those
+URLs. So `fetch` resolves the host itself and refuses loopback, private,
+link-local and reserved addresses (no avatars from 169.254.169.254 or
+localhost), connects to the address it checked, and checks every redirect
+the same way.
+
+The first request for a (url, size) fetches the image once, resizes it on
+a worker pool and stores a JPEG in a disk cache addressed by the hash of
+(url, size). Later requests are served straight from disk. The cache is
+capped in bytes and evicts least recently used files first. A source that
+couldn't be fetched isn't tried again for FAILURE_TTL seconds.
+
+Cached files are served as they are found, so THUMBNAIL_CACHE_DIR must be
+ours and writable by no one else (a planted symlink would serve any file
+we can read); otherwise thumbnails are off and images are linked
+directly.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+from flask import abort, current_app, send_file
+from itsdangerous import BadSignature, URLSafeSerializer
+from PIL import Image
+
+from assets import asset_url
+from startup import private_directory
+
+# size name -> (width, height); images are scaled down and center-cropped
+SIZES = {
+    'sm': (64, 64),
+    'md': (200, 200),
+    'header': (1200, 300),
+}
+
+FETCH_TIMEOUT = 5
+MAX_REDIRECTS = 3
+FAILURE_TTL = 5 * 60
+MAX_FAILURES = 10000
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+JPEG_QUALITY = 85
+ONE_DAY = 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailCache:
+    """Files in `directory`, keyed by hash, capped at `max_bytes` (LRU).
+
+    A file's mtime is its last use; eviction removes the oldest first.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self.entries())
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.jpg')
+
+    def entries(self):
+        """(mtime, path, size) of every cached file."""
+
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, path, stat.st_size
+
+    def get(self, key):
+        """Path of the cached file for `key` (marking it used), or None."""
+
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key, data):
+        """Store `data` under `key`, evicting old files if over the cap."""
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write then rename, so readers never see half a file
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self.lock:
+            self.total_bytes += len(data)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+        return path
+
+    def evict(self):
+        """Remove least recently used files until under 90% of the cap."""
+
+        target = self.max_bytes * 0.9
+        entries = sorted(self.entries())
+        self.total_bytes = sum(size for _, _, size in entries)
+
+        for _, path, size in entries:
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self.total_bytes -= size
+
+
+def public_address(host, port, allow_private=False):
+    """An address `host` resolves to, if none of them is loopback,
+    private, link-local or otherwise not on the public internet."""
+
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ValueError(f"Can't resolve {host}: {e}")
+
+    addresses = [info[4][0] for info in infos]
+    if not allow_private:
+        for address in addresses:
+            ip = ipaddress.ip_address(address.split('%')[0])
+            if ip.version == 6 and ip.ipv4_mapped:
+                ip = ip.ipv4_mapped
+            if not ip.is_global or ip.is_multicast:
+                raise ValueError(f"Refusing to fetch from {host} ({ip})")
+    return addresses[0]
+
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    """Connects to an already checked address rather than resolving the
+    host again (which could then resolve elsewhere)."""
+
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port),
+                                             self.timeout)
+
+
+class PinnedHTTPSConnection(PinnedHTTPConnection):
+    default_port = http.client.HTTPS_PORT
+
+    def connect(self):
+        super().connect()
+        self.sock = ssl.create_default_context().wrap_socket(
+            self.sock, server_hostname=self.host)
+
+
+def fetch(url, allow_private=False):
+    """Download the image at `url` (http/https only, public addresses
+    only, size-capped), following a few redirects."""
+
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Not an http(s) URL: {url}")
+
+        https = parts.scheme == 'https'
+        port = parts.port or (443 if https else 80)
+        address = public_address(parts.hostname, port, allow_private)
+        connection_class = (PinnedHTTPSConnection if https
+                            else PinnedHTTPConnection)
+        conn = connection_class(parts.hostname, port, address, FETCH_TIMEOUT)
+        try:
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            conn.request('GET', path, headers={'User-Agent': 'Warbler'})
+            response = conn.getresponse()
+
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                if not location:
+                    raise ValueError(f"Redirect without Location: {url}")
+                url = urljoin(url, location)
+                continue
+            if response.status != 200:
+                raise ValueError(f"HTTP {response.status}: {url}")
+
+            data = response.read(MAX_SOURCE_BYTES + 1)
+        finally:
+            conn.close()
+
+        if len(data) > MAX_SOURCE_BYTES:
+            raise ValueError(f"Image too large: {url}")
+        return data
+
+    raise ValueError(f"Too many redirects: {url}")
+
+
+def resize(data, size):
+    """Scale and center-crop image bytes to `size`; returns JPEG bytes."""
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('RGB', size)
+        thumb = image.convert('RGB')
+
+    width, height = size
+    scale = max(width / thumb.width, height / thumb.height)
+    scaled = (max(width, round(thumb.width * scale)),
+              max(height, round(thumb.height * scale)))
+    thumb = thumb.resize(scaled, Image.LANCZOS)
+
+    left = (thumb.width - width) // 2
+    top = (thumb.height - height) // 2
+    thumb = thumb.crop((left, top, left + width, top + height))
+
+    out = io.BytesIO()
+    thumb.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+class Thumbnailer:
+    """Makes thumbnails on a worker pool, at most once per (url, size)."""
+
+    def __init__(self, cache, workers, allow_private=False,
+                 clock=time.monotonic):
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix='thumbnail')
+        self.allow_private = allow_private
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        # key -> (when to try again, the error)
+        self.failures = {}
+
+    @staticmethod
+    def key(url, size_name):
+        return hashlib.sha256(f"{size_name}:{url}".encode('UTF-8')).hexdigest()
+
+    def make(self, url, size_name, key):
+        try:
+            data = resize(fetch(url, self.allow_private), SIZES[size_name])
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            with self.lock:
+                if len(self.failures) >= MAX_FAILURES:
+                    now = self.clock()
+                    self.failures = {key: failure for key, failure
+                                     in self.failures.items()
+                                     if failure[0] > now}
+                if len(self.failures) < MAX_FAILURES:
+                    self.failures[key] = (self.clock() + FAILURE_TTL, e)
+            raise
+        return self.cache.put(key, data)
+
+    def get(self, url, size_name):
+        """Path to the thumbnail of `url`, making it if needed."""
+
+        key = self.key(url, size_name)
+        path = self.cache.get(key)
+        if path:
+            return path
+
+        # concurrent requests for the same image share one fetch
+        with self.lock:
+            failure = self.failures.get(key)
+            if failure is not None:
+                if failure[0] > self.clock():
+                    raise failure[1]
+                del self.failures[key]
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.pool.submit(self.make, url, size_name, key)
+                self.in_flight[key] = future
+                future.add_done_callback(
+                    lambda _: self.in_flight.pop(key, None))
+
+        return future.result()
+
+
+def serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'],
+                             salt='thumbnail')
+
+
+def thumbnail_url(url, size_name='sm'):
+    """Template filter: URL of a `size_name` thumbnail of image `url`.
+
+    Local /static/ images are already small and cacheable, so they're
+    linked directly.
+    """
+
+    if not url or not url.startswith(('http://', 'https://')):
+        return asset_url(url)
+    if 'thumbnails' not in current_app.extensions:
+        return url
+
+    return f"/thumbs/{size_name}/{serializer().dumps(url)}"
+
+
+def serve_thumbnail(size_name, token):
+    """Serve a thumbnail, fetching and resizing the source on first use."""
+
+    if size_name not in SIZES:
+        abort(404)
+
+    try:
+        url = serializer().loads(token)
+    except BadSignature:
+        abort(404)
+
+    thumbnailer = current_app.extensions.get('thumbnails')
+    if thumbnailer is None:
+        abort(404)
+
+    try:
+        path = thumbnailer.get(url, size_name)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        abort(502)
+
+    return send_file(path, mimetype='image/jpeg', max_age=ONE_DAY)
+
+
+def init_app(app):
+    """Add the thumbnail endpoint and template filter to `app`."""
+
+    app.add_url_rule('/thumbs/<size_name>/<token>', 'thumbnail',
+                     serve_thumbnail)
+    app.add_template_filter(thumbnail_url, 'thumbnail')
+
+    directory = app.config['THUMBNAIL_CACHE_DIR']
+    if not private_directory(directory):
+        logger.warning("thumbnails off: %s is not a directory owned and "
+                       "only writable by this user", directory)
+        return
+
+    cache = ThumbnailCache(directory, app.config['THUMBNAIL_CACHE_MAX_BYTES'])
+    app.extensions['thumbnails'] = Thumbnailer(
+        cache, app.config['THUMBNAIL_WORKERS'],
+        app.config['THUMBNAIL_ALLOW_PRIVATE'])
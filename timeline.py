@@ -0,0 +1,197 @@
+"""Pull-based home timeline built from per-author caches.
+
+Instead of one `Message.user_id IN (...followed ids...)` query per home page
+load, each worker keeps, per recently active author, a bounded array of that
+author's newest (timestamp, message id) pairs. A home feed is the k-way heap
+merge of the caches of the authors the viewer follows; only the winning
+message ids are then loaded from the database.
+
+Caches are filled on demand (one query per batch of missing authors),
+appended to by `message_added`, dropped by `message_deleted` and expire
+after TIMELINE_CACHE_TTL seconds -- which bounds staleness for messages
+posted through another worker.
+
+Enabled with TIMELINE_ENGINE=cache; the default remains the SQL query.
+"""
+
+import bisect
+import heapq
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import select, union_all
+from sqlalchemy.orm import joinedload
+
+from models import db, Message
+
+LOAD_BATCH = 100
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def stamp(timestamp):
+    """A datetime as integer microseconds, for the compact arrays."""
+
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+class RecentMessages:
+    """One author's newest messages: parallel arrays, oldest first."""
+
+    __slots__ = ('stamps', 'ids', 'loaded_at')
+
+    def __init__(self, rows, loaded_at):
+        """`rows` are (timestamp, id) pairs, newest first."""
+
+        self.stamps = array('q', (stamp(ts) for ts, _ in reversed(rows)))
+        self.ids = array('q', (msg_id for _, msg_id in reversed(rows)))
+        self.loaded_at = loaded_at
+
+    def add(self, msg_stamp, msg_id, limit):
+        """Insert a message, keeping order; trim to `limit` now and then."""
+
+        i = len(self.stamps)
+        if i and msg_stamp < self.stamps[-1]:
+            i = bisect.bisect_right(self.stamps, msg_stamp)
+        self.stamps.insert(i, msg_stamp)
+        self.ids.insert(i, msg_id)
+
+        if len(self.ids) >= 2 * limit:
+            del self.stamps[:-limit]
+            del self.ids[:-limit]
+
+    def newest(self):
+        """(stamp, id) pairs, newest first."""
+
+        for i in range(len(self.ids) - 1, -1, -1):
+            yield self.stamps[i], self.ids[i]
+
+
+class TimelineCache:
+    """RecentMessages for up to `max_authors` authors, least recently used
+    evicted first."""
+
+    def __init__(self, per_author=100, max_authors=100_000, ttl=30,
+                 clock=time.monotonic):
+        self.per_author = per_author
+        self.max_authors = max_authors
+        self.ttl = ttl
+        self.clock = clock
+        self.authors = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def load(self, author_ids):
+        """Each author's newest `per_author` (timestamp, id), from the DB."""
+
+        rows = {author_id: [] for author_id in author_ids}
+        author_ids = list(author_ids)
+
+        for start in range(0, len(author_ids), LOAD_BATCH):
+            batch = author_ids[start:start + LOAD_BATCH]
+            newest = [
+                select(Message.user_id, Message.timestamp, Message.id)
+                .where(Message.user_id == author_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(self.per_author)
+                .subquery()
+                for author_id in batch
+            ]
+            stmt = union_all(*(select(sub) for sub in newest))
+            for author_id, timestamp, msg_id in db.session.execute(stmt):
+                rows[author_id].append((timestamp, msg_id))
+
+        for author_rows in rows.values():
+            author_rows.sort(reverse=True)
+        return rows
+
+    def recent(self, author_ids):
+        """RecentMessages for each author, loading any missing or stale."""
+
+        now = self.clock()
+        found = {}
+        missing = []
+
+        with self.lock:
+            for author_id in author_ids:
+                recent = self.authors.get(author_id)
+                if recent is None or now - recent.loaded_at > self.ttl:
+                    missing.append(author_id)
+                else:
+                    self.authors.move_to_end(author_id)
+                    found[author_id] = recent
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            loaded = {author_id: RecentMessages(rows, now)
+                      for author_id, rows in self.load(missing).items()}
+            with self.lock:
+                self.authors.update(loaded)
+                while len(self.authors) > self.max_authors:
+                    self.authors.popitem(last=False)
+            found.update(loaded)
+
+        return found
+
+    def home_ids(self, author_ids, limit):
+        """Ids of the newest `limit` messages by any of `author_ids`."""
+
+        recent = self.recent(author_ids)
+        with self.lock:
+            merged = heapq.merge(*(r.newest() for r in recent.values()),
+                                 reverse=True)
+            return [msg_id for _, msg_id in islice(merged, limit)]
+
+    def message_added(self, msg):
+        with self.lock:
+            recent = self.authors.get(msg.user_id)
+            if recent is not None:
+                recent.add(stamp(msg.timestamp), msg.id, self.per_author)
+
+    def message_deleted(self, msg):
+        # the author's cache may now be short of per_author messages;
+        # drop it and reload on next use
+        with self.lock:
+            self.authors.pop(msg.user_id, None)
+
+
+def home_messages(author_ids, limit=100):
+    """The newest `limit` messages by `author_ids`, newest first, with
+    their users loaded."""
+
+    ids = current_app.extensions['timeline'].home_ids(author_ids, limit)
+    if not ids:
+        return []
+
+    by_id = {msg.id: msg for msg in (Message.query
+                                     .options(joinedload(Message.user))
+                                     .filter(Message.id.in_(ids)))}
+    return [by_id[msg_id] for msg_id in ids if msg_id in by_id]
+
+
+def message_added(msg):
+    """Note a newly committed message."""
+
+    if 'timeline' in current_app.extensions:
+        current_app.extensions['timeline'].message_added(msg)
+
+
+def message_deleted(msg):
+    """Note a deleted message."""
+
+    if 'timeline' in current_app.extensions:
+        current_app.extensions['timeline'].message_deleted(msg)
+
+
+def init_app(app):
+    """Set up the timeline cache if TIMELINE_ENGINE is 'cache'."""
+
+    if app.config['TIMELINE_ENGINE'] == 'cache':
+        app.extensions['timeline'] = TimelineCache(
+            ttl=app.config['TIMELINE_CACHE_TTL'])
@@ -0,0 +1,20 @@
+"""Production entry point for Warbler.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Unlike importing app.py directly, this skips dev-only imports and compiles
+every template up front (into a bytecode cache shared on disk), so the
+first requests after a deploy don't pay for template compilation.
+"""
+
+import os
+
+os.environ.setdefault('FLASK_ENV', 'production')
+
+from app import app  # noqa: E402
+import startup  # noqa: E402
+
+startup.enable_bytecode_cache(
+    app, os.environ.get('TEMPLATE_CACHE_DIR',
+                        startup.DEFAULT_TEMPLATE_CACHE_DIR))
+startup.precompile_templates(app)